@@ -21,5 +21,5 @@ echo "Web server started."
 # Perform config test, triggers also registration
 /usr/local/bin/opensubmit-exec configtest
 
-# Run "opensubmit-exec run" every minute
-cron -f
+# Keep fetching jobs, logging goes directly into Docker stdout / stderr
+exec /usr/local/bin/opensubmit-exec daemon
@@ -4,8 +4,11 @@
     This library has two parts: The validator support functions and the
     daemon functionality for fetching and running validator scripts.
 
-    You should add a cron job for the following call:
-       python3 -m opensubmitexec.cmdline
+    You should either run the resident executor daemon:
+       opensubmit-exec daemon
+
+    or add a cron job for the following call:
+       opensubmit-exec run
 
     For writing test scripts, check the manual at open-submit.org
 '''
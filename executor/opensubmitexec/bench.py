@@ -0,0 +1,196 @@
+'''
+    Throughput benchmark of the executor.
+
+    Runs local test cases, as with 'opensubmit-exec test <dir>',
+    many times in a row and reports the latency of the job phases
+    and the number of jobs per second. The results can be written
+    as JSON, so that different runs can be compared.
+
+    A case directory contains a validator and a student submission file.
+    Case directories may also contain a validator and several
+    sub-directories with a single submission file each, such as
+    the 'helloworld_java' example.
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import zipfile
+import platform
+import tempfile
+
+from .server import fake_fetch_job
+from .cache import checksum
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+VALIDATOR_NAMES = ['validator.py', 'validator.zip']
+
+# Test script for synthetic submissions
+SYNTHETIC_VALIDATOR = """
+def validate(job):
+    job.grep_many(['main', 'TODO'])
+    job.send_pass_result("Got {0} files.".format(len(job.student_files)))
+"""
+
+
+def find_cases(directory):
+    '''
+    Returns the benchmark cases in the given directory, as list
+    of (name, validator path, submission path) tuples.
+    '''
+    cases = []
+    for root, dirs, files in sorted(os.walk(directory)):
+        validators = [fname for fname in files if fname in VALIDATOR_NAMES]
+        if not validators:
+            continue
+        validator = os.path.join(root, validators[0])
+        name = os.path.relpath(root, directory)
+        if name == '.':
+            name = os.path.basename(os.path.abspath(directory))
+        submissions = [fname for fname in files if fname not in VALIDATOR_NAMES]
+        if len(submissions) == 1:
+            cases.append((name, validator, os.path.join(root, submissions[0])))
+        for subdir in sorted(dirs):
+            entries = os.listdir(os.path.join(root, subdir))
+            if len(entries) == 1:
+                cases.append((name + os.sep + subdir, validator,
+                              os.path.join(root, subdir, entries[0])))
+    return cases
+
+
+def synthetic_case(directory, files, size):
+    '''
+    Create a case with a ZIP archive of the given number of files,
+    with the given total size in KB. The file content is random,
+    so that the archive is not smaller than the unpacked data.
+    '''
+    rnd = random.Random(files * 1000003 + size)
+    file_size = max(1, size * 1024 // files)
+    submission = os.path.join(directory, 'submission.zip')
+    with zipfile.ZipFile(submission, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for index in range(files):
+            data = rnd.getrandbits(file_size * 8).to_bytes(file_size, 'little')
+            archive.writestr('src/file{0}.c'.format(index), data)
+    validator = os.path.join(directory, 'validator.py')
+    with open(validator, 'w') as f:
+        f.write(SYNTHETIC_VALIDATOR)
+    return ('synthetic-{0}files-{1}KB'.format(files, size), validator, submission)
+
+
+def statistics(values):
+    '''
+    Returns minimum, maximum, mean and percentiles of the given values.
+    '''
+    values = sorted(values)
+
+    def percentile(p):
+        # Nearest rank
+        return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+    return {'min': values[0],
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'max': values[-1],
+            'mean': sum(values) / len(values)}
+
+
+def run_job(config, case_dir, validator_hash):
+    '''
+    Run one job for the prepared case directory.
+
+    Returns the job duration, the job phases and the result.
+    '''
+    started = time.time()
+    job = fake_fetch_job(config, case_dir, validator_hash)
+    if not job:
+        return time.time() - started, [], 'failed'
+    try:
+        job._run_validate()
+    except SystemExit:
+        # Test script called exit(), this would stop the executor
+        return time.time() - started, job._timeline, 'error'
+    if job.error_code is None:
+        result = 'none'
+    elif job.error_code == 0:
+        result = 'passed'
+    else:
+        result = 'failed'
+    return time.time() - started, job._timeline, result
+
+
+def run_case(config, validator, submission, repetitions, warmup):
+    '''
+    Run the case repeatedly and summarize the measurements.
+    '''
+    case_dir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        shutil.copy(validator, case_dir)
+        shutil.copy(submission, case_dir)
+        # Like in the daemon, the validator is cached
+        validator_hash = checksum(validator)
+        for index in range(warmup):
+            run_job(config, case_dir, validator_hash)
+        durations = []
+        phases = {}
+        results = {}
+        started = time.time()
+        for index in range(repetitions):
+            duration, timeline, result = run_job(config, case_dir, validator_hash)
+            durations.append(duration)
+            results[result] = results.get(result, 0) + 1
+            for phase in timeline:
+                if phase['duration'] is not None:
+                    phases.setdefault(phase['phase'], []).append(phase['duration'])
+        total = time.time() - started
+    finally:
+        shutil.rmtree(case_dir, ignore_errors=True)
+    return {'jobs': repetitions,
+            'duration': total,
+            'jobs_per_second': repetitions / total,
+            'results': results,
+            'latency': statistics(durations),
+            'phases': dict([(phase, statistics(values)) for phase, values in phases.items()])}
+
+
+def run_benchmark(config, cases, repetitions=10, warmup=1):
+    '''
+    Run all cases and return the benchmark report.
+    '''
+    report = {'version': 1,
+              'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': platform.node(),
+              'platform': platform.platform(),
+              'python': platform.python_version(),
+              'repetitions': repetitions,
+              'warmup': warmup,
+              'cases': {}}
+    jobs = 0
+    duration = 0
+    for name, validator, submission in cases:
+        logger.info("Benchmarking case " + name)
+        result = run_case(config, validator, submission, repetitions, warmup)
+        report['cases'][name] = result
+        jobs += result['jobs']
+        duration += result['duration']
+    report['total'] = {'jobs': jobs,
+                       'duration': duration,
+                       'jobs_per_second': jobs / duration if duration else 0}
+    return report
+
+
+def print_report(report, out=sys.stdout):
+    line = "{0:<40} {1:>10} {2:>10} {3:>10} {4:>10}"
+    for name, case in sorted(report['cases'].items()):
+        out.write("\n{0}: {1:.2f} jobs/s, results {2}\n".format(
+            name, case['jobs_per_second'], case['results']))
+        out.write(line.format("Phase (seconds)", "p50", "p90", "p99", "max") + "\n")
+        rows = [("job", case['latency'])] + sorted(case['phases'].items())
+        for phase, stats in rows:
+            out.write(line.format(phase[:40], *["{0:.4f}".format(stats[key])
+                                                for key in ['p50', 'p90', 'p99', 'max']]) + "\n")
+    out.write("\nTotal: {0} jobs in {1:.2f} seconds, {2:.2f} jobs/s\n".format(
+        report['total']['jobs'], report['total']['duration'], report['total']['jobs_per_second']))
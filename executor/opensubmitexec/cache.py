@@ -0,0 +1,118 @@
+'''
+    Local file caches of the executor.
+'''
+
+import os
+import shutil
+import hashlib
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+
+def checksum(fname):
+    '''
+    Determine the MD5 checksum of a file, in the same way as the OpenSubmit server.
+    '''
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class FileCache():
+    '''
+    Content-addressed file cache on disk.
+
+    Every entry is a single file named by its key. The modification
+    time of the file is updated on every cache hit, so that the least
+    recently used entries can be removed when the cache grows beyond
+    its size limit (in bytes).
+    '''
+    directory = None
+    max_size = None
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, target):
+        '''
+        Copy the cached file for the given key to the target path.
+
+        Students can modify everything in the working directory,
+        so a private copy is handed out instead of a hard link.
+
+        Returns False if the key is not cached.
+        '''
+        path = self._path(key)
+        try:
+            os.utime(path)
+            shutil.copyfile(path, target)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, source):
+        '''
+        Store a copy of the source file under the given key.
+        '''
+        path = self._path(key)
+        # Parallel jobs may store the same key, so rename atomically
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        '''
+        Remove least recently used entries until the size limit is met.
+        '''
+        entries = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.tmp'):
+                # Currently written by some job
+                continue
+            path = self._path(fname)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum([size for mtime, size, path in entries])
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.debug("Removing {0} from cache.".format(path))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def validator_cache(config):
+    '''
+    Returns the configured validator cache, or None if it is disabled.
+    '''
+    max_size = config.getint("Execution", "validator_cache_size")
+    if max_size <= 0:
+        return None
+    directory = os.path.join(config.get("Execution", "cache_dir"), 'validators')
+    return FileCache(directory, max_size * 1024 * 1024)
+
+
+def build_cache(config):
+    '''
+    Returns the configured build cache, or None if it is disabled.
+    '''
+    max_size = config.getint("Execution", "build_cache_size")
+    if max_size <= 0:
+        return None
+    directory = os.path.join(config.get("Execution", "cache_dir"), 'builds')
+    return FileCache(directory, max_size * 1024 * 1024)
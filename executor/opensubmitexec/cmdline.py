@@ -1,22 +1,34 @@
 # Administration script functionality on the production system
 
 import sys
+import json
+import time
+import signal
+import tempfile
+import threading
+import multiprocessing
+from queue import Empty
 
 from . import CONFIG_FILE_DEFAULT
-from .server import fetch_job, fake_fetch_job, send_hostinfo
-from .running import kill_longrunning
+from .server import fetch_job, fake_fetch_job, send_hostinfo, lease_jobs, fetch_leased_job
+from .limits import cleanup_jobs
+from .spool import replay_spool
+from . import metrics
 from .locking import ScriptLock, break_lock
 from .config import read_config, has_config, create_config, check_config
 
+import logging
+logger = logging.getLogger('opensubmitexec')
 
-def download_and_run(config):
+
+def download_and_run(config, wait=0):
     '''
     Main operation of the executor.
 
     Returns True when a job was downloaded and executed.
     Returns False when no job could be downloaded.
     '''
-    job = fetch_job(config)
+    job = fetch_job(config, wait)
     if job:
         job._run_validate()
         return True
@@ -24,6 +36,230 @@ def download_and_run(config):
         return False
 
 
+def poll_loop(config, stop, slot='main'):
+    '''
+    Repeats the cron-style 'run' operation until the stop event is set.
+
+    When no job is available, the delay until the next poll is
+    doubled, up to the configured maximum. A fetched job resets
+    the delay, so that the queue is drained without pauses.
+
+    Servers supporting long polling hold the request until a job
+    is available. In this case, the server is asked again right away.
+
+    Unexpected errors are logged and delay the next poll like an
+    empty poll, they do not end the loop.
+    '''
+    min_interval = config.getint("Execution", "poll_interval")
+    max_interval = config.getint("Execution", "poll_interval_max")
+    wait = config.getint("Server", "long_poll")
+    logger.info("Slot {0} started, polling every {1} to {2} seconds.".format(
+        slot, min_interval, max_interval))
+    interval = min_interval
+    while not stop.is_set():
+        try:
+            replay_spool(config)
+            started = time.time()
+            ran = download_and_run(config, wait)
+        except Exception:
+            logger.exception("Slot {0} failed, polling again in {1} seconds.".format(slot, interval))
+            stop.wait(interval)
+            interval = min(interval * 2, max_interval)
+            continue
+        if ran:
+            logger.info("Slot {0} finished a job.".format(slot))
+            interval = min_interval
+        elif wait > 0 and time.time() - started >= wait:
+            logger.debug("Slot {0} waited for jobs on the server, polling again.".format(slot))
+            interval = min_interval
+        else:
+            logger.debug("Slot {0} polls again in {1} seconds.".format(slot, interval))
+            stop.wait(interval)
+            interval = min(interval * 2, max_interval)
+    logger.info("Slot {0} stopped.".format(slot))
+
+
+def stop_on_signals():
+    '''
+    Returns an event that is set on SIGTERM or SIGINT.
+    '''
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        logger.info("Received signal {0}, stopping after the current job.".format(signum))
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    return stop
+
+
+def run_slot(config, slot):
+    '''
+    Entry point for a slot process of the daemon.
+    '''
+    poll_loop(config, stop_on_signals(), slot)
+
+
+def run_leased_slot(config, jobs, done, slot):
+    '''
+    Entry point for a slot process of the daemon with batch leasing.
+
+    Runs the job descriptions leased by the master process,
+    and reports every finished job on the 'done' queue.
+    '''
+    stop = stop_on_signals()
+    logger.info("Slot {0} started, waiting for leased jobs.".format(slot))
+    while not stop.is_set():
+        try:
+            description = jobs.get(timeout=1)
+        except Empty:
+            continue
+        try:
+            job = fetch_leased_job(config, description)
+            if job:
+                job._run_validate()
+                logger.info("Slot {0} finished a job.".format(slot))
+        except Exception:
+            logger.exception("Slot {0} failed to run a leased job.".format(slot))
+        done.put(slot)
+    logger.info("Slot {0} stopped.".format(slot))
+
+
+def start_slot(index, target, args):
+    slot = "slot-{0}".format(index + 1)
+    worker = multiprocessing.Process(target=target,
+                                     args=args + (slot,),
+                                     name=slot)
+    worker.start()
+    return worker
+
+
+def run_slots(config, stop, slots):
+    '''
+    Runs one polling process per slot until the stop event is set.
+    '''
+    workers = [None] * slots
+    while not stop.is_set():
+        for index, worker in enumerate(workers):
+            if worker is None or not worker.is_alive():
+                if worker is not None:
+                    logger.error("Slot {0} died with exit code {1}, restarting it.".format(
+                        worker.name, worker.exitcode))
+                workers[index] = start_slot(index, run_slot, (config,))
+        stop.wait(1)
+    return workers
+
+
+def requeue(jobs):
+    '''
+    Move the waiting jobs of a dead slot process to a fresh queue,
+    since the dead process may have left the old one locked.
+
+    Returns the new queue and the number of jobs in it.
+    '''
+    fresh = multiprocessing.Queue()
+    count = 0
+    try:
+        while True:
+            fresh.put(jobs.get_nowait())
+            count += 1
+    except Empty:
+        pass
+    jobs.close()
+    return fresh, count
+
+
+def run_leased_slots(config, stop, slots):
+    '''
+    Runs one process per slot until the stop event is set.
+
+    Jobs for all idle slots are leased from the server with
+    a single request and handed out to the slot processes.
+    The polling delay behaves like in poll_loop().
+    '''
+    min_interval = config.getint("Execution", "poll_interval")
+    max_interval = config.getint("Execution", "poll_interval_max")
+    wait = config.getint("Server", "long_poll")
+    interval = min_interval
+    next_poll = 0
+    done = multiprocessing.Queue()
+    queues = [multiprocessing.Queue() for index in range(slots)]
+    pending = [0] * slots
+    workers = [None] * slots
+    while not stop.is_set():
+        dead = [index for index, worker in enumerate(workers)
+                if worker is not None and not worker.is_alive()]
+        # Also the jobs finished by slot processes that died meanwhile
+        try:
+            while True:
+                finished = done.get_nowait()
+                pending[[worker.name for worker in workers].index(finished)] -= 1
+        except Empty:
+            pass
+        for index, worker in enumerate(workers):
+            if index in dead:
+                logger.error("Slot {0} died with exit code {1}, restarting it.".format(
+                    worker.name, worker.exitcode))
+                # A job that was running is lost, the server marks it as failed
+                # after the job timeout. The waiting jobs go to the new process.
+                queues[index], pending[index] = requeue(queues[index])
+            if worker is None or index in dead:
+                workers[index] = start_slot(index, run_leased_slot,
+                                            (config, queues[index], done))
+        idle = [index for index in range(slots) if pending[index] == 0]
+        if idle and time.time() >= next_poll:
+            replay_spool(config)
+            started = time.time()
+            descriptions = lease_jobs(config, len(idle), wait)
+            for index, description in zip(idle, descriptions):
+                queues[index].put(description)
+                pending[index] += 1
+            if descriptions or (wait > 0 and time.time() - started >= wait):
+                interval = min_interval
+                next_poll = 0
+            else:
+                logger.debug("Polling again in {0} seconds.".format(interval))
+                next_poll = time.time() + interval
+                interval = min(interval * 2, max_interval)
+        stop.wait(1)
+    return workers
+
+
+def run_daemon(config):
+    '''
+    Resident operation of the executor.
+
+    Runs the poll loop until SIGTERM or SIGINT is received,
+    so that configuration and imports stay warm.
+
+    With more than one configured slot, every slot gets its own
+    process. Crashed slot processes are restarted, a stop request
+    is forwarded to all of them.
+    '''
+    slots = config.getint("Execution", "slots")
+    stop = stop_on_signals()
+
+    logger.info("Executor daemon started with {0} slot(s).".format(slots))
+    metrics_server = metrics.serve(config)
+    with ScriptLock(config):
+        cleanup_jobs(config)
+        if slots == 1:
+            poll_loop(config, stop)
+        else:
+            if config.getboolean("Execution", "batch_leasing"):
+                workers = run_leased_slots(config, stop, slots)
+            else:
+                workers = run_slots(config, stop, slots)
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+    if metrics_server:
+        metrics_server.shutdown()
+    logger.info("Executor daemon stopped.")
+
+
 def copy_and_run(config, src_dir):
     '''
     Local-only operation of the executor.
@@ -47,10 +283,70 @@ def copy_and_run(config, src_dir):
 
 
 def get_config_fname(argv):
+    return get_option(argv, "-c", CONFIG_FILE_DEFAULT)
+
+
+def get_option(argv, name, default=None):
     for index, entry in enumerate(argv):
-        if entry == "-c":
+        if entry == name:
             return argv[index + 1]
-    return CONFIG_FILE_DEFAULT
+    return default
+
+
+def run_bench(config, argv):
+    '''
+    Benchmark operation of the executor, see bench.py.
+
+    Returns False if no benchmark case was found.
+    '''
+    from . import bench
+    cases = []
+    if len(argv) > 2 and not argv[2].startswith('-'):
+        cases += bench.find_cases(argv[2])
+    synthetic = get_option(argv, "-s")
+    if synthetic:
+        files, size = synthetic.split('x')
+        cases.append(bench.synthetic_case(tempfile.mkdtemp(), int(files), int(size)))
+    if not cases:
+        return False
+    report = bench.run_benchmark(config, cases,
+                                 int(get_option(argv, "-n", 10)),
+                                 int(get_option(argv, "-w", 1)))
+    bench.print_report(report)
+    output = get_option(argv, "-o")
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return True
+
+
+def run_fakeserver(argv):
+    '''
+    Serve the test cases in a local folder as jobs, see fakeserver.py.
+    Runs until all jobs are answered, or until it is interrupted.
+    '''
+    from .fakeserver import create_fake_server
+    jobs = get_option(argv, "-j")
+    weights = {}
+    for entry in get_option(argv, "-m", "").split(","):
+        if entry:
+            name, weight = entry.rsplit("=", 1)
+            weights[name] = float(weight)
+    fake = create_fake_server(argv[2],
+                              weights=weights,
+                              jobs=int(jobs) if jobs else None,
+                              latency=float(get_option(argv, "-l", 0)),
+                              error_rate=float(get_option(argv, "-e", 0)),
+                              results=get_option(argv, "-r"))
+    url = fake.start(int(get_option(argv, "-p", 8000)), get_option(argv, "-a", "127.0.0.1"))
+    print("Serving jobs at {0} with secret {1}".format(url, fake.secret))
+    try:
+        while not (jobs and fake.wait_for_results(int(jobs), 1)):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    fake.stop()
+    print(json.dumps(fake.summary(), indent=2))
 
 
 def console_script():
@@ -60,14 +356,26 @@ def console_script():
         installed by setuptools.
     '''
     if len(sys.argv) == 1:
-        print("opensubmit-exec [configcreate <server_url>|configtest|run|test <dir>|unlock|help] [-c config_file]")
+        print("opensubmit-exec [configcreate <server_url>|configtest|run|daemon|test <dir>|bench [<dir>]|fakeserver <dir>|unlock|help] [-c config_file]")
         return 0
 
     if "help" in sys.argv[1]:
         print("configcreate <server_url>:  Create initial config file for the OpenSubmit executor.")
         print("configtest:                 Check config file for correct installation of the OpenSubmit executor.")
         print("run:                        Fetch and run code to be tested from the OpenSubmit web server. Suitable for crontab.")
+        print("daemon:                     Keep fetching and running code to be tested from the OpenSubmit web server. Replaces the crontab entry.")
         print("test <dir>:                 Run test script from a local folder for testing purposes.")
+        print("bench [<dir>]:              Run the test cases in a local folder repeatedly and report the executor throughput.")
+        print("    -n <count>              Measured runs per case (default: 10), after one warm-up run (-w <count>).")
+        print("    -s <files>x<size>       Add a synthetic submission archive with the number of files and total size in KB.")
+        print("    -o <file>               Write the results as JSON, for comparing benchmark runs.")
+        print("fakeserver <dir>:           Serve the test cases in a local folder as jobs, for load tests of executors.")
+        print("    -p <port>               Port of the fake server (default: 8000), listening on 127.0.0.1 (-a <address>).")
+        print("    -j <count>              Number of jobs to hand out, the server stops when all results arrived.")
+        print("    -m <case>=<weight>,...  Relative frequency of the test cases in the job mix (default: 1).")
+        print("    -l <seconds>            Mean latency injected into every request.")
+        print("    -e <rate>               Fraction of requests failing with HTTP error 503.")
+        print("    -r <file>               Append all received results to the file, as JSON lines.")
         print("unlock:                     Break the script lock, because of crashed script.")
         print("help:                       Print this help")
         print(
@@ -114,17 +422,33 @@ def console_script():
 
     if "run" in sys.argv[1]:
         config = read_config(config_fname)
-        # Perform additional precautions for unattended mode in cron
-        kill_longrunning(config)
         with ScriptLock(config):
+            cleanup_jobs(config)
+            replay_spool(config)
             download_and_run(config)
         return 0
 
+    if "daemon" in sys.argv[1]:
+        config = read_config(config_fname)
+        run_daemon(config)
+        return 0
+
     if "test" in sys.argv[1]:
         config = read_config(config_fname)
         copy_and_run(config, sys.argv[2])
         return 0
 
+    if "fakeserver" in sys.argv[1]:
+        run_fakeserver(sys.argv)
+        return 0
+
+    if "bench" in sys.argv[1]:
+        config = read_config(config_fname)
+        if not run_bench(config, sys.argv):
+            print("ERROR: No benchmark cases given.")
+            return 1
+        return 0
+
 
 if __name__ == "__main__":
     exit(console_script())
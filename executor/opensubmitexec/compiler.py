@@ -2,7 +2,15 @@
 Functions dealing with the compilation of code.
 '''
 
-from .exceptions import ValidatorBrokenException
+import os
+import hashlib
+import tarfile
+import tempfile
+
+from .exceptions import ValidatorBrokenException, JobException
+from .filesystem import ArchiveExtractor
+from .cache import checksum
+from .hostinfo import compiler_version
 
 import logging
 logger = logging.getLogger('opensubmitexec')
@@ -34,3 +42,79 @@ def compiler_cmdline(compiler=GCC, output=None, inputs=None):
         else:
             cmdline.append(element)
     return cmdline[0], cmdline[1:]
+
+
+def snapshot(directory, ignore=[]):
+    '''
+    Returns modification time and size of all files in the directory,
+    by their relative path.
+    '''
+    result = {}
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        for fname in files:
+            path = os.path.join(root, fname)
+            relpath = os.path.relpath(path, directory)
+            if relpath not in ignore:
+                stat = os.lstat(path)
+                result[relpath] = (stat.st_mtime_ns, stat.st_size)
+    return result
+
+
+def build_key(directory, files, program, arguments):
+    '''
+    Cache key for a compiler run, based on the command line, the compiler
+    version and the content of the given files in the directory.
+
+    All files are considered, since included headers are not
+    part of the compiler command line.
+    '''
+    md5 = hashlib.md5()
+    md5.update(repr([program] + list(arguments)).encode('utf-8'))
+    md5.update(compiler_version(program).encode('utf-8'))
+    for relpath in sorted(files):
+        md5.update(relpath.encode('utf-8'))
+        md5.update(checksum(os.path.join(directory, relpath)).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def store_build(cache, key, directory, before):
+    '''
+    Store the files created or changed by a compiler run in the cache.
+    '''
+    after = snapshot(directory)
+    outputs = [relpath for relpath in sorted(after) if before.get(relpath) != after[relpath]]
+    fd, tmp_fname = tempfile.mkstemp(suffix='.tar')
+    os.close(fd)
+    try:
+        with tarfile.open(tmp_fname, 'w') as tar:
+            for relpath in outputs:
+                tar.add(os.path.join(directory, relpath), arcname=relpath)
+        cache.put(key, tmp_fname)
+    finally:
+        os.remove(tmp_fname)
+    logger.debug("Stored build result {0} in cache: {1}".format(key, outputs))
+
+
+def restore_build(cache, key, directory):
+    '''
+    Restore the files created by an earlier compiler run from the cache.
+
+    Returns False if there is no such cache entry, or if it contains
+    members that point outside of the directory. The entry was written
+    by an earlier student's build, so it gets the same checks as a
+    submission archive. The next store replaces a rejected entry.
+    '''
+    fd, tmp_fname = tempfile.mkstemp(suffix='.tar')
+    os.close(fd)
+    try:
+        if not cache.get(key, tmp_fname):
+            return False
+        try:
+            ArchiveExtractor(directory, tmp_fname).extract_tar()
+        except (JobException, tarfile.TarError):
+            logger.warning("Ignoring broken build result {0} in cache.".format(key))
+            return False
+    finally:
+        os.remove(tmp_fname)
+    return True
@@ -24,17 +24,48 @@ DEFAULT_SETTINGS = {
         'compile_cmd': 'make',
         'directory': '/tmp/',                    # Base directory for temporary directories
         'pidfile': '/tmp/executor.lock',         # Lock file for script lock
+        'slots': '1',                            # Number of parallel jobs
+        'slotlock': '/tmp/executor.slots',       # Lock file for exclusive jobs
+        'preempt_after': '0',                    # Seconds an exclusive job waits before pre-empting others
+        'process_registry': '/tmp/executor.jobs/',  # Process groups of the running jobs
+        'batch_leasing': 'False',                # Daemon mode: Lease jobs for all idle slots at once
+        'download_chunk_size': '65536',          # Chunk size in bytes for submission download
+        'max_submission_size': '500',            # Submission size limit in MB, 0 means no limit
+        'max_unpacked_size': '1000',             # Unpacked archive size limit in MB, 0 means no limit
+        'max_archive_entries': '10000',          # Archive entry limit, 0 means no limit
+        'max_compression_ratio': '200',          # Archive compression ratio limit, 0 means no limit
+        'cache_dir': '/tmp/executor.cache/',     # Base directory for local caches
+        'spool_dir': '/tmp/executor.spool/',     # Undelivered job results
+        'cgroup_dir': '',                        # Delegated cgroup v2 directory for job cgroups
+        'measure_cpus': '',                      # CPUs for performance measurements, e.g. isolated cores
+        'validator_cache_size': '100',           # Validator cache limit in MB, 0 disables it
+        'build_cache_size': '100',               # Build cache limit in MB, 0 disables it
+        'hostinfo_ttl': '86400',                 # Seconds the host information is cached, 0 disables it
+        'hostinfo_timeout': '10',                # Seconds per host information probe
+        'metrics_file': '',                      # Prometheus text file with executor metrics
+        'metrics_port': '0',                     # Daemon mode: Local HTTP port for metrics, 0 disables it
+        'validator_templates': '10',             # Number of unpacked validators kept, 0 disables it
+        'validator_template_hardlinks': 'False', # Hard link validator files into working directories
+        'poll_interval': '5',                    # Daemon mode: Initial delay between polls
+        'poll_interval_max': '60',               # Daemon mode: Maximum delay between polls
         # Execution environment for validation scripts
-        'script_runner': '/usr/bin/env python3'
+        'script_runner': '/usr/bin/env python3',
+        'fork_validators': 'True'                # Run test scripts in a forked child process
     },
     'Server': {
         'url': 'http://localhost:8000',          # OpenSubmit web server
         # Shared secret with OpenSubmit web server
         'secret': '49846zut93purfh977TTTiuhgalkjfnk89',
-        'uuid': uuid.getnode()
+        'uuid': uuid.getnode(),
+        'pooling': 'True',                       # Keep-alive connections, if requests is installed
+        'pool_size': '4',                        # Maximum number of pooled connections
+        'http_timeout': '60',                    # Timeout for server communication
+        'long_poll': '30',                       # Time the server may hold a job request
+        'retries': '5',                          # Retries for sending job results
+        'retry_delay': '2'                       # Initial delay between retries
     },
     'Logging': {
-        'format': '%%(asctime)-15s (%%(process)d): %%(message)s',
+        'format': '%%(asctime)-15s (%%(processName)s %%(process)d): %%(message)s',
         'file': '/tmp/executor.log',
         'to_file': 'False',
         'level': 'DEBUG'
@@ -58,6 +89,27 @@ secret={secret}
 # UUID of this executor
 uuid={uuid}
 
+# If the Python 'requests' package is installed, the executor keeps
+# connections to the server open for re-use. Disable this to open
+# a fresh connection for every request.
+pooling={pooling}
+
+# Maximum number of open connections to keep for re-use
+pool_size={pool_size}
+
+# Timeout in seconds for all connections to the server
+http_timeout={http_timeout}
+
+# Ask the server to hold job requests for up to this number of seconds,
+# until a job becomes available. This gives immediate job dispatching
+# with only a few requests. 0 disables the waiting.
+long_poll={long_poll}
+
+# Job results are sent again if the server is not reachable. The delay
+# in seconds between the attempts doubles after every failed attempt.
+retries={retries}
+retry_delay={retry_delay}
+
 [Execution]
 
 # Place where downloaded archives are extracted, compiled and validated
@@ -73,22 +125,133 @@ cleanup={cleanup}
 # Script interpreter to be used for the validation scripts
 script_runner={script_runner}
 
+# Run every test script in a forked child process of the executor,
+# so that crashing test scripts cannot harm the executor. The test
+# scripts are imported only once per version.
+fork_validators={fork_validators}
+
 # Validators can decide to run alone on the machine.
 # In this case, the following lock file is used.
 pidfile={pidfile}
 
-# Whatver runs under this account is not allowed to run longer than this time
-# This is the ultimate safeguard for deadlocks and submission processes going mad
-# This also means that you should not use this account for interactive work
+# Number of jobs being fetched and validated in parallel by the daemon,
+# each one in its own process
+slots={slots}
+
+# Validators can demand that their job runs alone on the machine.
+# This lock file coordinates the parallel jobs for that purpose.
+slotlock={slotlock}
+
+# An exclusive job waits for the other jobs on this machine to finish.
+# With a positive value, it waits only this number of seconds and then
+# terminates the programs of the other jobs. Pre-empted jobs are given back
+# to the server without a result, so that they are handed out again.
+# Demands OpenSubmit server with executor API version 1.2 or newer,
+# older servers would fail the job. 0 means waiting forever.
+preempt_after={preempt_after}
+
+# The process groups of all running jobs are registered in this directory,
+# for pre-emption and for cleaning up after crashed executors.
+process_registry={process_registry}
+
+# With more than one slot, the daemon can lease jobs for all idle slots
+# with a single request, instead of letting every slot poll on its own.
+# Demands OpenSubmit server with executor API version 1.1 or newer.
+batch_leasing={batch_leasing}
+
+# Student submissions are downloaded in chunks of this size (in bytes)
+download_chunk_size={download_chunk_size}
+
+# Jobs with a larger submission file (in MB) fail without being executed.
+# <=0 means no limit.
+max_submission_size={max_submission_size}
+
+# Limits for unpacking submission archives, as protection against archive
+# bombs. Jobs with a larger archive fail without being executed.
+# Validator packages from the teachers are not limited.
+# The unpacked size is given in MB. The compression ratio is the unpacked size
+# divided by the archive size. <=0 means no limit.
+max_unpacked_size={max_unpacked_size}
+max_archive_entries={max_archive_entries}
+max_compression_ratio={max_compression_ratio}
+
+# Base directory for the local caches of the executor
+cache_dir={cache_dir}
+
+# The host information sent to the server is cached for this number of
+# seconds, 0 disables the caching. The cache is also invalidated when
+# compilers and other inspected software are updated. Every probe
+# command is killed after the given timeout in seconds.
+hostinfo_ttl={hostinfo_ttl}
+hostinfo_timeout={hostinfo_timeout}
+
+# Metrics about fetched jobs, results, phase durations, polls and slot usage,
+# in the Prometheus text format. They are written to the given file after
+# every update, e.g. into the directory of the node exporter textfile collector.
+# The daemon can also serve them on the given port of localhost.
+# Leave the file empty and the port 0 to disable the metrics.
+metrics_file={metrics_file}
+metrics_port={metrics_port}
+
+# Test scripts can measure the performance of student programs with
+# Job.measure_program(). The measured programs are pinned to these CPUs,
+# given as comma-separated list of CPU numbers. Cores isolated from the
+# operating system scheduler (e.g. with the isolcpus kernel parameter)
+# give the most stable results. Leave it empty to disable the pinning.
+measure_cpus={measure_cpus}
+
+# Job results are stored here until they are delivered to the server.
+# Undelivered results are sent again when the executor runs the next time,
+# so this should be a directory that survives reboots.
+spool_dir={spool_dir}
+
+# Every job can get its own cgroup below this cgroup v2 directory, so that
+# the memory and process limits of the assignment apply to the job as a whole.
+# The directory must be writable for the executor account, e.g. by systemd
+# delegation, and have the memory and pids controllers enabled for its children.
+# Leave empty to apply these limits as rlimits per program.
+cgroup_dir={cgroup_dir}
+
+# Downloaded validators are cached locally, based on their checksum.
+# Size limit of this cache in MB, 0 disables the caching.
+validator_cache_size={validator_cache_size}
+
+# Unpacked validator packages are kept as templates for the working
+# directories of later jobs. Their files are cloned copy-on-write if
+# the file system supports it (e.g. btrfs, XFS), and copied otherwise.
+# Number of templates kept, 0 disables them.
+validator_templates={validator_templates}
+
+# Hard link the validator files into the working directories, if they
+# cannot be cloned. This saves time and space for large reference data.
+# The linked files are read-only, only enable this if test scripts and
+# student programs never modify the files from the validator package.
+validator_template_hardlinks={validator_template_hardlinks}
+
+# Results of compiler runs are cached locally, based on the compiler command
+# line, the compiler version and the files in the working directory.
+# Size limit of this cache in MB, 0 disables the caching.
+build_cache_size={build_cache_size}
+
+# Jobs without a timeout given by the server are not allowed to run longer
+# than this time. All programs started by the job are killed then.
 timeout={timeout}
 
 # Limit the size of result message to a number of bytes, because of database entry
 # size. <=0 means no limit, any positive value limits the message size
+# The captured console output of student programs is limited to this size too,
+# only the beginning and the end are kept.
 message_size={message_size}
 
 # Customize the compilation command to be executed
 compile_cmd={compile_cmd}
 
+# When running as daemon, the server is polled again after this number
+# of seconds if no job was available. Every further unsuccessful poll
+# doubles the delay, up to the given maximum.
+poll_interval={poll_interval}
+poll_interval_max={poll_interval_max}
+
 [Logging]
 
 # Logging format, as described in the Python logging module documentation
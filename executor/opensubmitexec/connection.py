@@ -0,0 +1,177 @@
+'''
+    HTTP connections to the OpenSubmit server.
+
+    If the requests library is installed, all requests of an executor
+    process share one pooled keep-alive session. Otherwise, or if pooling
+    is disabled in the configuration, every request opens a fresh
+    connection with urllib.
+
+    Both variants report problems with the same urllib exceptions.
+'''
+
+import os
+import socket
+import http.client
+
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+# The pooled session, re-created in forked slot processes
+_session = None
+_session_pid = None
+
+# Problems of urllib that are not reported as URLError
+URLLIB_ERRORS = (socket.timeout, ConnectionError, http.client.HTTPException)
+
+
+class UrllibResponse():
+    '''
+    Server response received with urllib.
+    '''
+    def __init__(self, response):
+        self._response = response
+        self.headers = response.info()
+
+    def read(self):
+        try:
+            return self._response.read()
+        except URLLIB_ERRORS as e:
+            raise URLError(str(e))
+
+    def iter_chunks(self, chunk_size):
+        try:
+            for chunk in iter(lambda: self._response.read(chunk_size), b''):
+                yield chunk
+        except URLLIB_ERRORS as e:
+            raise URLError(str(e))
+
+    def close(self):
+        self._response.close()
+
+
+class PooledResponse():
+    '''
+    Server response received with the pooled requests session.
+    '''
+    def __init__(self, response):
+        self._response = response
+        self.headers = response.headers
+
+    def read(self):
+        try:
+            return self._response.content
+        except requests.exceptions.RequestException as e:
+            raise URLError(str(e))
+
+    def iter_chunks(self, chunk_size):
+        try:
+            for chunk in self._response.iter_content(chunk_size):
+                yield chunk
+        except requests.exceptions.RequestException as e:
+            raise URLError(str(e))
+
+    def close(self):
+        # Gives the connection back to the pool
+        self._response.close()
+
+
+def pooling(config):
+    '''
+    Determine if the pooled session is used.
+    '''
+    return requests is not None and config.getboolean("Server", "pooling")
+
+
+def get_session(config):
+    '''
+    Returns the pooled session of this process.
+    '''
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        pool_size = config.getint("Server", "pool_size")
+        logger.debug("Creating HTTP session with pool size {0}".format(pool_size))
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _session_pid = os.getpid()
+    return _session
+
+
+def _pooled_request(config, url, data=None, timeout=None):
+    if timeout is None:
+        timeout = config.getint("Server", "http_timeout")
+    session = get_session(config)
+    try:
+        if data is None:
+            response = session.get(url, stream=True, timeout=timeout)
+        else:
+            response = session.post(url, data=data, timeout=timeout,
+                                    headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    except requests.exceptions.RequestException as e:
+        raise URLError(str(e))
+    if response.status_code >= 400:
+        response.close()
+        raise HTTPError(url, response.status_code, response.reason,
+                        response.headers, None)
+    return PooledResponse(response)
+
+
+def get(config, url, timeout=None):
+    '''
+    Perform a GET request. Without explicit timeout,
+    the configured one is used.
+
+    Returns a response object with 'headers', 'read()', 'iter_chunks()'
+    and 'close()'. Raises HTTPError or URLError on problems.
+    '''
+    if timeout is None:
+        timeout = config.getint("Server", "http_timeout")
+    if pooling(config):
+        return _pooled_request(config, url, timeout=timeout)
+    try:
+        return UrllibResponse(urlopen(url, timeout=timeout))
+    except URLLIB_ERRORS as e:
+        raise URLError(str(e))
+
+
+def post(config, url, post_data):
+    '''
+    Perform a POST request with the given list of form fields.
+
+    Raises HTTPError or URLError on problems.
+    '''
+    post_data = urlencode(post_data)
+    post_data = post_data.encode("utf-8", errors="ignore")
+    if pooling(config):
+        response = _pooled_request(config, url, post_data)
+    else:
+        timeout = config.getint("Server", "http_timeout")
+        try:
+            response = UrllibResponse(urlopen(Request(url, post_data), timeout=timeout))
+        except URLLIB_ERRORS as e:
+            raise URLError(str(e))
+    response.close()
+
+
+def download(config, url, fullpath):
+    '''
+    Perform a GET request and store the response body in the given file.
+    '''
+    response = get(config, url)
+    try:
+        with open(fullpath, 'wb') as target:
+            for chunk in response.iter_chunks(65536):
+                target.write(chunk)
+    finally:
+        response.close()
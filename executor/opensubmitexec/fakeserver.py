@@ -0,0 +1,322 @@
+'''
+    Stand-in for the OpenSubmit web server, for load tests of executors.
+
+    The fake server speaks the executor protocol of the '/jobs/' and
+    '/machines/' URLs, including batch leasing and long polling.
+    It hands out jobs for the test cases in a directory (see bench.py),
+    optionally with latency and errors injected, and records the
+    results sent back by the executors.
+
+    Every executor machine is asked for its configuration on its first
+    request, like with the real server. Jobs are never handed out twice,
+    results that are missing or were sent twice show up in the summary.
+'''
+
+import os
+import json
+import time
+import random
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, parse_qsl
+
+from .bench import find_cases, statistics
+from .cache import checksum
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+API_VERSION = '1.1.0'
+
+
+class FakeCase():
+    '''
+    Validator and submission file handed out as job.
+    '''
+    def __init__(self, name, validator, submission, weight=1):
+        self.name = name
+        self.validator = validator
+        self.submission = submission
+        self.weight = weight
+        self.validator_hash = checksum(validator)
+        self.submission_hash = checksum(submission)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as with the real server
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug("Fake server: " + format % args)
+
+    def _reply(self, status, body=b'', headers={}):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, str(value))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _disturb(self):
+        '''
+        Inject latency and errors. Returns True if the request failed.
+        '''
+        delay, fail = self.server.fake.disturbance()
+        time.sleep(delay)
+        if fail:
+            self._reply(503, b'Injected error')
+        return fail
+
+    def do_GET(self):
+        if self._disturb():
+            return
+        fake = self.server.fake
+        url = urlparse(self.path)
+        query = dict([(key, values[0]) for key, values in parse_qs(url.query).items()])
+        if url.path.startswith('/download/'):
+            # /download/<case>/<validator|submission>/
+            parts = url.path.strip('/').split('/')
+            case = fake.cases[int(parts[1])]
+            fname = case.validator if parts[2] == 'validator' else case.submission
+            with open(fname, 'rb') as f:
+                self._reply(200, f.read(), {'Content-Type': 'application/binary'})
+            return
+        if url.path != '/jobs/':
+            self._reply(404)
+            return
+        if query.get('Secret') != fake.secret:
+            self._reply(403)
+            return
+        if fake.register(query['UUID']):
+            self._reply(200, headers={'Action': 'get_config',
+                                      'APIVersion': API_VERSION,
+                                      'MachineId': query['UUID']})
+            return
+        count = int(query.get('Jobs', 1))
+        jobs = fake.lease(count, min(int(query.get('Wait', 0)), fake.max_wait))
+        if not jobs:
+            self._reply(404)
+            return
+        if 'Jobs' in query:
+            manifest = []
+            for index, desc in jobs:
+                desc['SubmissionUrl'] = fake.url + '/download/{0}/submission/'.format(index)
+                manifest.append(desc)
+            self._reply(200, json.dumps({'Jobs': manifest}).encode('utf-8'),
+                        {'Content-Type': 'application/json', 'APIVersion': API_VERSION})
+        else:
+            index, desc = jobs[0]
+            with open(fake.cases[index].submission, 'rb') as f:
+                body = f.read()
+            headers = dict(desc)
+            headers['APIVersion'] = API_VERSION
+            headers['Content-Type'] = 'application/binary'
+            self._reply(200, body, headers)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        fields = dict(parse_qsl(self.rfile.read(length).decode('utf-8')))
+        if self._disturb():
+            return
+        fake = self.server.fake
+        if fields.get('Secret') != fake.secret:
+            self._reply(403)
+            return
+        path = urlparse(self.path).path
+        if path == '/machines/' or fields.get('Action') == 'get_config':
+            fake.register(fields['UUID'], fields.get('Config'))
+            self._reply(201)
+        elif path == '/jobs/':
+            fake.record(fields)
+            self._reply(201)
+        else:
+            self._reply(404)
+
+
+class FakeJobServer():
+    '''
+    The fake server, running in a background thread with start() and stop().
+
+    cases:      List of (name, validator path, submission path) tuples, see bench.py
+    weights:    Optional dictionary of case name to relative frequency
+    jobs:       Number of jobs to hand out, None for no limit
+    latency:    Mean of the random delay for every request, in seconds
+    error_rate: Fraction of requests answered with a HTTP 503 error
+    results:    Optional file name, results are appended as JSON lines
+    '''
+    secret = '49846zut93purfh977TTTiuhgalkjfnk89'
+    timeout = 3600
+    max_wait = 30
+    url = None
+
+    def __init__(self, cases, weights={}, jobs=None, latency=0, error_rate=0,
+                 results=None, seed=None):
+        self.cases = [FakeCase(name, validator, submission, weights.get(name, 1))
+                      for name, validator, submission in cases]
+        self.remaining = jobs
+        self.latency = latency
+        self.error_rate = error_rate
+        self.results_file = results
+        self.results = []
+        self.machines = {}
+        self.delivered = {}
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Condition()
+        self._next_id = 1
+        self._server = None
+
+    def disturbance(self):
+        '''
+        Returns the delay and the failure decision for the next request.
+        '''
+        with self._lock:
+            delay = self._random.uniform(0, 2 * self.latency) if self.latency else 0
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return delay, fail
+
+    def register(self, uuid, config=None):
+        '''
+        Remember the executor machine.
+
+        Returns True if the machine was unknown so far.
+        '''
+        with self._lock:
+            known = uuid in self.machines
+            if config or not known:
+                self.machines[uuid] = config
+            return not known
+
+    def _job(self):
+        index = self._weighted_choice()
+        case = self.cases[index]
+        file_id = self._next_id
+        self._next_id += 1
+        desc = {'SubmissionFileChecksum': case.submission_hash,
+                'SubmissionFileId': str(file_id),
+                'SubmissionOriginalFilename': os.path.basename(case.submission),
+                'SubmissionId': str(file_id),
+                'SubmitterName': 'Student {0}'.format(file_id),
+                'SubmitterStudentId': str(file_id),
+                'AuthorNames': 'Student {0}'.format(file_id),
+                'SubmitterStudyProgram': 'Computer Science',
+                'Course': 'Load test',
+                'Assignment': case.name,
+                'Timeout': self.timeout,
+                'Action': 'test_validity',
+                'PostRunValidation': self.url + '/download/{0}/validator/'.format(index),
+                'ValidatorHash': case.validator_hash}
+        self.delivered[desc['SubmissionFileId']] = time.time()
+        return index, desc
+
+    def _weighted_choice(self):
+        # No random.choices() before Python 3.6
+        point = self._random.uniform(0, sum([case.weight for case in self.cases]))
+        for index, case in enumerate(self.cases):
+            point -= case.weight
+            if point <= 0:
+                return index
+        return len(self.cases) - 1
+
+    def lease(self, count, wait=0):
+        '''
+        Hand out up to 'count' jobs. Without jobs left, the request
+        is held for 'wait' seconds, like with long polling.
+
+        Returns a list of (case index, job description) tuples.
+        '''
+        with self._lock:
+            if self.remaining is not None:
+                count = min(count, self.remaining)
+                self.remaining -= count
+            if count == 0:
+                # No new jobs will come, only stop() wakes up
+                self._lock.wait(wait)
+                return []
+            return [self._job() for index in range(count)]
+
+    def record(self, fields):
+        '''
+        Store a result sent by an executor.
+        '''
+        fields = dict(fields)
+        fields.pop('Secret', None)
+        fields['Received'] = time.time()
+        with self._lock:
+            delivered = self.delivered.get(fields.get('SubmissionFileId'))
+            if delivered:
+                fields['Latency'] = fields['Received'] - delivered
+            self.results.append(fields)
+            if self.results_file:
+                with open(self.results_file, 'a') as f:
+                    f.write(json.dumps(fields) + '\n')
+            self._lock.notify_all()
+
+    def wait_for_results(self, count, timeout=None):
+        '''
+        Wait until the given number of results was received.
+        '''
+        deadline = time.time() + timeout if timeout else None
+        with self._lock:
+            while len(self.results) < count:
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+    def summary(self):
+        '''
+        Returns statistics about handed out jobs and received results.
+        '''
+        with self._lock:
+            received = [result['SubmissionFileId'] for result in self.results]
+            latencies = [result['Latency'] for result in self.results if 'Latency' in result]
+            outcomes = {}
+            for result in self.results:
+                key = 'passed' if result.get('ErrorCode') == '0' else 'failed'
+                outcomes[key] = outcomes.get(key, 0) + 1
+            return {'machines': len(self.machines),
+                    'jobs': len(self.delivered),
+                    'results': len(self.results),
+                    'outcomes': outcomes,
+                    'missing': len(set(self.delivered) - set(received)),
+                    'duplicates': len(received) - len(set(received)),
+                    'injected_errors': self.errors,
+                    'latency': statistics(latencies) if latencies else None}
+
+    def start(self, port=0, address='127.0.0.1'):
+        '''
+        Serve in a background thread. Returns the server URL.
+        '''
+        self._server = ThreadingHTTPServer((address, port), FakeRequestHandler)
+        self._server.fake = self
+        self.url = 'http://{0}:{1}'.format(address, self._server.server_address[1])
+        thread = threading.Thread(target=self._server.serve_forever, name='fakeserver')
+        thread.daemon = True
+        thread.start()
+        logger.info("Fake job server running at " + self.url)
+        return self.url
+
+    def stop(self):
+        with self._lock:
+            self._lock.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def create_fake_server(directory, **kwargs):
+    '''
+    Create a fake server for the test cases in the given directory.
+    '''
+    cases = find_cases(directory)
+    if not cases:
+        raise ValueError("No test cases found in " + directory)
+    return FakeJobServer(cases, **kwargs)
@@ -7,20 +7,193 @@ import tarfile
 import os
 import tempfile
 import shutil
+import time
+import fcntl
 
 from .exceptions import JobException
+from .metrics import timed
 
 import logging
 logger = logging.getLogger('opensubmitexec')
 
 
-def unpack_if_needed(destination_path, fpath):
+def _common_prefix(first, second):
+    '''
+    Returns the common beginning of two path component lists,
+    with None standing for no list.
+    '''
+    if first is None:
+        return second
+    if second is None:
+        return first
+    length = 0
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        length += 1
+    return first[:length]
+
+
+class ArchiveExtractor():
+    '''
+    Single-pass extraction of ZIP and TAR archives.
+
+    Every member is checked for a safe path before it is written.
+    The limits for the number of entries, the total unpacked size
+    and the compression ratio are checked while the data is copied,
+    so that the announced sizes in the archive do not matter.
+    Limits <= 0 are not checked.
+
+    The deepest directory that contains all archive members is
+    determined on the fly.
+    '''
+    max_entries = 0
+    max_size = 0        # bytes
+    max_ratio = 0
+
+    def __init__(self, destination_path, fpath, config=None):
+        self.destination = os.path.realpath(destination_path)
+        self.fpath = fpath
+        if config:
+            self.max_entries = config.getint("Execution", "max_archive_entries")
+            self.max_size = config.getint("Execution", "max_unpacked_size") * 1024 * 1024
+            self.max_ratio = config.getint("Execution", "max_compression_ratio")
+        self.archive_size = max(os.path.getsize(fpath), 1)
+        self.entries = 0
+        self.size = 0
+        # Common directory of all files, and all directory entries
+        self._common = None
+        self._directories = []
+
+    def _fail(self, info_tutor):
+        logger.error(info_tutor)
+        raise JobException(info_student="Your archive could not be unpacked: " + info_tutor,
+                           info_tutor=info_tutor)
+
+    def _path(self, name):
+        '''
+        Check an archive path and return the target path and the path components.
+        '''
+        parts = [part for part in name.split('/') if part not in ('', '.')]
+        if name.startswith('/') or '..' in parts:
+            self._fail("The archive entry '{0}' points outside of the archive.".format(name))
+        if not parts:
+            return None, parts
+        target = os.path.join(self.destination, *parts)
+        # Symbolic links from earlier entries may redirect the path
+        if not self._is_inside(os.path.dirname(target)):
+            self._fail("The archive entry '{0}' points outside of the archive.".format(name))
+        return target, parts
+
+    def _member(self, name, is_dir):
+        '''
+        Account for a new archive member and return its target path.
+        '''
+        self.entries += 1
+        if self.max_entries > 0 and self.entries > self.max_entries:
+            self._fail("The archive has more than {0} entries.".format(self.max_entries))
+        target, parts = self._path(name)
+        if is_dir:
+            self._directories.append(parts)
+        else:
+            self._common = _common_prefix(self._common, parts[:-1])
+        return target
+
+    def _is_inside(self, path):
+        path = os.path.realpath(path)
+        return path == self.destination or path.startswith(self.destination + os.sep)
+
+    def _copy(self, source, target):
+        with open(target, 'wb') as f:
+            for chunk in iter(lambda: source.read(65536), b''):
+                self.size += len(chunk)
+                if self.max_size > 0 and self.size > self.max_size:
+                    self._fail("The unpacked archive is larger than {0} MB.".format(
+                        self.max_size // (1024 * 1024)))
+                if self.max_ratio > 0 and self.size > self.max_ratio * self.archive_size:
+                    self._fail("The archive has a compression ratio of more than {0}.".format(
+                        self.max_ratio))
+                f.write(chunk)
+
+    def single_dir(self):
+        '''
+        Returns the directory containing all archive members, or None.
+        '''
+        common = self._common
+        for directory in self._directories:
+            if common is None:
+                common = directory
+            elif directory[:len(common)] == common or common[:len(directory)] == directory:
+                # Sub-directories and parent directories are fine
+                continue
+            else:
+                common = _common_prefix(common, directory)
+        if common:
+            return '/'.join(common)
+        return None
+
+    def extract_zip(self):
+        with zipfile.ZipFile(self.fpath, "r") as archive:
+            for info in archive.infolist():
+                is_dir = info.filename.endswith('/')
+                target = self._member(info.filename, is_dir)
+                if not target:
+                    continue
+                if is_dir:
+                    os.makedirs(target, exist_ok=True)
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with archive.open(info) as source:
+                        self._copy(source, target)
+
+    def extract_tar(self):
+        # Stream mode, the archive is read only once
+        with tarfile.open(self.fpath, "r|*") as archive:
+            for member in archive:
+                if not (member.isdir() or member.isfile() or member.issym() or member.islnk()):
+                    logger.warning("Skipping special file '{0}' in archive.".format(member.name))
+                    continue
+                target = self._member(member.name, member.isdir())
+                if not target:
+                    continue
+                if member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if os.path.islink(target) or (member.issym() and os.path.isfile(target)):
+                    # Replaced by a later member with the same name
+                    os.remove(target)
+                if member.issym():
+                    link = os.path.join(os.path.dirname(target), member.linkname)
+                    if not self._is_inside(link):
+                        self._fail("The archive link '{0}' points outside of the archive.".format(member.name))
+                    os.symlink(member.linkname, target)
+                    continue
+                if member.islnk():
+                    link, parts = self._path(member.linkname)
+                    if not link or not self._is_inside(link) or not os.path.isfile(link):
+                        self._fail("The archive link '{0}' points outside of the archive.".format(member.name))
+                    shutil.copyfile(link, target)
+                else:
+                    self._copy(archive.extractfile(member), target)
+                os.chmod(target, (member.mode & 0o777) | 0o600)
+                os.utime(target, (member.mtime, member.mtime))
+
+    def report(self, seconds):
+        logger.info("Unpacked {0} entries with {1} bytes from {2} in {3:.2f} seconds ({4:.1f} MB/s).".format(
+            self.entries, self.size, self.fpath, seconds,
+            self.size / (1024 * 1024) / max(seconds, 0.000001)))
+
+
+def unpack_if_needed(destination_path, fpath, config=None):
     '''
     fpath is the fully qualified path to a single file that
     might be a ZIP / TGZ archive.
 
     The function moves the file, or the content if it is an
     archive, to the directory given by destination_path.
+    Archives are checked against the limits from the given
+    configuration, a JobException is raised if they are exceeded.
 
     The function returns two values. The first one is a 
     directory name if:
@@ -46,84 +219,28 @@ def unpack_if_needed(destination_path, fpath):
                  (destination_path, str(dircontent)))
 
     # Perform un-archiving, in case
+    extractor = ArchiveExtractor(destination_path, fpath, config)
+    started = time.time()
     if zipfile.is_zipfile(fpath):
         logger.debug("Detected ZIP file at %s, unpacking it." % (fpath))
         did_unpack = True
-        with zipfile.ZipFile(fpath, "r") as zip:
-            infolist = zip.infolist()
-            directories = [
-                entry.filename for entry in infolist if entry.filename.endswith('/')]
-            logger.debug("List of directory entries: " + str(directories))
-
-            # Consider this case: ['subdir1/', 'subdir1/subdir2/']
-            if len(directories) > 1:
-                redundant = []
-                for current in directories:
-                    starts_with_this = [
-                        el for el in directories if el.startswith(current)]
-                    if len(starts_with_this) == len(directories):
-                        # current is a partial directory name that is contained
-                        # in all others
-                        redundant.append(current)
-                logger.debug("Redundant directory entries: " + str(redundant))
-                directories = [
-                    entry for entry in directories if entry not in redundant]
-                logger.debug(
-                    "Updated list of directory entries: " + str(directories))
-
-            files = [
-                entry.filename for entry in infolist if not entry.filename.endswith('/')]
-            logger.debug("List of files: " + str(files))
-            if len(directories) == 1:
-                d = directories[0]
-                in_this_dir = [entry for entry in files if entry.startswith(d)]
-                if len(files) == len(in_this_dir):
-                    logger.debug("ZIP archive contains only one subdirectory")
-                    single_dir = d
-            zip.extractall(destination_path)
+        extractor.extract_zip()
     elif tarfile.is_tarfile(fpath):
         logger.debug("Detected TAR file at %s, unpacking it." % (fpath))
         did_unpack = True
-        with tarfile.open(fpath) as tar:
-            infolist = tar.getmembers()
-            # A TGZ file of one subdirectory with arbitrary files
-            # has one infolist entry per directory and file
-            directories = [entry.name for entry in infolist if entry.isdir()]
-            files = [entry.name for entry in infolist if entry.isfile()]
-            logger.debug(directories)
-            logger.debug(files)
-            if len(directories) == 1:
-                d = directories[0]
-                in_this_dir = [entry for entry in files if entry.startswith(d)]
-                if len(files) == len(in_this_dir):
-                    logger.debug("TGZ archive contains only one subdirectory")
-                    single_dir = d
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(tar, destination_path)
+        extractor.extract_tar()
     else:
         if not fpath.startswith(destination_path):
             logger.debug(
                 "File at %s is a single non-archive file, copying it to %s" % (fpath, destination_path))
             shutil.copy(fpath, destination_path)
 
+    if did_unpack:
+        extractor.report(time.time() - started)
+        single_dir = extractor.single_dir()
+        if single_dir:
+            logger.debug("Archive contains only the subdirectory " + single_dir)
+
     dircontent = os.listdir(destination_path)
     logger.debug("Content of %s after unarchiving: %s" %
                  (destination_path, str(dircontent)))
@@ -170,6 +287,11 @@ def prepare_working_directory(job, submission_path, validator_path):
     If unrecoverable errors happen, such as an empty student archive,
     a JobException is raised.
     '''
+    with timed(job._config, 'unpack'):
+        _prepare_working_directory(job, submission_path, validator_path)
+
+
+def _prepare_working_directory(job, submission_path, validator_path):
     # Safeguard for fail-fast in disk full scenarios on the executor
 
     dusage = shutil.disk_usage(job.working_dir)
@@ -183,7 +305,8 @@ def prepare_working_directory(job, submission_path, validator_path):
     validator_fname = os.path.basename(validator_path)
 
     # Un-archive student submission
-    single_dir, did_unpack = unpack_if_needed(job.working_dir, submission_path)
+    with job._phase('unpack submission'):
+        single_dir, did_unpack = unpack_if_needed(job.working_dir, submission_path, job._config)
     job.student_files = os.listdir(job.working_dir)
     if did_unpack:
         job.student_files.remove(submission_fname)
@@ -217,14 +340,34 @@ def prepare_working_directory(job, submission_path, validator_path):
     logger.debug("Student files: {0}".format(job.student_files))
 
     # Unpack validator package
-    single_dir, did_unpack = unpack_if_needed(job.working_dir, validator_path)
+    with job._phase('unpack validator'):
+        template = validator_template(job, validator_path)
+        if template:
+            try:
+                populate_from_template(job._config, template, job.working_dir)
+                return
+            except FileNotFoundError:
+                logger.warning("Validator template {0} was removed meanwhile.".format(template))
+        unpack_validator(job, job.working_dir, validator_path)
+
+
+def unpack_validator(job, directory, validator_path):
+    '''
+    Unpack the validator package into the given directory, and make
+    sure that the validator script has the expected name.
+
+    The archive limits are meant for student submissions, validator
+    packages from the teachers may contain large reference data.
+    '''
+    single_dir, did_unpack = unpack_if_needed(directory, validator_path)
     if single_dir:
         info_student = "Internal error with the validator. Please contact your course responsible."
         info_tutor = "Error: Directories are not allowed in the validator archive."
         logger.error(info_tutor)
         raise JobException(info_student=info_student, info_tutor=info_tutor)
 
-    if not os.path.exists(job.validator_script_name):
+    script_name = os.path.join(directory, job._validator_import_name + '.py')
+    if not os.path.exists(script_name):
         if did_unpack:
             # The download was an archive, but the validator was not inside.
             # This is a failure of the tutor.
@@ -235,9 +378,132 @@ def prepare_working_directory(job, submission_path, validator_path):
                                info_tutor=info_tutor)
         else:
             # The download is already the script, but has the wrong name
+            validator_path = os.path.join(directory, os.path.basename(validator_path))
             logger.warning("Renaming {0} to {1}.".format(
-                validator_path, job.validator_script_name))
-            shutil.move(validator_path, job.validator_script_name)
+                validator_path, script_name))
+            shutil.move(validator_path, script_name)
+
+
+def validator_template(job, validator_path):
+    '''
+    Returns the directory with the unpacked validator package of this job,
+    shared by all jobs with the same validator. The directory is created
+    if needed.
+
+    Returns None if templates are disabled or the validator checksum is unknown.
+    '''
+    count = job._config.getint("Execution", "validator_templates")
+    if count <= 0 or not job.validator_hash:
+        return None
+    base = os.path.join(job._config.get("Execution", "cache_dir"), 'templates')
+    template = os.path.join(base, job.validator_hash)
+    if os.path.isdir(template):
+        os.utime(template)
+        return template
+    os.makedirs(base, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp', dir=base)
+    try:
+        unpack_validator(job, tmp_dir, validator_path)
+        if job._config.getboolean("Execution", "validator_template_hardlinks"):
+            # Hard linked files must not be changed by the jobs
+            for root, dirs, files in os.walk(tmp_dir):
+                for fname in files:
+                    path = os.path.join(root, fname)
+                    os.chmod(path, os.stat(path).st_mode & ~0o222)
+        # Parallel jobs may create the same template
+        os.rename(tmp_dir, template)
+        logger.debug("Created validator template " + template)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isdir(template):
+            raise
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    _evict_templates(base, count)
+    return template
+
+
+def _evict_templates(base, count):
+    '''
+    Remove the least recently used templates beyond the given number.
+    '''
+    templates = []
+    for name in os.listdir(base):
+        if not name.startswith('.tmp'):
+            try:
+                templates.append((os.stat(os.path.join(base, name)).st_mtime, name))
+            except FileNotFoundError:
+                pass
+    for mtime, name in sorted(templates)[:-count]:
+        logger.debug("Removing validator template " + name)
+        # Jobs copying from it fall back to unpacking the validator
+        trash = tempfile.mkdtemp(prefix='.tmp', dir=base)
+        try:
+            os.rename(os.path.join(base, name), os.path.join(trash, name))
+        except OSError:
+            pass
+        shutil.rmtree(trash, ignore_errors=True)
+
+
+# Linux ioctl for copy-on-write file clones
+FICLONE = 0x40049409
+
+
+def _reflink(source, target):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _make_private(source, target):
+    # The template may be read-only because of hard links
+    os.chmod(target, os.stat(source).st_mode | 0o200)
+
+
+def populate_from_template(config, template, directory):
+    '''
+    Put the files of a validator template into the working directory,
+    replacing student files with the same name.
+
+    Files are cloned copy-on-write if the file system supports it,
+    hard linked if configured, and copied otherwise. Clones and copies
+    are private to the job.
+    '''
+    hardlinks = config.getboolean("Execution", "validator_template_hardlinks")
+    use_reflink = True
+    counts = {'reflink': 0, 'hardlink': 0, 'copy': 0}
+    started = time.time()
+    for root, dirs, files in os.walk(template):
+        target_root = os.path.join(directory, os.path.relpath(root, template))
+        os.makedirs(target_root, exist_ok=True)
+        for fname in files:
+            source = os.path.join(root, fname)
+            target = os.path.join(target_root, fname)
+            if os.path.lexists(target):
+                os.remove(target)
+            if use_reflink:
+                try:
+                    _reflink(source, target)
+                    _make_private(source, target)
+                    counts['reflink'] += 1
+                    continue
+                except OSError:
+                    # Not supported by this file system, don't try again
+                    use_reflink = False
+                    if os.path.lexists(target):
+                        os.remove(target)
+            if hardlinks:
+                try:
+                    os.link(source, target)
+                    counts['hardlink'] += 1
+                    continue
+                except OSError:
+                    hardlinks = False
+            shutil.copyfile(source, target)
+            _make_private(source, target)
+            counts['copy'] += 1
+    logger.debug("Populated {0} from validator template in {1:.3f} seconds ({2} reflinks, {3} hard links, {4} copies).".format(
+        directory, time.time() - started, counts['reflink'], counts['hardlink'], counts['copy']))
 
 
 def has_file(dir, fname):
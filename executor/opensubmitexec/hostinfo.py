@@ -2,17 +2,49 @@
     Functions to retrieve host information.
 '''
 
+# The os() function below shadows the module name
+import os as _os
+import json
+import time
+import shlex
+import signal
+import shutil
 import platform
-from subprocess import getoutput
+import threading
+from functools import partial
+from subprocess import Popen, PIPE, STDOUT, DEVNULL, TimeoutExpired
 
-# def from_cmd(cmd, stdhndl=" 2>&1", e_shell=True):
+import logging
+logger = logging.getLogger('opensubmitexec')
 
+# Seconds per probe if no configuration is given
+PROBE_TIMEOUT = 10
 
-def from_cmd(cmd):
+
+def from_cmd(cmd, timeout=None):
     '''
     Determine some system information based on a shell command.
+
+    The command and its child processes are killed after the
+    timeout (in seconds), with an empty result.
     '''
-    return getoutput(cmd)
+    proc = Popen(cmd, shell=True, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT,
+                 start_new_session=True)
+    try:
+        output = proc.communicate(timeout=timeout)[0]
+    except TimeoutExpired:
+        logger.warning("Killing '{0}' after {1} seconds.".format(cmd, timeout))
+        if hasattr(_os, 'killpg'):
+            _os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+        proc.communicate()
+        return ""
+    output = output.decode(errors='replace')
+    # Same result as with subprocess.getoutput()
+    if output.endswith('\n'):
+        output = output[:-1]
+    return output
 
 
 def ipaddress():
@@ -70,30 +102,162 @@ def cpu():
         return platform.processor()
 
 
-def compiler():
+def compiler(timeout=None):
     if platform.system() == "Windows":
-        conf = from_cmd("cl.exe|@echo off", "")  # force returncode 0
+        conf = from_cmd("cl.exe|@echo off", timeout)  # force returncode 0
         conf = conf.split("\n")[0]  # extract version info
     else:
-        conf = from_cmd("cc -v")
+        conf = from_cmd("cc -v", timeout)
     return conf
 
 
-def all_host_infos():
+# Version information per compiler program, determined once per process
+_compiler_versions = {}
+
+
+def compiler_version(program):
     '''
-        Summarize all host information.
+    Determine path and version information of the given compiler program.
+    '''
+    if program not in _compiler_versions:
+        path = shutil.which(program) or program
+        _compiler_versions[program] = path + "\n" + from_cmd(shlex.quote(path) + " --version")
+    return _compiler_versions[program]
+
+
+def _probes(timeout):
     '''
+    Returns the host information probes, as title, function, and the
+    programs or directories whose modification invalidates the result.
+    '''
+    return [
+        ("Operating system", os, []),
+        ("CPUID information", cpu, []),
+        ("CC information", partial(compiler, timeout), ['cc']),
+        ("JDK information", partial(from_cmd, "java -version", timeout), ['java']),
+        ("MPI information", partial(from_cmd, "mpirun -version", timeout), ['mpirun']),
+        ("Scala information", partial(from_cmd, "scala -version", timeout), ['scala']),
+        ("OpenCL headers", partial(from_cmd, "find /usr/include|grep opencl.h", timeout), ['/usr/include']),
+        ("OpenCL libraries", partial(from_cmd, "find /usr/lib/ -iname '*opencl*'", timeout), ['/usr/lib']),
+        ("NVidia SMI", partial(from_cmd, "nvidia-smi -q", timeout), ['nvidia-smi']),
+        ("OpenCL Details", opencl, [])
+    ]
+
+
+def _stamps(probes):
+    '''
+    Modification times of the programs and directories the probes depend on.
+    '''
+    stamps = {}
+    for title, probe, dependencies in probes:
+        for name in dependencies:
+            path = name if _os.path.isabs(name) else shutil.which(name)
+            try:
+                stamps[name] = _os.stat(path).st_mtime
+            except (TypeError, OSError):
+                # Not installed
+                stamps[name] = None
+    return stamps
+
+
+def _run_probe(title, probe):
+    start = time.time()
+    try:
+        result = probe()
+    except Exception as e:
+        logger.warning("Could not determine {0}: {1}".format(title, str(e)))
+        result = ""
+    logger.debug("Determining {0} took {1:.2f} seconds.".format(title, time.time() - start))
+    return result
+
+
+def _store_probe(results, title, probe):
+    results[title] = _run_probe(title, probe)
+
+
+def _run_probes(probes, timeout):
+    '''
+    Run all probes in parallel. Probes that do not finish
+    in time, even without a shell command, give an empty result.
+
+    The probes run in daemon threads, so that hanging ones
+    do not keep the executor from exiting.
+    '''
+    start = time.time()
+    results = {}
+    threads = []
+    for title, probe, dependencies in probes:
+        thread = threading.Thread(target=_store_probe, args=(results, title, probe),
+                                  name="hostinfo " + title)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    deadline = start + timeout + 1
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
     output = []
-    output.append(["Operating system", os()])
-    output.append(["CPUID information", cpu()])
-    output.append(["CC information", compiler()])
-    output.append(["JDK information", from_cmd("java -version")])
-    output.append(["MPI information", from_cmd("mpirun -version")])
-    output.append(["Scala information", from_cmd("scala -version")])
-    output.append(["OpenCL headers", from_cmd(
-        "find /usr/include|grep opencl.h")])
-    output.append(["OpenCL libraries", from_cmd(
-        "find /usr/lib/ -iname '*opencl*'")])
-    output.append(["NVidia SMI", from_cmd("nvidia-smi -q")])
-    output.append(["OpenCL Details", opencl()])
+    for title, probe, dependencies in probes:
+        if title in results:
+            output.append([title, results[title]])
+        else:
+            logger.warning("Determining {0} took too long, skipping it.".format(title))
+            output.append([title, ""])
+    logger.debug("Host information determined in {0:.2f} seconds.".format(time.time() - start))
     return output
+
+
+def _cache_file(config):
+    directory = config.get("Execution", "cache_dir")
+    _os.makedirs(directory, exist_ok=True)
+    return _os.path.join(directory, 'hostinfo.json')
+
+
+def _read_cache(fname, ttl, stamps):
+    '''
+    Returns the cached host information, or None if it is outdated.
+    '''
+    try:
+        with open(fname) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cached['created'] > ttl:
+        logger.debug("Cached host information is expired.")
+        return None
+    if cached['stamps'] != stamps:
+        logger.debug("Installed software changed since the host information was cached.")
+        return None
+    return cached['infos']
+
+
+def _write_cache(fname, stamps, infos):
+    tmp_fname = "{0}.{1}.tmp".format(fname, _os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump({'created': time.time(), 'stamps': stamps, 'infos': infos}, f)
+    _os.replace(tmp_fname, fname)
+
+
+def all_host_infos(config=None):
+    '''
+        Summarize all host information.
+
+        With a configuration, the probe timeout is taken from there,
+        and the result is cached on disk for the configured time.
+    '''
+    if not config:
+        probes = _probes(PROBE_TIMEOUT)
+        return _run_probes(probes, PROBE_TIMEOUT)
+    timeout = config.getint("Execution", "hostinfo_timeout")
+    ttl = config.getint("Execution", "hostinfo_ttl")
+    probes = _probes(timeout)
+    if ttl <= 0:
+        return _run_probes(probes, timeout)
+    fname = _cache_file(config)
+    stamps = _stamps(probes)
+    infos = _read_cache(fname, ttl, stamps)
+    if infos:
+        logger.debug("Using cached host information from " + fname)
+        return infos
+    infos = _run_probes(probes, timeout)
+    _write_cache(fname, stamps, infos)
+    return infos
@@ -1,17 +1,51 @@
 import os.path
 import sys
+import json
+import time
+import signal
+import statistics
 import importlib
+import importlib.util
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from .config import read_config
 from .exceptions import *
-from .server import send_post
+from .spool import send_result
+from .server import supports_retry
 from .filesystem import remove_working_directory
+from .locking import SlotLock
+from .limits import JobProcesses, preempt_jobs, kill_jobs_of
+from .cache import build_cache
+from .compiler import snapshot, build_key, store_build, restore_build
+from .running import RunningProgram
+from . import metrics
 
 import logging
 logger = logging.getLogger('opensubmitexec')
 
 UNSPECIFIC_ERROR = -9999
 
+# Test script modules imported by this executor process, by validator checksum
+_validator_modules = OrderedDict()
+VALIDATOR_MODULE_CACHE = 20
+# Checksums of the test scripts that were imported in a forked child before
+_importable_validators = set()
+# Seconds a forked test script may run beyond the job timeout
+VALIDATOR_GRACE = 30
+
+
+def summarize(values):
+    '''
+    Returns median, mean, standard deviation, minimum and maximum of the values.
+    '''
+    return {'median': round(statistics.median(values), 6),
+            'mean': round(statistics.mean(values), 6),
+            'stddev': round(statistics.stdev(values), 6) if len(values) > 1 else 0.0,
+            'min': min(values),
+            'max': max(values)}
+
 
 class InternalJob():
     """Internal base class for jobs,
@@ -23,10 +57,40 @@ class InternalJob():
     _online = None
     # Action requested by the server (legacy)
     action = None
+    # Executor API version of the server that sent the job
+    api_version = None
+    # Coordination with parallel jobs on this machine
+    _slot_lock = None
 
     submission_url = None
+    file_name = None
+    # Student files in the working directory, after unpacking
+    student_files = None
     validator_url = None
+    validator_hash = None
     result_sent = False
+    # Error code of the sent result
+    error_code = None
+    # Resource usage of the programs run for this job
+    _perf_records = None
+    # Summaries of the performance measurements in this job
+    _measurements = None
+    # Start time of the job, and its phases so far
+    _started = None
+    _timeline = None
+    # Resource limits for the programs of this job, as given by the server
+    limit_cpu_time = None
+    limit_memory = None
+    limit_processes = None
+    limit_file_size = None
+    # The programs started for this job
+    _processes = None
+    _timed_out = False
+    _child_killed = False
+    _validator_imported = False
+    # Build cache statistics
+    _build_hits = 0
+    _build_misses = 0
 
     # The base name of the validation / full test script
     # on disk, for importing.
@@ -38,6 +102,10 @@ class InternalJob():
         else:
             self._config = read_config()
         self._online = online
+        self._perf_records = []
+        self._measurements = []
+        self._started = time.time()
+        self._timeline = []
 
     def __str__(self):
         '''
@@ -47,23 +115,222 @@ class InternalJob():
 
     def _run_validate(self):
         '''
-        Execute the validate() method in the test script belonging to this job.
+        Execute the validate() method in the test script belonging to this job,
+        while holding a slot on this machine.
+
+        If configured, the test script runs in a forked child process,
+        so that a crashing test script cannot harm the executor.
         '''
-        assert(os.path.exists(self.validator_script_name))
+        with SlotLock(self._config) as self._slot_lock, \
+                metrics.slot_busy(self._config), metrics.timed(self._config, 'validate'):
+            if self._config.getboolean("Execution", "fork_validators") and hasattr(os, 'fork'):
+                self._run_forked()
+            else:
+                self._run_watched()
+        self._slot_lock = None
+
+    def _timeout(self):
+        if self.timeout:
+            return self.timeout
+        else:
+            return self._config.getint("Execution", "timeout")
+
+    def _run_watched(self, module=None):
+        '''
+        Execute the test script. All programs of the job are killed
+        when the job timeout is over, and when the validator is finished.
+        '''
+        timeout = self._timeout()
+        watchdog = threading.Timer(timeout, self._kill_programs, [timeout])
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            self._run_validator(module)
+        finally:
+            watchdog.cancel()
+            if self._processes:
+                self._processes.close()
+                self._processes = None
+            if self._build_hits or self._build_misses:
+                logger.info("Build cache: {0} hit(s), {1} miss(es) for this job.".format(
+                    self._build_hits, self._build_misses))
+
+    def _load_validator(self):
+        '''
+        Returns the test script module, imported only once per
+        validator checksum in this executor process.
+
+        Returns None if the checksum is unknown, or if the test script
+        was not imported successfully in a forked child yet. Its module
+        level code may hang or end the process, the child runs it under
+        the job timeout.
+        '''
+        if self.validator_hash not in _importable_validators:
+            return None
+        if self.validator_hash in _validator_modules:
+            _validator_modules.move_to_end(self.validator_hash)
+            return _validator_modules[self.validator_hash]
         old_path = sys.path
         sys.path = [self.working_dir] + old_path
-        # logger.debug('Python search path is now {0}.'.format(sys.path))
+        try:
+            spec = importlib.util.spec_from_file_location(
+                self._validator_import_name, self.validator_script_name)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            sys.path = old_path
+        _validator_modules[self.validator_hash] = module
+        if len(_validator_modules) > VALIDATOR_MODULE_CACHE:
+            _validator_modules.popitem(last=False)
+        return module
 
+    def _run_forked(self):
+        '''
+        Execute the test script in a forked child process.
+
+        Once the test script module was imported successfully in a child,
+        it is imported in this process before, so that all later jobs with
+        the same validator get it for free.
+        '''
         try:
-            module = importlib.import_module(self._validator_import_name)
-        except Exception as e:
+            with self._phase('import validator'):
+                module = self._load_validator()
+        except BaseException as e:
             text_student = "Internal validation problem, please contact your course responsible."
             text_tutor = "Exception while loading the validator: " + str(e)
             self._send_result(text_student, text_tutor, UNSPECIFIC_ERROR)
             return
+        status_read, status_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(status_read)
+            self._run_child(module, status_write)
+        os.close(status_write)
+        logger.debug("Running test script in child process {0}.".format(pid))
+        killer = threading.Timer(self._timeout() + VALIDATOR_GRACE, self._kill_child, [pid])
+        killer.daemon = True
+        killer.start()
+        try:
+            # Returns when the child is gone
+            with os.fdopen(status_read) as f:
+                status = f.readline().strip()
+                report = f.read()
+            pid, exit_status = os.waitpid(pid, 0)
+        finally:
+            killer.cancel()
+        result_sent = False
+        try:
+            # Timeline and result of the job in the child
+            report = json.loads(report)
+            self._timeline = report['timeline']
+            self.error_code = report['error_code']
+            result_sent = report['result_sent']
+            if report['validator_imported'] and self.validator_hash:
+                _importable_validators.add(self.validator_hash)
+        except ValueError:
+            pass
+        if status == 'done':
+            self.result_sent = True
+            return
+        # Child crashed, was killed or called sys.exit(), clean up after it
+        kill_jobs_of(self._config, pid)
+        if result_sent:
+            logger.error("The test script process ended abnormally after sending its result.")
+            self.result_sent = True
+            remove_working_directory(self.working_dir, self._config)
+            return
+        if self._child_killed:
+            text_student = "The validation was cancelled, since it took too long."
+            text_tutor = "The test script did not finish within the job timeout."
+        elif status.startswith('exit '):
+            text_student = "Internal problem while validating your submission. Please contact the course responsible."
+            text_tutor = "The test script ended with exit status {0} before sending a result.".format(
+                status.split()[1])
+        else:
+            text_student = "Internal problem while validating your submission. Please contact the course responsible."
+            if os.WIFSIGNALED(exit_status):
+                text_tutor = "The test script process was terminated by signal {0}.".format(
+                    os.WTERMSIG(exit_status))
+            else:
+                text_tutor = "The test script process ended unexpectedly with exit status {0}.".format(
+                    os.WEXITSTATUS(exit_status))
+        logger.error(text_tutor)
+        self._send_result(text_student, text_tutor, UNSPECIFIC_ERROR)
+        remove_working_directory(self.working_dir, self._config)
+
+    def _run_child(self, module, status_write):
+        '''
+        Main function of the forked child process, never returns.
+        '''
+        status = 'crash'
+        try:
+            if module:
+                module.__file__ = self.validator_script_name
+            self._run_watched(module)
+            status = 'done'
+        except SystemExit as e:
+            # Exit status as with the interpreter, messages mean 1
+            if e.code is None:
+                status = 'exit 0'
+            else:
+                status = 'exit {0}'.format(e.code if isinstance(e.code, int) else 1)
+        except BaseException:
+            logger.exception("Test script crashed.")
+        finally:
+            try:
+                with os.fdopen(status_write, 'w') as f:
+                    f.write(status + '\n')
+                    json.dump({'timeline': self._timeline,
+                               'error_code': self.error_code,
+                               'result_sent': self.result_sent,
+                               'validator_imported': self._validator_imported}, f)
+            finally:
+                os._exit(0)
+
+    def _kill_child(self, pid):
+        logger.error("Test script process {0} exceeded the job timeout, killing it.".format(pid))
+        self._child_killed = True
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _job_processes(self):
+        '''
+        Returns the tracker for the programs started by this job.
+        '''
+        if not self._processes:
+            self._processes = JobProcesses(self._config,
+                                           cpu_time=self.limit_cpu_time,
+                                           memory=self.limit_memory,
+                                           processes=self.limit_processes,
+                                           file_size=self.limit_file_size)
+        return self._processes
+
+    def _kill_programs(self, timeout):
+        logger.error("Job exceeded its timeout of {0} seconds, killing its programs.".format(timeout))
+        self._timed_out = True
+        if self._processes:
+            self._processes.kill()
+
+    def _run_validator(self, module=None):
+        assert(os.path.exists(self.validator_script_name))
+        old_path = sys.path
+        sys.path = [self.working_dir] + old_path
+        # logger.debug('Python search path is now {0}.'.format(sys.path))
 
-        # Looped validator loading in the test suite demands this
-        importlib.reload(module)
+        if not module:
+            try:
+                with self._phase('import validator'):
+                    module = importlib.import_module(self._validator_import_name)
+                    # Looped validator loading in the test suite demands this
+                    importlib.reload(module)
+                self._validator_imported = True
+            except Exception as e:
+                text_student = "Internal validation problem, please contact your course responsible."
+                text_tutor = "Exception while loading the validator: " + str(e)
+                self._send_result(text_student, text_tutor, UNSPECIFIC_ERROR)
+                return
 
         # make the call
         try:
@@ -139,7 +406,202 @@ class InternalJob():
         # Clean the file system, since we can't do anything else
         remove_working_directory(self.working_dir, self._config)
 
+    def _run_compiler(self, program, arguments):
+        '''
+        Run the compiler, or restore its result from the build cache.
+        '''
+        cache = build_cache(self._config)
+        if not cache:
+            prog = RunningProgram(self, program, arguments)
+            prog.expect_exit_status(0)
+            return
+        ignore = ['download.validator', self._validator_import_name + '.py']
+        if self.file_name not in (self.student_files or []):
+            # Unpacked submission archive, the content counts
+            ignore.append(self.file_name)
+        before = snapshot(self.working_dir, ignore)
+        key = build_key(self.working_dir, before, program, arguments)
+        if restore_build(cache, key, self.working_dir):
+            logger.info("Using cached build result {0} instead of running '{1}'.".format(key, program))
+            self._build_hits += 1
+            return
+        self._build_misses += 1
+        prog = RunningProgram(self, program, arguments)
+        prog.expect_exit_status(0)
+        store_build(cache, key, self.working_dir, before)
+
+    def _make_exclusive(self):
+        '''
+        Make sure that no other job runs on this machine.
+        '''
+        if self._slot_lock:
+            preempt_after = self._config.getint("Execution", "preempt_after")
+            if preempt_after > 0 and self._online and not supports_retry(self.api_version):
+                logger.warning("Server cannot take back pre-empted jobs, waiting for the other jobs instead.")
+                preempt_after = 0
+            self._slot_lock.make_exclusive(
+                preempt_after,
+                lambda: preempt_jobs(self._config, self._job_processes().name))
+
+    def _record_perf_data(self, record):
+        self._perf_records.append(record)
+
+    def _measure_cpus(self, cpu_affinity):
+        '''
+        Returns the CPUs for pinning measured programs, or None.
+
+        Without explicit CPUs, the configured ones are used. Isolated
+        cores are not part of the affinity mask of the executor itself,
+        so only the existence of the CPUs is checked.
+        '''
+        if cpu_affinity is None:
+            configured = self._config.get("Execution", "measure_cpus")
+            cpu_affinity = [int(cpu) for cpu in configured.split(',') if cpu.strip()]
+        if not cpu_affinity:
+            return None
+        if not hasattr(os, 'sched_setaffinity'):
+            logger.warning("CPU pinning is not supported on this platform, measuring without it.")
+            return None
+        cpus = set([cpu for cpu in cpu_affinity if 0 <= cpu < os.cpu_count()])
+        if cpus != set(cpu_affinity):
+            logger.warning("Ignoring unknown CPUs in {0}.".format(cpu_affinity))
+        return cpus or None
+
+    def _record_measurement(self, summary):
+        self._measurements.append(summary)
+
+    def _add_phase(self, name, start, end=None):
+        '''
+        Add a phase of the job to its timeline. Times are given as
+        returned by time.time(). Without end, the duration is unknown.
+        '''
+        phase = {'phase': name, 'start': round(start - self._started, 6)}
+        phase['duration'] = round(end - start, 6) if end else None
+        self._timeline.append(phase)
+
+    @contextmanager
+    def _phase(self, name):
+        '''
+        Record the enclosed code as phase of the job.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._add_phase(name, start, time.time())
+
+    def _timeline_data(self):
+        '''
+        Returns the timeline of the job, as sent to the server.
+
+        The JSON format is:
+
+            {
+              "version": 1,
+              "phases": [
+                {
+                  "phase": "download submission",
+                  "start": 0.05,        # seconds since the job was fetched
+                  "duration": 0.01      # seconds, None if not known yet
+                },
+                ...
+              ]
+            }
+
+        The last phase is the sending of the result itself, with unknown duration.
+        '''
+        return json.dumps({'version': 1, 'phases': self._timeline})
+
+    def _perf_data(self):
+        '''
+        Returns the resource usage of all programs run for this job,
+        as sent to the server, or None if no program was run.
+
+        The JSON format is:
+
+            {
+              "version": 1,
+              "programs": [
+                {
+                  "name": "./a.out",                 # program name
+                  "arguments": [],                   # command-line arguments
+                  "exit_status": 0,                  # None if killed by a signal
+                  "wall_time": 0.12,                 # seconds
+                  "user_time": 0.1,                  # CPU seconds in user mode
+                  "system_time": 0.01,               # CPU seconds in kernel mode
+                  "max_rss": 2100,                   # peak resident set size in KiB,
+                                                     # of this program and its children
+                  "voluntary_context_switches": 3,
+                  "involuntary_context_switches": 1,
+                  "block_input": 0,                  # file system input operations
+                  "block_output": 8                  # file system output operations
+                },
+                ...
+              ],
+              "total": { ... },                      # sums, the maximum for max_rss
+              "measurements": [                      # only with Job.measure_program()
+                {
+                  "name": "./a.out",
+                  "arguments": [],
+                  "repetitions": 10,                 # measured runs, after the warm-up runs
+                  "warmup": 1,
+                  "cpus": [2, 3],                    # None if not pinned
+                  "wall_time": {"median": 0.12, "mean": 0.12, "stddev": 0.01, "min": 0.11, "max": 0.14},
+                  "cpu_time": { ... },               # user and system time
+                  "max_rss": { ... }
+                },
+                ...
+              ]
+            }
+
+        Only the wall time is given for programs whose own resource usage
+        could not be determined.
+        '''
+        if not self._perf_records:
+            return None
+        total = {}
+        for record in self._perf_records:
+            for key, value in record.items():
+                if key in ['name', 'arguments', 'exit_status']:
+                    continue
+                if key == 'max_rss':
+                    total[key] = max(total.get(key, 0), value)
+                else:
+                    total[key] = round(total.get(key, 0) + value, 6)
+        data = {'version': 1,
+                'programs': self._perf_records,
+                'total': total}
+        if self._measurements:
+            data['measurements'] = self._measurements
+        return json.dumps(data)
+
+    def _give_back(self):
+        '''
+        Give the job back to the server without a result, so that it is
+        handed out again. Returns False if the server cannot take it back.
+        '''
+        if not self._online or not supports_retry(self.api_version):
+            return False
+        send_result(self._config, [("SubmissionFileId", self.file_id),
+                                   ("Action", self.action),
+                                   ("Retry", "1"),
+                                   ("Secret", self._config.get("Server", "secret")),
+                                   ("UUID", self._config.get("Server", "uuid"))])
+        self.result_sent = True
+        return True
+
     def _send_result(self, info_student, info_tutor, error_code):
+        if self._processes and self._processes.preempted():
+            # The killed programs say nothing about the submission,
+            # so the job goes back to the server for another run
+            metrics.count(self._config, 'jobs_finished_total',
+                          {'action': self.action, 'result': 'preempted'})
+            if self._give_back():
+                logger.warning("Job was pre-empted by an exclusive job, gave it back to the server.")
+            else:
+                logger.warning("Job was pre-empted by an exclusive job, not sending a result.")
+            self.result_sent = True
+            return
         post_data = [("SubmissionFileId", self.file_id),
                      ("Message", info_student),
                      ("Action", self.action),
@@ -149,8 +611,17 @@ class InternalJob():
                      ("Secret", self._config.get("Server", "secret")),
                      ("UUID", self._config.get("Server", "uuid"))
                      ]
+        perf_data = self._perf_data()
+        if perf_data:
+            post_data.append(("PerfData", perf_data))
+        self.error_code = error_code
+        self._add_phase('send result', time.time())
+        post_data.append(("Timeline", self._timeline_data()))
         logger.info(
             'Sending result to OpenSubmit Server: ' + str(post_data))
+        metrics.count(self._config, 'jobs_finished_total',
+                      {'action': self.action, 'result': 'passed' if error_code == 0 else 'failed'})
         if self._online:
-            send_post(self._config, "/jobs/", post_data)
+            with metrics.timed(self._config, 'report'):
+                send_result(self._config, post_data)
         self.result_sent = True
@@ -2,7 +2,7 @@
 The official executor API for validation test and full test scripts.
 '''
 
-from .internaljob import InternalJob, UNSPECIFIC_ERROR
+from .internaljob import InternalJob, UNSPECIFIC_ERROR, summarize
 from .filesystem import has_file
 from .exceptions import *
 from .compiler import GCC, compiler_cmdline
@@ -10,6 +10,8 @@ from .running import RunningProgram
 
 import os
 import re
+import mmap
+import bisect
 import logging
 logger = logging.getLogger('opensubmitexec')
 
@@ -128,12 +130,15 @@ class Job(InternalJob):
             inputs (tuple):   The list of input files for the compiler.
             output (str):     The name of the output file.
 
+        Successful compiler runs are cached on the test machine. If the
+        same compiler call is made with identical files in the working
+        directory again, the created files are restored from the cache.
+
         """
         # Let exceptions travel through
-        prog = RunningProgram(self, *compiler_cmdline(compiler=compiler,
-                                                      inputs=inputs,
-                                                      output=output))
-        prog.expect_exit_status(0)
+        self._run_compiler(*compiler_cmdline(compiler=compiler,
+                                             inputs=inputs,
+                                             output=output))
 
     def run_build(self, compiler=GCC, inputs=None, output=None):
         """Combined call of 'configure', 'make' and the compiler.
@@ -169,7 +174,7 @@ class Job(InternalJob):
         """
         logger.debug("Spawning program for interaction ...")
         if exclusive:
-            kill_longrunning(self.config)
+            self._make_exclusive()
 
         return RunningProgram(self, name, arguments, timeout)
 
@@ -190,11 +195,65 @@ class Job(InternalJob):
         """
         logger.debug("Running program ...")
         if exclusive:
-            kill_longrunning(self.config)
+            self._make_exclusive()
 
         prog = RunningProgram(self, name, arguments, timeout)
         return prog.expect_end()
 
+    def measure_program(self, name, arguments=[], repetitions=10, warmup=1,
+                        cpu_affinity=None, timeout=30):
+        """Measures the performance of a program in the working directory.
+
+        The program is run for warm-up first, and then repeatedly for the
+        measurement. All runs must end with exit status 0. The job runs
+        alone on the test machine meanwhile, and the program is pinned
+        to the given CPUs. The summary is also sent to the server as
+        part of the performance data of the job.
+
+        Args:
+            name (str):          The name of the program to be executed.
+            arguments (tuple):   Command-line arguments for the program.
+            repetitions (int):   Number of measured runs.
+            warmup (int):        Number of runs before the measurement, e.g. for filling caches.
+            cpu_affinity (list): CPU numbers for the program. By default, the CPUs
+                                 from the 'measure_cpus' setting of the executor are used.
+            timeout (int):       The timeout for each run.
+
+        Returns:
+            dict: The summary of the measurement. The entries 'wall_time' and 'cpu_time'
+            (seconds), and 'max_rss' (KiB) contain the 'median', 'mean', 'stddev',
+            'min' and 'max' of the measured runs. Every run is measured on its own.
+            'cpu_time' and 'max_rss' are missing if the operating system
+            did not report the resource usage of the runs.
+
+        Raises:
+            WrongExitStatusException: One of the runs ended with another exit status.
+        """
+        if repetitions < 1:
+            raise ValueError("At least one measured run is needed.")
+        logger.debug("Measuring program ...")
+        self._make_exclusive()
+        cpus = self._measure_cpus(cpu_affinity)
+        runs = []
+        for index in range(warmup + repetitions):
+            prog = RunningProgram(self, name, arguments, timeout, cpus)
+            prog.expect_exitstatus(0)
+            if index >= warmup:
+                runs.append(prog.usage)
+        summary = {'name': name,
+                   'arguments': list(arguments),
+                   'repetitions': repetitions,
+                   'warmup': warmup,
+                   'cpus': sorted(cpus) if cpus else None,
+                   'wall_time': summarize([run['wall_time'] for run in runs])}
+        # Resource usage of the single runs, as reported by wait4()
+        if all(['max_rss' in run for run in runs]):
+            summary['cpu_time'] = summarize([round(run['user_time'] + run['system_time'], 6)
+                                             for run in runs])
+            summary['max_rss'] = summarize([run['max_rss'] for run in runs])
+        self._record_measurement(summary)
+        return summary
+
     def grep(self, regex):
         """Scans the student files for text patterns.
 
@@ -202,18 +261,73 @@ class Job(InternalJob):
             regex (str):       Regular expression used for scanning inside the files.
 
         Returns:
-            tuple:     Names of the matching files in the working directory.
+            tuple:     Names of the matching files in the working directory,
+                       one entry per matching line.
         """
         matches = []
-        logger.debug("Searching student files for '{0}'".format(regex))
-        for fname in self.student_files:
-            if os.path.isfile(self.working_dir + fname):
-                for line in open(self.working_dir + fname, 'br'):
-                    if re.search(regex.encode(), line):
-                        logger.debug("{0} contains '{1}'".format(fname, regex))
-                        matches.append(fname)
+        for fname, lines in self.grep_many([regex], skip_binary=False)[regex].items():
+            matches += [fname] * len(lines)
         return matches
 
+    def grep_many(self, patterns, max_size=None, skip_binary=True):
+        """Scans the student files for several text patterns at once.
+
+        Every file is read only once, all patterns are compiled only once.
+        The patterns are matched line-wise, so '^' and '$' refer to the
+        beginning and end of a line, and no match spans several lines.
+
+        Args:
+            patterns (tuple):  Regular expressions used for scanning inside the files.
+            max_size (int):    Files larger than this number of bytes are not scanned.
+            skip_binary (bool): Do not scan files that contain NUL bytes.
+
+        Returns:
+            dict:     For each pattern, a dictionary that maps the names of the
+                      matching files to the list of matching line numbers.
+        """
+        compiled = [(pattern, re.compile(pattern.encode(), re.MULTILINE))
+                    for pattern in patterns]
+        result = {pattern: {} for pattern in patterns}
+        logger.debug("Searching student files for {0}".format(patterns))
+        for fname in self.student_files:
+            path = self.working_dir + fname
+            if not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            if size == 0:
+                # Cannot be mapped, and there is nothing to find
+                continue
+            if max_size is not None and size > max_size:
+                logger.debug("Not scanning {0}, it has {1} bytes.".format(fname, size))
+                continue
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if skip_binary and data.find(b'\0', 0, 8192) >= 0:
+                    logger.debug("Not scanning binary file {0}.".format(fname))
+                    continue
+                line_starts = None
+                for pattern, regex in compiled:
+                    lines = []
+                    pos = 0
+                    while pos < len(data):
+                        match = regex.search(data, pos)
+                        if not match:
+                            break
+                        start = data.rfind(b'\n', 0, match.start()) + 1
+                        end = data.find(b'\n', match.start())
+                        if end < 0:
+                            end = len(data)
+                        # Matches across lines, e.g. with '\s', count only
+                        # if the pattern also matches within the line
+                        if match.end() <= end or regex.search(data, start, end):
+                            if line_starts is None:
+                                line_starts = [0] + [m.end() for m in re.finditer(b'\n', data)]
+                            lines.append(bisect.bisect_right(line_starts, start))
+                        pos = end + 1
+                    if lines:
+                        logger.debug("{0} contains '{1}' in line(s) {2}".format(fname, pattern, lines))
+                        result[pattern][fname] = lines
+        return result
+
     def ensure_files(self, filenames):
         """Checks the student submission for specific files.
 
@@ -0,0 +1,290 @@
+'''
+    Resource limits and clean termination for the programs of a job.
+'''
+
+import os
+import time
+import glob
+import signal
+import resource
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+# Makes job names unique within one executor process
+_job_counter = 0
+
+# Seconds between SIGTERM and SIGKILL for pre-empted jobs
+PREEMPT_GRACE = 2
+
+
+def _write(fname, text):
+    with open(fname, 'w') as f:
+        f.write(text)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _kill_cgroup(path):
+    '''
+    Kill all processes in the given cgroup.
+    '''
+    try:
+        # Linux >= 5.14 does it atomically, including new forks
+        _write(os.path.join(path, 'cgroup.kill'), '1')
+        return
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(path, 'cgroup.procs')) as f:
+            pids = [int(line) for line in f if line.strip()]
+    except OSError:
+        return
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def _kill_groups(pgids, sig):
+    for pgid in pgids:
+        try:
+            os.killpg(pgid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def _read_groups(fname):
+    '''
+    Returns the process groups listed in a registry file.
+    '''
+    try:
+        with open(fname) as f:
+            # The last line may be incomplete while being written
+            return [int(line) for line in f if line.endswith('\n')]
+    except FileNotFoundError:
+        return []
+
+
+def _owner(name):
+    '''
+    Returns the executor process that created the given job name.
+    '''
+    return int(name.split('-')[1])
+
+
+def _remove_cgroup(path):
+    # Killed processes take a moment to leave the cgroup
+    for attempt in range(20):
+        try:
+            os.rmdir(path)
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            time.sleep(0.05)
+    logger.error("Could not remove cgroup " + path)
+
+
+def registry_dir(config):
+    directory = config.get("Execution", "process_registry")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def kill_jobs_of(config, owner):
+    '''
+    Kill the programs and remove the cgroups of all jobs
+    run by the given executor process, which ended unexpectedly.
+    '''
+    pattern = 'job-{0}-*'.format(owner)
+    for fname in glob.glob(os.path.join(registry_dir(config), pattern)):
+        if not fname.endswith('.preempted'):
+            logger.info("Killing programs of stale job " + os.path.basename(fname))
+            _kill_groups(_read_groups(fname), signal.SIGKILL)
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+    base = config.get("Execution", "cgroup_dir")
+    if base:
+        for path in glob.glob(os.path.join(base, pattern)):
+            logger.info("Removing stale cgroup " + path)
+            _kill_cgroup(path)
+            _remove_cgroup(path)
+
+
+def cleanup_jobs(config):
+    '''
+    Kill the programs and remove the cgroups left behind by crashed executor processes.
+    '''
+    names = [os.path.basename(fname) for fname in glob.glob(os.path.join(registry_dir(config), 'job-*'))]
+    base = config.get("Execution", "cgroup_dir")
+    if base:
+        names += [os.path.basename(path) for path in glob.glob(os.path.join(base, 'job-*'))]
+    for owner in set([_owner(name) for name in names]):
+        if not _pid_alive(owner):
+            kill_jobs_of(config, owner)
+
+
+def preempt_jobs(config, own_name):
+    '''
+    Terminate the programs of all other jobs on this machine.
+
+    The jobs are marked as pre-empted before, so that they
+    do not report the killing as result to the server.
+    '''
+    directory = registry_dir(config)
+    victims = []
+    for fname in glob.glob(os.path.join(directory, 'job-*')):
+        name = os.path.basename(fname)
+        if name == own_name or name.endswith('.preempted'):
+            continue
+        if not _pid_alive(_owner(name)):
+            # Left behind by a crashed executor, see cleanup_jobs()
+            continue
+        logger.info("Pre-empting job " + name)
+        open(fname + '.preempted', 'w').close()
+        if not os.path.exists(fname):
+            # Finished meanwhile
+            os.remove(fname + '.preempted')
+            continue
+        victims.append((name, _read_groups(fname)))
+    for name, pgids in victims:
+        _kill_groups(pgids, signal.SIGTERM)
+    if victims:
+        time.sleep(PREEMPT_GRACE)
+    base = config.get("Execution", "cgroup_dir")
+    for name, pgids in victims:
+        if base:
+            _kill_cgroup(os.path.join(base, name))
+        _kill_groups(pgids, signal.SIGKILL)
+    return len(victims)
+
+
+class JobProcesses():
+    '''
+    The programs started for a job, and their resource limits.
+
+    pexpect starts every program in its own session, and therefore
+    in its own process group. All groups of the job are killed at
+    once when the job ends or runs into its timeout, also catching
+    the child processes the programs left behind.
+
+    The process groups are also listed in a registry file per job,
+    so that an exclusive job can pre-empt the other jobs on this
+    machine without touching unrelated processes.
+
+    If a cgroup v2 directory writable for the executor is configured,
+    every job additionally gets its own cgroup. It limits memory and
+    process count for the whole job, and allows to kill processes that
+    escaped their process group. Otherwise, these limits are applied as
+    rlimits per program. Note that the process count rlimit counts all
+    processes of the executor user account.
+
+    CPU time and file size are always limited per program with rlimits.
+    '''
+    cpu_time = None     # seconds
+    memory = None       # MB
+    processes = None
+    file_size = None    # MB
+    name = None
+    cgroup = None
+
+    def __init__(self, config, cpu_time=None, memory=None, processes=None, file_size=None):
+        self.cpu_time = cpu_time
+        self.memory = memory
+        self.processes = processes
+        self.file_size = file_size
+        self._groups = []
+        global _job_counter
+        _job_counter += 1
+        self.name = "job-{0}-{1}".format(os.getpid(), _job_counter)
+        self._registry = os.path.join(registry_dir(config), self.name)
+        open(self._registry, 'w').close()
+        self.cgroup = self._create_cgroup(config.get("Execution", "cgroup_dir"))
+
+    def _create_cgroup(self, base):
+        if not base:
+            return None
+        path = os.path.join(base, self.name)
+        try:
+            os.mkdir(path)
+            if self.memory:
+                _write(os.path.join(path, 'memory.max'), str(self.memory * 1024 * 1024))
+            if self.processes:
+                _write(os.path.join(path, 'pids.max'), str(self.processes))
+        except OSError as e:
+            logger.warning("Cannot use cgroup {0}, falling back to rlimits: {1}".format(path, str(e)))
+            _remove_cgroup(path)
+            return None
+        logger.debug("Running job programs in cgroup " + path)
+        return path
+
+    def preexec(self):
+        '''
+        Applies the limits, called in the forked child before the program is started.
+        '''
+        if self.cgroup:
+            try:
+                _write(os.path.join(self.cgroup, 'cgroup.procs'), '0')
+            except OSError:
+                # Only the job-wide limits are lost, rlimits still apply
+                self.cgroup = None
+        if self.cpu_time:
+            # SIGXCPU at the soft limit, SIGKILL one second later
+            resource.setrlimit(resource.RLIMIT_CPU, (self.cpu_time, self.cpu_time + 1))
+        if self.file_size:
+            size = self.file_size * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_FSIZE, (size, size))
+        if not self.cgroup:
+            if self.memory:
+                size = self.memory * 1024 * 1024
+                resource.setrlimit(resource.RLIMIT_AS, (size, size))
+            if self.processes:
+                resource.setrlimit(resource.RLIMIT_NPROC, (self.processes, self.processes))
+
+    def add(self, pid):
+        '''
+        Register a started program, which is the leader of its own process group.
+        '''
+        self._groups.append(pid)
+        with open(self._registry, 'a') as f:
+            f.write("{0}\n".format(pid))
+
+    def preempted(self):
+        '''
+        Determine if some exclusive job killed the programs of this job.
+        '''
+        return os.path.exists(self._registry + '.preempted')
+
+    def kill(self):
+        '''
+        Kill all processes of the job.
+        '''
+        if self.cgroup:
+            _kill_cgroup(self.cgroup)
+        _kill_groups(self._groups, signal.SIGKILL)
+
+    def close(self):
+        '''
+        Kill all processes of the job and remove its registry entry and cgroup.
+        '''
+        self.kill()
+        for fname in [self._registry, self._registry + '.preempted']:
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                pass
+        if self.cgroup:
+            _remove_cgroup(self.cgroup)
+            self.cgroup = None
@@ -3,6 +3,8 @@
 '''
 
 from twisted.python.lockfile import FilesystemLock
+import fcntl
+import time
 import os
 
 import logging
@@ -43,3 +45,78 @@ class ScriptLock():
         '''
         logger.debug("Releasing script lock")
         self.flock.unlock()
+
+
+class SlotLock():
+    '''
+    Coordination of parallel jobs on this machine.
+
+    Every running job holds a shared lock on the slot lock file.
+    A job demanding exclusive execution closes a gate for new jobs
+    and waits until all other jobs have released their shared lock,
+    optionally pre-empting them after some time.
+    '''
+    config = None
+    exclusive = False
+    _gate = None
+    _lock = None
+
+    def __init__(self, config):
+        self.config = config
+
+    def __enter__(self):
+        '''
+        Be a context manager.
+        '''
+        fname = self.config.get("Execution", "slotlock")
+        self._gate = open(fname + '.gate', 'a')
+        self._lock = open(fname, 'a')
+        # Pass the gate, which is closed while an exclusive job runs
+        fcntl.flock(self._gate, fcntl.LOCK_EX)
+        fcntl.flock(self._lock, fcntl.LOCK_SH)
+        fcntl.flock(self._gate, fcntl.LOCK_UN)
+        return self
+
+    def make_exclusive(self, preempt_after=0, preempt=None):
+        '''
+        Wait until this job is the only one running on the machine.
+
+        If the other jobs are still running after preempt_after seconds,
+        the preempt function is called once to terminate them.
+        '''
+        if self.exclusive:
+            return
+        logger.info("Waiting for other jobs on this machine to finish ...")
+        # Give up the shared lock first, so that two jobs asking
+        # for exclusive execution at the same time do not deadlock
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        fcntl.flock(self._gate, fcntl.LOCK_EX)
+        if preempt and preempt_after > 0:
+            deadline = time.time() + preempt_after
+            while not self._try_exclusive():
+                if time.time() > deadline:
+                    logger.info("Other jobs still running after {0} seconds, pre-empting them.".format(preempt_after))
+                    preempt()
+                    break
+                time.sleep(0.1)
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        self.exclusive = True
+        logger.info("Job is now running exclusively on this machine.")
+
+    def _try_exclusive(self):
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        '''
+        Be a context manager.
+        '''
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+        if self.exclusive:
+            fcntl.flock(self._gate, fcntl.LOCK_UN)
+            self.exclusive = False
+        self._gate.close()
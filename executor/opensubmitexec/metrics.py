@@ -0,0 +1,220 @@
+'''
+    Operational metrics of the executor, in the Prometheus text format.
+
+    All executor processes (slots, forked test scripts, cron runs)
+    update a shared state file in the cache directory under a file lock.
+    After every update, the metrics are written to the configured file,
+    e.g. for the textfile collector of the Prometheus node exporter.
+    The daemon can additionally serve them on a local HTTP port.
+
+    Without metrics file and port, all functions do nothing.
+'''
+
+import os
+import json
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+PREFIX = 'opensubmit_executor_'
+
+# Name: (type, help text)
+METRICS = {
+    'jobs_fetched_total': ('counter', 'Jobs fetched from the server, by action.'),
+    'jobs_finished_total': ('counter', 'Job results reported to the server, by action and result.'),
+    'phase_seconds': ('summary', 'Duration of the job phases.'),
+    'polls_total': ('counter', 'Job requests to the server, by outcome.'),
+    'result_retries_total': ('counter', 'Repeated attempts to deliver a job result.'),
+    'slots': ('gauge', 'Configured number of parallel jobs.'),
+    'slots_busy': ('gauge', 'Slots currently running a job.'),
+    'slot_busy_seconds_total': ('counter', 'Time spent running jobs, summed over all slots.')
+}
+
+
+def enabled(config):
+    return bool(config.get("Execution", "metrics_file")) or \
+        config.getint("Execution", "metrics_port") > 0
+
+
+def _state_file(config):
+    directory = config.get("Execution", "cache_dir")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, 'metrics.json')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return ','.join(['{0}="{1}"'.format(key, str(value).replace('"', '\\"'))
+                     for key, value in sorted(labels.items())])
+
+
+def _update(config, change):
+    '''
+    Apply the change function to the shared state, and write the metrics file.
+
+    Problems are only logged, they should not affect the job.
+    '''
+    try:
+        fd = os.open(_state_file(config), os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = json.load(f)
+            except ValueError:
+                # New state file
+                state = {'counters': {}, 'busy': {}}
+            change(state)
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+            f.flush()
+            fname = config.get("Execution", "metrics_file")
+            if fname:
+                tmp_fname = "{0}.{1}.tmp".format(fname, os.getpid())
+                with open(tmp_fname, 'w') as target:
+                    target.write(_render(config, state))
+                os.replace(tmp_fname, fname)
+    except OSError as e:
+        logger.warning("Could not update metrics: " + str(e))
+
+
+def _add(state, name, labels, value):
+    counter = state['counters'].setdefault(name, {})
+    key = _labels(labels)
+    counter[key] = counter.get(key, 0) + value
+
+
+def count(config, name, labels=None, value=1):
+    '''
+    Increment a counter.
+    '''
+    if enabled(config):
+        _update(config, lambda state: _add(state, name, labels, value))
+
+
+def observe(config, name, seconds, labels=None):
+    '''
+    Record a duration for a summary metric.
+    '''
+    def change(state):
+        _add(state, name + '_sum', labels, seconds)
+        _add(state, name + '_count', labels, 1)
+    if enabled(config):
+        _update(config, change)
+
+
+@contextmanager
+def timed(config, phase):
+    '''
+    Record the duration of the enclosed code as job phase.
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(config, 'phase_seconds', time.time() - start, {'phase': phase})
+
+
+@contextmanager
+def slot_busy(config):
+    '''
+    Mark this process as running a job for the enclosed code.
+
+    Busy slots of crashed processes are ignored.
+    '''
+    if not enabled(config):
+        yield
+        return
+    pid = str(os.getpid())
+    start = time.time()
+
+    def begin(state):
+        state['busy'][pid] = start
+
+    def end(state):
+        state['busy'].pop(pid, None)
+        _add(state, 'slot_busy_seconds_total', None, time.time() - start)
+    _update(config, begin)
+    try:
+        yield
+    finally:
+        _update(config, end)
+
+
+def _alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _render(config, state):
+    counters = dict(state['counters'])
+    counters['slots'] = {'': config.getint("Execution", "slots")}
+    counters['slots_busy'] = {'': len([pid for pid in state['busy'] if _alive(pid)])}
+    lines = []
+    for name, (kind, text) in sorted(METRICS.items()):
+        lines.append('# HELP {0}{1} {2}'.format(PREFIX, name, text))
+        lines.append('# TYPE {0}{1} {2}'.format(PREFIX, name, kind))
+        if kind == 'summary':
+            series = [name + '_sum', name + '_count']
+        else:
+            series = [name]
+        for series_name in series:
+            for labels, value in sorted(counters.get(series_name, {}).items()):
+                if labels:
+                    lines.append('{0}{1}{{{2}}} {3}'.format(PREFIX, series_name, labels, value))
+                else:
+                    lines.append('{0}{1} {2}'.format(PREFIX, series_name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def render(config):
+    '''
+    Returns the current metrics in the Prometheus text format.
+    '''
+    try:
+        with open(_state_file(config)) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {'counters': {}, 'busy': {}}
+    return _render(config, state)
+
+
+def serve(config):
+    '''
+    Serve the metrics on the configured local port in a background thread.
+
+    Returns the server, or None if no port is configured.
+    '''
+    port = config.getint("Execution", "metrics_port")
+    if port <= 0:
+        return None
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render(config).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("Metrics request: " + format % args)
+
+    server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on http://127.0.0.1:{0}/metrics".format(port))
+    return server
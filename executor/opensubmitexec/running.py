@@ -1,7 +1,7 @@
 import pexpect
+import ptyprocess
 import os
 import time
-import tempfile
 
 from .exceptions import *
 
@@ -9,31 +9,102 @@ import logging
 logger = logging.getLogger('opensubmitexec')
 
 
-def kill_longrunning(config):
-    '''
-        Terminate everything under the current user account
-        that has run too long. This is a final safeguard if
-        the subprocess timeout stuff is not working.
-        You better have no production servers running also
-        under the current user account ...
-    '''
-    import psutil
-    ourpid = os.getpid()
-    username = psutil.Process(ourpid).username
-    # Check for other processes running under this account
-    # Take the timeout definition from the config file
-    timeout = config.getint("Execution", "timeout")
-    for proc in psutil.process_iter():
-        if proc.username == username and proc.pid != ourpid:
-            runtime = time.time() - proc.create_time
-            logger.debug("This user already runs %u for %u seconds." %
-                         (proc.pid, runtime))
-            if runtime > timeout:
-                logger.debug("Killing %u due to exceeded runtime." % proc.pid)
-                try:
-                    proc.kill()
-                except Exception:
-                    logger.error("ERROR killing process %d." % proc.pid)
+class OutputBuffer():
+    """Bounded in-memory log of the console I/O of a running program.
+
+    Keeps the first and the last bytes of the output, up to
+    the given limit in total, and counts the bytes dropped
+    in between. A limit <= 0 keeps everything.
+    """
+    limit = None
+    dropped = 0
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._head = bytearray()
+        self._tail = bytearray()
+        if limit > 0:
+            self._head_size = limit // 2
+            self._tail_size = limit - self._head_size
+
+    def write(self, data):
+        if self.limit <= 0:
+            self._head += data
+            return
+        free = self._head_size - len(self._head)
+        if free > 0:
+            self._head += data[:free]
+            data = data[free:]
+        self._tail += data
+        # Trim only now and then, to keep writes cheap
+        if len(self._tail) > 2 * self._tail_size:
+            excess = len(self._tail) - self._tail_size
+            del self._tail[:excess]
+            self.dropped += excess
+
+    def flush(self):
+        pass
+
+    def text(self):
+        """Returns the kept output as text, with a marker for the dropped part."""
+        tail = self._tail
+        dropped = self.dropped
+        if self.limit > 0 and len(tail) > self._tail_size:
+            dropped += len(tail) - self._tail_size
+            tail = tail[-self._tail_size:]
+        text = self._head.decode('utf-8', errors='replace')
+        if dropped:
+            text += "\n[... {0} bytes of output dropped ...]\n".format(dropped)
+        return text + tail.decode('utf-8', errors='replace')
+
+
+class UsagePtyProcess(ptyprocess.PtyProcess):
+    """Pseudo terminal process that is reaped with wait4().
+
+    This gives the resource usage of this process alone, which is
+    not available anymore after someone else reaped it.
+    """
+    usage = None
+
+    def _wait4(self, options):
+        try:
+            pid, status, usage = os.wait4(self.pid, options)
+        except ChildProcessError:
+            raise ptyprocess.PtyProcessError(
+                'Child process was reaped by someone else.')
+        if pid == 0:
+            return False
+        if os.WIFSTOPPED(status):
+            raise ptyprocess.PtyProcessError(
+                'Child process is stopped, which is not supported.')
+        self.usage = usage
+        self.status = status
+        if os.WIFEXITED(status):
+            self.exitstatus = os.WEXITSTATUS(status)
+            self.signalstatus = None
+        else:
+            self.exitstatus = None
+            self.signalstatus = os.WTERMSIG(status)
+        self.terminated = True
+        return True
+
+    def isalive(self):
+        if self.terminated:
+            return False
+        # Linux needs the blocking form to get the status of a defunct process
+        return not self._wait4(0 if self.flag_eof else os.WNOHANG)
+
+    def wait(self):
+        if not self.terminated:
+            self._wait4(0)
+        return self.exitstatus
+
+
+class UsageSpawn(pexpect.spawn):
+    """pexpect.spawn that keeps the resource usage of the terminated program."""
+
+    def _spawnpty(self, args, **kwargs):
+        return UsagePtyProcess.spawn(args, **kwargs)
 
 
 class RunningProgram(pexpect.spawn):
@@ -46,23 +117,26 @@ class RunningProgram(pexpect.spawn):
         job (Job):            The original job for this program execution.
         name (str):           The name of the binary that is executed.
         arguments (tuple):    The command-line arguments being used for execution.
+        usage (dict):         Resource usage of the terminated program, see Job.measure_program().
     """
     job = None
     name = None
     arguments = None
-    _logfile = None
+    usage = None
+    _output = None
     _spawn = None
+    _started = None
 
     def get_output(self):
         """Get the program output produced so far.
 
+        Only the beginning and the end of very long outputs are kept,
+        as configured with the 'message_size' setting.
+
         Returns:
             str: Program output as text. May be incomplete.
         """
-        # Open temporary file for reading, in text mode
-        # This makes sure that the file pointer for writing
-        # is not touched
-        return ''.join(open(self._logfile.name).readlines())
+        return self._output.text()
 
     def get_exitstatus(self):
         """Get the exit status of the program execution.
@@ -74,7 +148,7 @@ class RunningProgram(pexpect.spawn):
         logger.debug("Exit status is {0}".format(self._spawn.exitstatus))
         return self._spawn.exitstatus
 
-    def __init__(self, job, name, arguments=[], timeout=30):
+    def __init__(self, job, name, arguments=[], timeout=30, cpu_affinity=None):
         self.job = job
         self.name = name
         self.arguments = arguments
@@ -90,14 +164,27 @@ class RunningProgram(pexpect.spawn):
         if name.startswith('./'):
             name = name.replace('./', self.job.working_dir)
 
-        self._logfile = tempfile.NamedTemporaryFile()
-        logger.debug("Keeping console I/O in " + self._logfile.name)
+        preexec = job._job_processes().preexec
+        if cpu_affinity:
+            def preexec():
+                job._job_processes().preexec()
+                os.sched_setaffinity(0, cpu_affinity)
+
+        self._output = OutputBuffer(job._config.getint("Execution", "message_size"))
+        self._started = time.time()
+        if job._job_processes().preempted():
+            logger.debug("Job was pre-empted, not spawning '{0}'.".format(self.name))
+            raise TerminationException(instance=self,
+                                       real_exception=Exception("Pre-empted by an exclusive job."),
+                                       output=self.get_output())
         try:
-            self._spawn = pexpect.spawn(name, arguments,
-                                        logfile=self._logfile,
-                                        timeout=timeout,
-                                        cwd=self.job.working_dir,
-                                        echo=False)
+            self._spawn = UsageSpawn(name, arguments,
+                                     logfile=self._output,
+                                     timeout=timeout,
+                                     cwd=self.job.working_dir,
+                                     echo=False,
+                                     preexec_fn=preexec)
+            job._job_processes().add(self._spawn.pid)
         except Exception as e:
             logger.debug("Spawning failed: " + str(e))
             raise NestedException(instance=self, real_exception=e, output=self.get_output())
@@ -124,6 +211,9 @@ class RunningProgram(pexpect.spawn):
         try:
             return self._spawn.expect(pattern, timeout)
         except pexpect.exceptions.EOF as e:
+            if self.job._timed_out:
+                logger.debug("Raising timeout exception, the job timeout killed the program.")
+                raise TimeoutException(instance=self, real_exception=e, output=self.get_output())
             logger.debug("Raising termination exception.")
             raise TerminationException(instance=self, real_exception=e, output=self.get_output())
         except pexpect.exceptions.TIMEOUT as e:
@@ -167,9 +257,14 @@ class RunningProgram(pexpect.spawn):
             # Make sure we fetch the last output bytes.
             # Recommendation from the pexpect docs.
             self._spawn.expect(pexpect.EOF)
-            self._spawn.wait()
+            self._reap()
+            if self.job._timed_out:
+                raise pexpect.exceptions.TIMEOUT("Killed by the job timeout.")
             dircontent = str(os.listdir(self.job.working_dir))
             logger.debug("Working directory after execution: " + dircontent)
+            if self._output.dropped:
+                logger.debug("Dropped {0} bytes of output from '{1}'.".format(
+                    self._output.dropped, self.name))
             return self.get_exitstatus(), self.get_output()
         except pexpect.exceptions.EOF as e:
             logger.debug("Raising termination exception.")
@@ -181,6 +276,33 @@ class RunningProgram(pexpect.spawn):
             logger.debug("Waiting for expected program end failed.")
             raise NestedException(instance=self, real_exception=e, output=self.get_output())
 
+    def _reap(self):
+        """Wait for the terminated program and record its resource usage in the job."""
+        self._spawn.wait()
+        wall_time = time.time() - self._started
+        self.usage = {
+            'name': self.name,
+            'arguments': list(self.arguments),
+            'exit_status': self._spawn.exitstatus,
+            'wall_time': round(wall_time, 6)
+        }
+        usage = self._spawn.ptyproc.usage
+        if usage is not None:
+            self.usage.update({
+                'user_time': round(usage.ru_utime, 6),
+                'system_time': round(usage.ru_stime, 6),
+                'max_rss': usage.ru_maxrss,
+                'voluntary_context_switches': usage.ru_nvcsw,
+                'involuntary_context_switches': usage.ru_nivcsw,
+                'block_input': usage.ru_inblock,
+                'block_output': usage.ru_oublock
+            })
+        else:
+            # Reaped elsewhere, the usage of other processes must not show up here
+            logger.warning("No resource usage available for '{0}'.".format(self.name))
+        self.job._record_perf_data(self.usage)
+        self.job._add_phase("run " + self.name, self._started, self._started + wall_time)
+
     def expect_exitstatus(self, exit_status):
         """Wait for the running program to finish and expect some exit status.
 
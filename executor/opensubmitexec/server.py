@@ -8,55 +8,117 @@ import shutil
 import os.path
 import glob
 import json
+import time
+import hashlib
 
 from .exceptions import *
 from .filesystem import *
 from .hostinfo import ipaddress, all_host_infos
+from .cache import validator_cache, checksum
+
+from . import connection, metrics
 
-from urllib.request import urlopen, urlretrieve
 from urllib.error import HTTPError, URLError
-from urllib.parse import urlencode
 
 import logging
 logger = logging.getLogger('opensubmitexec')
 
 
-def fetch(url, fullpath):
+def fetch(config, url, fullpath):
     '''
     Fetch data from an URL and save it under the given target name.
     '''
     logger.debug("Fetching %s from %s" % (fullpath, url))
 
     try:
-        tmpfile, headers = urlretrieve(url)
         if os.path.exists(fullpath):
             os.remove(fullpath)
-        shutil.move(tmpfile, fullpath)
+        connection.download(config, url, fullpath)
     except Exception as e:
         logger.error("Error during fetching: " + str(e))
         raise
 
+def fetch_validator(config, job, fullpath):
+    '''
+    Fetch the validator package of a job and save it under the given target name.
+
+    Validators with a known checksum are taken from the local cache,
+    if available. Downloaded validators are added to the cache.
+    '''
+    cache = validator_cache(config)
+    if cache and job.validator_hash:
+        if cache.get(job.validator_hash, fullpath):
+            logger.debug("Using cached validator " + job.validator_hash)
+            return
+    fetch(config, job.validator_url, fullpath)
+    if cache:
+        validator_hash = checksum(fullpath)
+        if job.validator_hash and job.validator_hash != validator_hash:
+            # Validator was changed on the server meanwhile
+            logger.warning("Validator checksum differs from the announced one.")
+        cache.put(validator_hash, fullpath)
+
+
+def store_submission(config, response, fullpath, expected_checksum=None):
+    '''
+    Stream the submission file from the server response to the given file.
+
+    The size limit is checked before and during the download,
+    the checksum is computed on the fly.
+
+    Raises a JobException if the size limit is exceeded, or if the
+    checksum does not match to the one announced by the server.
+    '''
+    chunk_size = config.getint("Execution", "download_chunk_size")
+    max_size = int(config.getfloat("Execution", "max_submission_size") * 1024 * 1024)
+    too_large = JobException(info_student="Your upload is too large for the test machine.",
+                             info_tutor="Submission file exceeds the executor limit of {0} MB.".format(
+                                 config.get("Execution", "max_submission_size")))
+    try:
+        announced = response.headers.get("Content-Length")
+        if max_size > 0 and announced and int(announced) > max_size:
+            raise too_large
+        md5 = hashlib.md5()
+        received = 0
+        with open(fullpath, 'wb') as target:
+            for chunk in response.iter_chunks(chunk_size):
+                received += len(chunk)
+                if max_size > 0 and received > max_size:
+                    raise too_large
+                md5.update(chunk)
+                target.write(chunk)
+    finally:
+        response.close()
+    logger.debug("Received {0} bytes of submission data.".format(received))
+    if expected_checksum and md5.hexdigest() != expected_checksum:
+        raise JobException(info_student="Internal error while transferring your submission to the test machine. Please contact your course responsible.",
+                           info_tutor="Checksum mismatch for the downloaded submission file.")
+
+
 def send_post(config, urlpath, post_data):
     '''
     Send POST data to an OpenSubmit server url path,
     according to the configuration.
+
+    Returns True on success. Job results should be sent
+    with spool.send_result() instead, which retries.
     '''
     server = config.get("Server", "url")
     logger.debug("Sending executor payload to " + server)
-    post_data = urlencode(post_data)
-    post_data = post_data.encode("utf-8", errors="ignore")
     url = server + urlpath
     try:
-        urlopen(url, post_data)
+        connection.post(config, url, post_data)
     except Exception as e:
         logger.error('Error while sending data to server: ' + str(e))
+        return False
+    return True
 
 
 def send_hostinfo(config):
     '''
     Register this host on OpenSubmit test machine.
     '''
-    info = all_host_infos()
+    info = all_host_infos(config)
     logger.debug("Sending host information: " + str(info))
     post_data = [("Config", json.dumps(info)),
                  ("Action", "get_config"),
@@ -86,107 +148,283 @@ def compatible_api_version(server_version):
         return False
 
 
-def fetch_job(config):
+def supports_retry(server_version):
+    '''
+    Check if the server takes jobs back without a result (API version 1.2).
+    '''
+    try:
+        major, minor = server_version.split('.')[:2]
+        return (int(major), int(minor)) >= (1, 2)
+    except Exception:
+        return False
+
+
+def server_url(config, absolute_url):
+    '''
+    Translate a download URL given by the server to the configured server URL.
+    '''
+    # Ignore server-given host + port and use the configured one instead
+    # This fixes problems with the arbitrary Django LiveServer port choice
+    # It would be better to return relative URLs only for this property,
+    # but this is a Bernhard-incompatible API change
+    from urllib.parse import urlparse
+    relative_path = urlparse(absolute_url).path
+    # I'm Sven, not Berhard but I can't wrap my head around what Peter wrote
+    # Issue for me being https://host/path is suffixed  with /path/download/blah
+    # Removing the latter path
+    try:
+        relative_path = relative_path[relative_path.index("/download"):]
+    except ValueError:
+        pass
+    return config.get("Server", "url") + relative_path
+
+
+def create_job(config, description):
+    '''
+    Create a job object from the job description sent by the server,
+    either as response headers or as entry of a batch manifest.
+    '''
+    from .job import Job
+    job = Job(config)
+
+    job.submitter_name = description['SubmitterName']
+    job.author_names = description['AuthorNames']
+    job.submitter_studyprogram = description['SubmitterStudyProgram']
+    job.course = description['Course']
+    job.assignment = description['Assignment']
+    job.action = description["Action"]
+    job.file_id = description["SubmissionFileId"]
+    job.sub_id = description["SubmissionId"]
+    job.file_name = description["SubmissionOriginalFilename"]
+    job.submitter_student_id = description["SubmitterStudentId"]
+    job.api_version = description.get("APIVersion")
+    metrics.count(config, 'jobs_fetched_total', {'action': job.action})
+    if "Timeout" in description:
+        job.timeout = int(description["Timeout"])
+    if "ValidatorHash" in description:
+        job.validator_hash = description["ValidatorHash"]
+    if "LimitCpuTime" in description:
+        job.limit_cpu_time = int(description["LimitCpuTime"])
+    if "LimitMemory" in description:
+        job.limit_memory = int(description["LimitMemory"])
+    if "LimitProcesses" in description:
+        job.limit_processes = int(description["LimitProcesses"])
+    if "LimitFileSize" in description:
+        job.limit_file_size = int(description["LimitFileSize"])
+    if "PostRunValidation" in description:
+        job.validator_url = server_url(config, description["PostRunValidation"])
+    return job
+
+
+def setup_job(config, job, response, expected_checksum=None):
+    '''
+    Store the submission from the server response and the validator
+    in a fresh working directory for the job.
+
+    Returns None if the job could not be prepared.
+    Errors are reported to the server directly.
+    '''
+    job.working_dir = create_working_dir(config, job.sub_id)
+
+    with metrics.timed(config, 'download'):
+        # Store submission in working directory
+        submission_fname = job.working_dir + job.file_name
+        try:
+            with job._phase('download submission'):
+                store_submission(config, response, submission_fname, expected_checksum)
+        except JobException as e:
+            logger.error(e.info_tutor)
+            job.send_fail_result(e.info_student, e.info_tutor)
+            remove_working_directory(job.working_dir, config)
+            return None
+
+        # Store validator package in working directory
+        validator_fname = job.working_dir + 'download.validator'
+        with job._phase('download validator'):
+            fetch_validator(config, job, validator_fname)
+
+    try:
+        prepare_working_directory(job, submission_fname, validator_fname)
+    except JobException as e:
+        job.send_fail_result(e.info_student, e.info_tutor)
+        return None
+    logger.debug("Got job: " + str(job))
+    return job
+
+
+def jobs_url(config, wait=0):
+    url = "%s/jobs/?Secret=%s&UUID=%s" % (config.get("Server", "url"),
+                                          config.get("Server", "secret"),
+                                          config.get("Server", "uuid"))
+    if wait > 0:
+        url += "&Wait=%u" % wait
+    return url
+
+
+def jobs_timeout(config, wait=0):
+    '''
+    HTTP timeout for job requests, considering the time the server may hold them.
+    '''
+    return config.getint("Server", "http_timeout") + max(wait, 0)
+
+
+def fetch_job(config, wait=0):
     '''
     Fetch any available work from the OpenSubmit server and
     return an according job object.
 
+    The server may hold the request for 'wait' seconds,
+    until some work is available.
+
     Returns None if no work is available.
 
     Errors are reported by this function directly.
     '''
-    url = "%s/jobs/?Secret=%s&UUID=%s" % (config.get("Server", "url"),
-                                          config.get("Server", "secret"),
-                                          config.get("Server", "uuid"))
+    url = jobs_url(config, wait)
 
     try:
         # Fetch information from server
-        result = urlopen(url)
-        headers = result.info()
-        logger.debug("Raw job data: " + str(result.headers).replace('\n', ', '))
+        started = time.time()
+        result = connection.get(config, url, jobs_timeout(config, wait))
+        fetched = time.time()
+        headers = result.headers
+        logger.debug("Raw job data: " + str(headers).replace('\n', ', '))
         if not compatible_api_version(headers["APIVersion"]):
             # No proper reporting possible, so only logging.
             logger.error("Incompatible API version. Please update OpenSubmit.")
+            result.close()
+            metrics.count(config, 'polls_total', {'outcome': 'error'})
             return None
 
         if headers["Action"] == "get_config":
             # The server does not know us,
             # so it demands registration before hand.
             logger.info("Machine unknown on server, sending registration ...")
+            result.close()
+            metrics.count(config, 'polls_total', {'outcome': 'registration'})
             send_hostinfo(config)
             return None
 
         # Create job object with information we got
-        from .job import Job
-        job = Job(config)
-
-        job.submitter_name = headers['SubmitterName']
-        job.author_names = headers['AuthorNames']
-        job.submitter_studyprogram = headers['SubmitterStudyProgram']
-        job.course = headers['Course']
-        job.assignment = headers['Assignment']
-        job.action = headers["Action"]
-        job.file_id = headers["SubmissionFileId"]
-        job.sub_id = headers["SubmissionId"]
-        job.file_name = headers["SubmissionOriginalFilename"]
-        job.submitter_student_id = headers["SubmitterStudentId"]
-        if "Timeout" in headers:
-            job.timeout = int(headers["Timeout"])
-        if "PostRunValidation" in headers:
-            # Ignore server-given host + port and use the configured one instead
-            # This fixes problems with the arbitrary Django LiveServer port choice
-            # It would be better to return relative URLs only for this property,
-            # but this is a Bernhard-incompatible API change
-            from urllib.parse import urlparse
-            relative_path = urlparse(headers["PostRunValidation"]).path
-            # I'm Sven, not Berhard but I can't wrap my head around what Peter wrote
-            # Issue for me being https://host/path is suffixed  with /path/download/blah
-            # Removing the latter path
-            try:
-                relative_path = relative_path[relative_path.index("/download"):]
-            except ValueError:
-                pass
-            job.validator_url = config.get("Server", "url") + relative_path
-        job.working_dir = create_working_dir(config, job.sub_id)
+        metrics.count(config, 'polls_total', {'outcome': 'job'})
+        job = create_job(config, headers)
+        job._started = started
+        job._add_phase('fetch', started, fetched)
+        return setup_job(config, job, result, headers.get("SubmissionFileChecksum"))
+    except HTTPError as e:
+        if e.code == 404:
+            logger.debug("Nothing to do.")
+            metrics.count(config, 'polls_total', {'outcome': 'empty'})
+            return None
+        metrics.count(config, 'polls_total', {'outcome': 'error'})
+    except URLError as e:
+        logger.error("Error while contacting {0}: {1}".format(url, str(e)))
+        metrics.count(config, 'polls_total', {'outcome': 'error'})
+        return None
 
-        # Store submission in working directory
-        submission_fname = job.working_dir + job.file_name
-        with open(submission_fname, 'wb') as target:
-            target.write(result.read())
-        assert(os.path.exists(submission_fname))
 
-        # Store validator package in working directory
-        validator_fname = job.working_dir + 'download.validator'
-        fetch(job.validator_url, validator_fname)
+def lease_jobs(config, count, wait=0):
+    '''
+    Lease up to 'count' jobs from the OpenSubmit server with one request.
+    The server may hold the request for 'wait' seconds.
 
+    Returns the list of job descriptions from the server manifest,
+    which may be empty. Use fetch_leased_job() to get the job objects.
+
+    Demands server API version 1.1 or newer.
+    '''
+    url = jobs_url(config, wait) + "&Jobs=%u" % count
+
+    try:
+        result = connection.get(config, url, jobs_timeout(config, wait))
         try:
-            prepare_working_directory(job, submission_fname, validator_fname)
-        except JobException as e:
-            job.send_fail_result(e.info_student, e.info_tutor)
-            return None
-        logger.debug("Got job: " + str(job))
-        return job
+            headers = result.headers
+            if not compatible_api_version(headers["APIVersion"]):
+                logger.error("Incompatible API version. Please update OpenSubmit.")
+                metrics.count(config, 'polls_total', {'outcome': 'error'})
+                return []
+
+            if headers.get("Action") == "get_config":
+                logger.info("Machine unknown on server, sending registration ...")
+                metrics.count(config, 'polls_total', {'outcome': 'registration'})
+                send_hostinfo(config)
+                return []
+
+            if "json" not in headers.get("Content-Type", ""):
+                # Older servers ignore the batch request and deliver a single job,
+                # which is lost now. The server marks it as failed after the job timeout.
+                logger.error("Server does not support batch leasing, please disable it in the configuration.")
+                metrics.count(config, 'polls_total', {'outcome': 'error'})
+                return []
+
+            manifest = json.loads(result.read().decode("utf-8"))
+        finally:
+            result.close()
+        logger.debug("Leased {0} job(s).".format(len(manifest["Jobs"])))
+        for description in manifest["Jobs"]:
+            description["APIVersion"] = headers["APIVersion"]
+        metrics.count(config, 'polls_total', {'outcome': 'job' if manifest["Jobs"] else 'empty'})
+        return manifest["Jobs"]
     except HTTPError as e:
         if e.code == 404:
             logger.debug("Nothing to do.")
-            return None
+            metrics.count(config, 'polls_total', {'outcome': 'empty'})
+        else:
+            logger.error("Error while leasing jobs: " + str(e))
+            metrics.count(config, 'polls_total', {'outcome': 'error'})
+        return []
     except URLError as e:
         logger.error("Error while contacting {0}: {1}".format(url, str(e)))
+        metrics.count(config, 'polls_total', {'outcome': 'error'})
+        return []
+    except (ValueError, KeyError) as e:
+        logger.error("Invalid job manifest from the server: {0}".format(str(e)))
+        metrics.count(config, 'polls_total', {'outcome': 'error'})
+        return []
+
+
+def fetch_leased_job(config, description):
+    '''
+    Download the submission for a job description from the
+    batch manifest and return an according job object.
+
+    Returns None if the job could not be prepared. The job is given
+    back to the server then, or gets a fail result from older servers.
+    '''
+    job = create_job(config, description)
+    url = server_url(config, description["SubmissionUrl"])
+    try:
+        with job._phase('fetch'):
+            result = connection.get(config, url)
+        return setup_job(config, job, result, description.get("SubmissionFileChecksum"))
+    except OSError as e:
+        # Download problems, and file system problems in the working directory
+        logger.error("Error while preparing leased job for submission file {0}: {1}".format(
+            job.file_id, str(e)))
+        if job.working_dir:
+            remove_working_directory(job.working_dir, config)
+        if not job._give_back():
+            job.send_fail_result("Internal problem while preparing the test of your submission. "
+                                 "Please contact the course responsible.",
+                                 "Error while preparing the job: " + str(e))
         return None
 
 
-def fake_fetch_job(config, src_dir):
+def fake_fetch_job(config, src_dir, validator_hash=None):
     '''
     Act like fetch_job, but take the validator file and the student
     submission files directly from a directory.
 
     Intended for testing purposes when developing test scripts.
+    With a validator checksum, the validator caches are used as for
+    real jobs.
 
     Check also cmdline.py.
     '''
     logger.debug("Creating fake job from " + src_dir)
     from .job import Job
     job = Job(config, online=False)
+    job.validator_hash = validator_hash
     job.working_dir = create_working_dir(config, '42')
     for fname in glob.glob(src_dir + os.sep + '*'):
         logger.debug("Copying {0} to {1} ...".format(fname, job.working_dir))
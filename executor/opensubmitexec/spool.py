@@ -0,0 +1,163 @@
+'''
+    Durable delivery of job results to the OpenSubmit server.
+
+    Every result is written to the spool directory before it is sent.
+    The file is only removed after a successful delivery, so results
+    survive server downtimes and executor restarts. There is at most one
+    spooled result per submission file and action, newer results replace
+    undelivered older ones.
+'''
+
+import os
+import json
+import time
+import glob
+
+from urllib.error import HTTPError
+
+from . import connection, metrics
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+# Form fields that are always taken from the current configuration
+CREDENTIAL_FIELDS = ['Secret', 'UUID']
+
+
+def spool_dir(config):
+    directory = config.get("Execution", "spool_dir")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def spool_result(config, post_data):
+    '''
+    Store the result form data in the spool directory.
+
+    Returns the name of the spool file.
+    '''
+    fields = dict(post_data)
+    fname = os.path.join(spool_dir(config), "{0}-{1}.json".format(
+        fields["SubmissionFileId"], fields["Action"]))
+    data = [(key, value) for key, value in post_data if key not in CREDENTIAL_FIELDS]
+    tmp_fname = "{0}.{1}.tmp".format(fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
+    return fname
+
+
+def _claim(fname):
+    '''
+    Rename the spool file, so that no other executor process sends it.
+
+    Returns the new file name, or None if some other process was faster.
+    '''
+    claimed = "{0}.sending.{1}".format(fname, os.getpid())
+    try:
+        os.rename(fname, claimed)
+    except FileNotFoundError:
+        return None
+    return claimed
+
+
+def _release(claimed):
+    '''
+    Give a claimed spool file back, unless a newer result was spooled meanwhile.
+    '''
+    fname = claimed[:claimed.rindex(".sending.")]
+    if os.path.exists(fname):
+        os.remove(claimed)
+    else:
+        os.rename(claimed, fname)
+
+
+def deliver(config, fname):
+    '''
+    Send a spooled result to the server.
+
+    Returns True if the spool file is done, either because
+    it was delivered or because the server rejected it.
+    Returns False if the delivery should be tried again later.
+    '''
+    claimed = _claim(fname)
+    if not claimed:
+        return True
+    with open(claimed) as f:
+        post_data = [tuple(field) for field in json.load(f)]
+    post_data += [("Secret", config.get("Server", "secret")),
+                  ("UUID", config.get("Server", "uuid"))]
+    url = config.get("Server", "url") + "/jobs/"
+    try:
+        connection.post(config, url, post_data)
+    except HTTPError as e:
+        if e.code < 500:
+            # Retrying does not help. The job stays leased,
+            # until the server marks it as failed after its timeout.
+            logger.error("Server rejected result from {0}, dropping it: {1}".format(fname, str(e)))
+            os.remove(claimed)
+            return True
+        logger.warning("Server error while sending result from {0}: {1}".format(fname, str(e)))
+        _release(claimed)
+        return False
+    except Exception as e:
+        logger.warning("Error while sending result from {0}: {1}".format(fname, str(e)))
+        _release(claimed)
+        return False
+    os.remove(claimed)
+    logger.debug("Delivered result from " + fname)
+    return True
+
+
+def send_result(config, post_data):
+    '''
+    Spool the result form data and send it to the server.
+
+    Failed deliveries are repeated with exponential backoff.
+    If the configured number of retries is exhausted, the result
+    stays in the spool until replay_spool() is called.
+
+    Returns True if the result was delivered.
+    '''
+    fname = spool_result(config, post_data)
+    delay = config.getfloat("Server", "retry_delay")
+    retries = config.getint("Server", "retries")
+    for attempt in range(retries + 1):
+        if deliver(config, fname):
+            return True
+        if attempt < retries:
+            logger.info("Sending the result again in {0} seconds.".format(delay))
+            metrics.count(config, 'result_retries_total')
+            time.sleep(delay)
+            delay *= 2
+    logger.error("Result stays in the spool for later delivery: " + fname)
+    return False
+
+
+def replay_spool(config):
+    '''
+    Try once to send the undelivered results from the spool directory,
+    until the first delivery fails.
+
+    Spool files of crashed executor processes are recovered before.
+
+    Returns the number of results still waiting for delivery.
+    '''
+    directory = spool_dir(config)
+    for claimed in glob.glob(os.path.join(directory, "*.json.sending.*")):
+        pid = int(claimed[claimed.rindex(".") + 1:])
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            logger.info("Recovering spooled result " + claimed)
+            _release(claimed)
+        except PermissionError:
+            pass
+    fnames = sorted(glob.glob(os.path.join(directory, "*.json")))
+    for index, fname in enumerate(fnames):
+        logger.info("Replaying spooled result " + fname)
+        if not deliver(config, fname):
+            return len(fnames) - index
+    return 0
@@ -22,7 +22,8 @@ setup(
     ],
 
     install_requires=required,
-    extras_require={'report-opencl': ["pyopencl"]},
+    extras_require={'report-opencl': ["pyopencl"],
+                    'http-pooling': ["requests"]},
     packages = ['opensubmitexec'],
     package_data = {'opensubmitexec': ['VERSION']},
     entry_points={
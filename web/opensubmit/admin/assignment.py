@@ -143,7 +143,12 @@ class AssignmentAdmin(ModelAdmin):
             ('File Upload Validation',
                 {   'fields': (('attachment_test_validity', 'validity_script_download'), \
                                'attachment_test_full', \
-                               ('test_machines', 'attachment_test_timeout') )},
+                               ('test_machines', 'attachment_test_timeout'), \
+                               'reuse_test_results' )},
+            ),
+            ('Resource Limits for Tests',
+                {   'fields': (('limit_cpu_time', 'limit_memory'),
+                               ('limit_processes', 'limit_file_size'))},
             )
     )
 
@@ -6,7 +6,7 @@ from django.db.models import Q
 from django.shortcuts import redirect
 from django.utils.safestring import mark_safe
 from django.http import HttpResponse
-from django.utils.html import format_html
+from django.utils.html import format_html, format_html_join
 from opensubmit.models import Assignment, Submission, Grading
 from django.utils import timesince
 
@@ -172,7 +172,23 @@ class SubmissionAdmin(ModelAdmin):
                 text = result_obj.result
             else:
                 text = result_obj.result_tutor
-            return format_html("{1}<div style='font-size:80%'><br/>(Generated by {0})</div>", result_obj.machine, text)
+            html = format_html("{1}<div style='font-size:80%'><br/>(Generated by {0})</div>", result_obj.machine, text)
+            if not show_student_data:
+                html += self._render_timeline(result_obj)
+            return html
+
+    def _render_timeline(self, result_obj):
+        '''
+            Renders the phases of the executor job as small table.
+        '''
+        phases = result_obj.phases.all()
+        if not phases:
+            return ''
+        rows = format_html_join('', "<tr><td>{0}</td><td>{1}</td><td>{2}</td></tr>",
+                                ((phase.name, '%.3f s' % phase.start,
+                                  '?' if phase.duration is None else '%.3f s' % phase.duration)
+                                 for phase in phases))
+        return format_html("<table style='font-size:80%'><tr><th>Job phase</th><th>Start</th><th>Duration</th></tr>{0}</table>", rows)
 
     def validationtest_result_student(self, instance):
         result_obj = instance.get_validation_result()
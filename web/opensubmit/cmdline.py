@@ -55,6 +55,10 @@ DATABASE_PORT: {database_port}
 # every student ...
 # Change it, the value does not matter.
 SHARED_SECRET: 49846zut93purfh977TTTiuhgalkjfnk89
+# Executors may ask the server to hold their request until a job is available.
+# This is the maximum waiting time in seconds. Every waiting executor occupies
+# one web server thread, 0 disables the waiting.
+MAX_WAIT: 30
 
 [admin]
 ADMIN_NAME: {admin_name}
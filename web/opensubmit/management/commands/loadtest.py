@@ -0,0 +1,295 @@
+'''
+    Load test of the executor API with many simulated executors.
+
+    The command seeds a course with pending submissions, and then
+    lets each simulated executor poll '/jobs/', report results and
+    send its host information to '/machines/', in its own thread.
+    Requests are handled in-process with the Django test client,
+    so that the database queries per request can be counted.
+
+    The seeded data is removed afterwards, unless --keep is given.
+    Never run this on a production database.
+'''
+
+import random
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from opensubmit.models import Course, Assignment, Submission, SubmissionFile, SubmissionTestResult, TestMachine, UserProfile
+
+PREFIX = 'loadtest'
+
+VALIDATOR = b'''
+def validate(job):
+    job.send_pass_result("Load test result.")
+'''
+
+
+def percentile(values, p):
+    # Nearest rank
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+class Recorder():
+    '''
+    Collects the measurements of all simulated executors.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.dispatched = {}
+        self.results = set()
+
+    def request(self, kind, latency, queries, error=None):
+        with self.lock:
+            entry = self.requests.setdefault(kind, {'latencies': [], 'queries': [], 'errors': {}})
+            entry['latencies'].append(latency)
+            entry['queries'].append(queries)
+            if error:
+                entry['errors'][error] = entry['errors'].get(error, 0) + 1
+
+    def dispatch(self, job, executor):
+        with self.lock:
+            self.dispatched.setdefault(job, []).append(executor)
+
+    def result(self, job):
+        with self.lock:
+            self.results.add(job)
+
+    def double_dispatches(self):
+        '''
+        Returns the jobs handed out to more than one executor, or more than once.
+        '''
+        with self.lock:
+            return dict([(job, executors) for job, executors in self.dispatched.items()
+                         if len(executors) > 1])
+
+
+class Executor(threading.Thread):
+    '''
+    A simulated executor, talking to the server like opensubmit-exec.
+    '''
+
+    def __init__(self, host, recorder, options, deadline, rnd):
+        super().__init__(name=host)
+        self.host = host
+        self.recorder = recorder
+        self.options = options
+        self.deadline = deadline
+        self.rnd = rnd
+        self.client = Client(HTTP_HOST=settings.ALLOWED_HOSTS[0])
+
+    def call(self, kind, method, path, data):
+        started = time.time()
+        response = None
+        error = None
+        with CaptureQueriesContext(connection) as queries:
+            try:
+                response = method(path, data)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                    response.close()
+                if response.status_code not in (200, 201, 404):
+                    error = 'HTTP %u' % response.status_code
+            except Exception as e:
+                error = type(e).__name__
+        if response is not None and response.status_code == 404:
+            kind += ' (empty)'
+        self.recorder.request(kind, time.time() - started, len(queries), error)
+        return None if error else response
+
+    def register(self):
+        self.call('POST /machines/', self.client.post, '/machines/',
+                  {'Secret': settings.JOB_EXECUTOR_SECRET, 'UUID': self.host,
+                   'Config': '[["Operating system", "Load test"]]'})
+
+    def poll(self):
+        '''
+        Fetch jobs and return their (file id, action) pairs.
+        '''
+        params = {'Secret': settings.JOB_EXECUTOR_SECRET, 'UUID': self.host}
+        if self.options['wait']:
+            params['Wait'] = self.options['wait']
+        if self.options['batch']:
+            params['Jobs'] = self.options['batch']
+        response = self.call('GET /jobs/', self.client.get, '/jobs/', params)
+        if response is None or response.status_code != 200:
+            return []
+        if self.options['batch']:
+            return [(job['SubmissionFileId'], job['Action']) for job in response.json()['Jobs']]
+        return [(response['SubmissionFileId'], response['Action'])]
+
+    def report(self, job):
+        file_id, action = job
+        response = self.call('POST /jobs/', self.client.post, '/jobs/',
+                             {'Secret': settings.JOB_EXECUTOR_SECRET, 'UUID': self.host,
+                              'SubmissionFileId': file_id, 'Action': action,
+                              'Message': 'Load test result.', 'MessageTutor': 'Load test result.',
+                              'ErrorCode': 0})
+        if response is not None:
+            self.recorder.result(job)
+
+    def run(self):
+        try:
+            # Executors do not start at the same moment
+            time.sleep(self.rnd.uniform(0, self.options['poll_interval']))
+            self.register()
+            while time.time() < self.deadline:
+                jobs = self.poll()
+                for job in jobs:
+                    self.recorder.dispatch(job, self.host)
+                if jobs:
+                    time.sleep(self.options['run_time'])
+                    for job in jobs:
+                        self.report(job)
+                else:
+                    time.sleep(self.rnd.uniform(0.5, 1.5) * self.options['poll_interval'])
+        finally:
+            connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Runs a load test of the executor API with simulated executors.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--executors', type=int, default=200,
+                            help='Number of simulated executors (default: 200).')
+        parser.add_argument('--submissions', type=int, default=1000,
+                            help='Number of seeded submissions pending for testing (default: 1000).')
+        parser.add_argument('--duration', type=float, default=60,
+                            help='Duration of the load test in seconds (default: 60).')
+        parser.add_argument('--poll-interval', type=float, default=3,
+                            help='Mean time between job requests of an idle executor (default: 3).')
+        parser.add_argument('--run-time', type=float, default=1,
+                            help='Simulated duration of a test run in seconds (default: 1).')
+        parser.add_argument('--batch', type=int, default=0,
+                            help='Lease this number of jobs per request, instead of one.')
+        parser.add_argument('--wait', type=int, default=0,
+                            help='Long polling time for job requests.')
+        parser.add_argument('--full-test', action='store_true',
+                            help='Give the assignment a full test, so that every submission is tested twice.')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed for the polling jitter.')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the seeded data after the test.')
+
+    def seed(self, options):
+        '''
+        Create the course, assignment, submissions and test machines.
+        '''
+        self.cleanup()
+        owner = User.objects.create_user(username=PREFIX + '_owner', email='owner@example.org')
+        course = Course(title='Load test course', active=True, owner=owner,
+                        homepage='http://example.org/loadtest')
+        course.save()
+        now = timezone.now()
+        assignment = Assignment(title='Load test assignment',
+                                course=course,
+                                download='http://example.org/loadtest.pdf',
+                                publish_at=now - timedelta(weeks=1),
+                                soft_deadline=now + timedelta(weeks=1),
+                                hard_deadline=now + timedelta(weeks=1),
+                                has_attachment=True,
+                                max_authors=1)
+        assignment.attachment_test_validity.save(PREFIX + '_validator.py', ContentFile(VALIDATOR), save=False)
+        if options['full_test']:
+            assignment.attachment_test_full.save(PREFIX + '_fulltest.py', ContentFile(VALIDATOR), save=False)
+        assignment.save()
+        for index in range(options['submissions']):
+            user = User.objects.create_user(username='%s_student_%u' % (PREFIX, index),
+                                            email='student%u@example.org' % index,
+                                            first_name='Student', last_name=str(index))
+            UserProfile(user=user).save()
+            upload = SubmissionFile(original_filename='hello.c')
+            upload.attachment.save('%s_%u.c' % (PREFIX, index),
+                                   ContentFile('int main() { return %u; }\n' % index), save=False)
+            upload.save()
+            Submission(assignment=assignment, submitter=user, file_upload=upload,
+                       notes='Load test submission.',
+                       state=Submission.TEST_VALIDITY_PENDING).save()
+        hosts = []
+        for index in range(options['executors']):
+            machine = TestMachine(host='%s-%s' % (PREFIX, uuid.uuid4()), last_contact=timezone.now())
+            machine.save()
+            assignment.test_machines.add(machine)
+            hosts.append(machine.host)
+        return assignment, hosts
+
+    def cleanup(self):
+        '''
+        Remove the data created by an earlier load test.
+        '''
+        for upload in SubmissionFile.objects.filter(submissions__submitter__username__startswith=PREFIX + '_'):
+            upload.attachment.delete(save=False)
+            upload.delete()
+        for assignment in Assignment.objects.filter(course__owner__username=PREFIX + '_owner'):
+            assignment.attachment_test_validity.delete(save=False)
+            assignment.attachment_test_full.delete(save=False)
+        Course.objects.filter(owner__username=PREFIX + '_owner').delete()
+        User.objects.filter(username__startswith=PREFIX + '_').delete()
+        TestMachine.objects.filter(host__startswith=PREFIX + '-').delete()
+
+    def report(self, recorder, assignment, elapsed):
+        line = '{0:<26} {1:>7} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9} {7:>8} {8:>8}'
+        self.stdout.write(line.format('Request', 'count', 'errors', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)',
+                                      'max (ms)', 'queries', 'max q.'))
+        total = 0
+        for kind, entry in sorted(recorder.requests.items()):
+            latencies = sorted(entry['latencies'])
+            total += len(latencies)
+            self.stdout.write(line.format(
+                kind, len(latencies), sum(entry['errors'].values()),
+                *['%.1f' % (1000 * percentile(latencies, p)) for p in (50, 90, 99, 100)],
+                '%.1f' % (sum(entry['queries']) / len(entry['queries'])), max(entry['queries'])))
+            for error, count in sorted(entry['errors'].items()):
+                self.stdout.write('    %s: %u' % (error, count))
+        self.stdout.write('\n%u requests in %.1f seconds, %.1f requests/s' % (total, elapsed, total / elapsed))
+        self.stdout.write('%u jobs dispatched, %u results reported' %
+                          (sum([len(executors) for executors in recorder.dispatched.values()]),
+                           len(recorder.results)))
+        self.stdout.write('%u submissions still pending' %
+                          Submission.pending_tests.filter(assignment=assignment).count())
+        incidents = recorder.double_dispatches()
+        duplicates = SubmissionTestResult.objects.filter(submission_file__submissions__assignment=assignment) \
+                                                 .values('submission_file', 'kind') \
+                                                 .annotate(count=Count('pk')).filter(count__gt=1)
+        self.stdout.write('%u double dispatches, %u duplicate test results' %
+                          (len(incidents), len(duplicates)))
+        for (file_id, action), executors in sorted(incidents.items()):
+            self.stdout.write('    Submission file %s (%s) went to %s' % (file_id, action, ', '.join(executors)))
+
+    def handle(self, *args, **options):
+        # Students get no mails about their results
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            self.stdout.write('Seeding %u submissions for %u executors ...' %
+                              (options['submissions'], options['executors']))
+            assignment, hosts = self.seed(options)
+            rnd = random.Random(options['seed'])
+            recorder = Recorder()
+            started = time.time()
+            deadline = started + options['duration']
+            executors = [Executor(host, recorder, options, deadline, random.Random(rnd.random()))
+                         for host in hosts]
+            for executor in executors:
+                executor.start()
+            for executor in executors:
+                executor.join()
+            elapsed = time.time() - started
+            try:
+                self.report(recorder, assignment, elapsed)
+            finally:
+                if not options['keep']:
+                    self.cleanup()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opensubmit', '0036_auto_20190305_0911'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignment',
+            name='limit_cpu_time',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum CPU time (in seconds) for each program started by the test scripts. Leave empty for no limit.', null=True, verbose_name='CPU time limit'),
+        ),
+        migrations.AddField(
+            model_name='assignment',
+            name='limit_file_size',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum size (in MB) of files written by the programs started by the test scripts. Leave empty for no limit.', null=True, verbose_name='File size limit'),
+        ),
+        migrations.AddField(
+            model_name='assignment',
+            name='limit_memory',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum memory usage (in MB) for the programs started by the test scripts. Leave empty for no limit.', null=True, verbose_name='Memory limit'),
+        ),
+        migrations.AddField(
+            model_name='assignment',
+            name='limit_processes',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum number of processes the programs started by the test scripts may create. Leave empty for no limit.', null=True, verbose_name='Process limit'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opensubmit', '0037_assignment_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignment',
+            name='reuse_test_results',
+            field=models.BooleanField(default=False, help_text='Activate this to skip the validation / full test for uploads that are byte-identical to an already tested file, if the test script and the test machines did not change. The earlier result is copied instead.', verbose_name='Re-use test results ?'),
+        ),
+        migrations.AddField(
+            model_name='submissiontestresult',
+            name='error_code',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='submissiontestresult',
+            name='file_checksum',
+            field=models.CharField(blank=True, editable=False, max_length=36, null=True),
+        ),
+        migrations.AddField(
+            model_name='submissiontestresult',
+            name='validator_checksum',
+            field=models.CharField(blank=True, editable=False, max_length=36, null=True),
+        ),
+    ]
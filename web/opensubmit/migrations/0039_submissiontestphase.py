@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opensubmit', '0038_test_result_reuse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubmissionTestPhase',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('name', models.CharField(max_length=255)),
+                ('start', models.FloatField()),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('test_result', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='phases', to='opensubmit.SubmissionTestResult')),
+            ],
+            options={
+                'ordering': ['test_result', 'position'],
+            },
+        ),
+    ]
@@ -4,7 +4,7 @@ from .gradingscheme import GradingScheme
 from .testmachine import TestMachine
 from .submission import Submission
 from .submissionfile import SubmissionFile
-from .submissiontestresult import SubmissionTestResult
+from .submissiontestresult import SubmissionTestResult, SubmissionTestPhase
 from .assignment import Assignment
 from .userprofile import UserProfile
 from .studyprogram import StudyProgram
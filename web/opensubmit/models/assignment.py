@@ -4,7 +4,7 @@ from django.conf import settings
 from django.urls import reverse
 
 from .submission import Submission
-from .submissionfile import SubmissionFile
+from .submissionfile import SubmissionFile, file_checksum
 from .submissiontestresult import SubmissionTestResult
 
 import os
@@ -13,7 +13,6 @@ from itertools import groupby
 import logging
 logger = logging.getLogger('OpenSubmit')
 
-
 class Assignment(models.Model):
     '''
         An assignment for which students can submit their solution.
@@ -35,6 +34,11 @@ class Assignment(models.Model):
     attachment_test_full = models.FileField(upload_to="testscripts", blank=True, null=True, verbose_name='Full test script', help_text='Same as the validation script, but executed AFTER the hard deadline to determine final grading criterias for the submission. Results are not shown to students.')
     test_machines = models.ManyToManyField('TestMachine', blank=True, related_name="assignments", help_text="The test machines that will take care of submissions for this assignment.")
     max_authors = models.PositiveSmallIntegerField(default=1, help_text="Maximum number of authors (= group size) for this assignment.")
+    limit_cpu_time = models.PositiveIntegerField(blank=True, null=True, verbose_name="CPU time limit", help_text="Maximum CPU time (in seconds) for each program started by the test scripts. Leave empty for no limit.")
+    limit_memory = models.PositiveIntegerField(blank=True, null=True, verbose_name="Memory limit", help_text="Maximum memory usage (in MB) for the programs started by the test scripts. Leave empty for no limit.")
+    limit_processes = models.PositiveIntegerField(blank=True, null=True, verbose_name="Process limit", help_text="Maximum number of processes the programs started by the test scripts may create. Leave empty for no limit.")
+    limit_file_size = models.PositiveIntegerField(blank=True, null=True, verbose_name="File size limit", help_text="Maximum size (in MB) of files written by the programs started by the test scripts. Leave empty for no limit.")
+    reuse_test_results = models.BooleanField(default=False, verbose_name="Re-use test results ?", help_text="Activate this to skip the validation / full test for uploads that are byte-identical to an already tested file, if the test script and the test machines did not change. The earlier result is copied instead.")
 
     class Meta:
         app_label = 'opensubmit'
@@ -115,6 +119,24 @@ class Assignment(models.Model):
         else:
             return None
 
+    def validity_test_checksum(self):
+        '''
+            Return checksum of the validity test script, so that executors can cache it.
+        '''
+        if self.has_validity_test():
+            return file_checksum(self.attachment_test_validity.path)
+        else:
+            return None
+
+    def full_test_checksum(self):
+        '''
+            Return checksum of the full test script, so that executors can cache it.
+        '''
+        if self.has_full_test():
+            return file_checksum(self.attachment_test_full.path)
+        else:
+            return None
+
     def url(self, request):
         '''
             Return absolute URL for assignment description.
@@ -11,7 +11,7 @@ import tarfile
 from opensubmit import mails
 
 from .submissionfile import upload_path, SubmissionFile
-from .submissiontestresult import SubmissionTestResult
+from .submissiontestresult import SubmissionTestResult, SubmissionTestPhase
 
 import logging
 import shutil
@@ -504,15 +504,28 @@ class Submission(models.Model):
         # this implies that the Apache media serving is disabled
         return reverse('submission_grading_file', args=(self.pk,))
 
-    def _save_test_result(self, machine, text_student, text_tutor, kind, perf_data):
+    def _save_test_result(self, machine, text_student, text_tutor, kind, perf_data, error_code, phases):
+        if kind == SubmissionTestResult.VALIDITY_TEST:
+            validator_checksum = self.assignment.validity_test_checksum()
+        else:
+            validator_checksum = self.assignment.full_test_checksum()
         result = SubmissionTestResult(
             result=text_student,
             result_tutor=text_tutor,
             machine=machine,
             kind=kind,
             perf_data=perf_data,
+            error_code=error_code,
+            file_checksum=self.file_upload.attachment_checksum(),
+            validator_checksum=validator_checksum,
             submission_file=self.file_upload)
         result.save()
+        if phases:
+            SubmissionTestPhase.objects.bulk_create([
+                SubmissionTestPhase(test_result=result, position=position,
+                                    name=phase['phase'], start=phase['start'],
+                                    duration=phase['duration'])
+                for position, phase in enumerate(phases)])
 
     def _get_test_result(self, kind):
         try:
@@ -520,10 +533,46 @@ class Submission(models.Model):
         except:
             return None
 
+    def reusable_test_result(self):
+        '''
+            Return the most recent test result for a byte-identical upload in
+            this assignment, produced with the current test script on one of
+            the current test machines. Returns None if there is no such result,
+            or if the pending test is not eligible for re-use.
+        '''
+        if self.state == Submission.TEST_VALIDITY_PENDING:
+            kind = SubmissionTestResult.VALIDITY_TEST
+            validator_checksum = self.assignment.validity_test_checksum()
+        elif self.state == Submission.TEST_FULL_PENDING:
+            # Re-tests of closed submissions are explicitly requested, so they always run
+            kind = SubmissionTestResult.FULL_TEST
+            validator_checksum = self.assignment.full_test_checksum()
+        else:
+            return None
+        file_checksum = self.file_upload.attachment_checksum()
+        if not file_checksum or not validator_checksum:
+            return None
+        return SubmissionTestResult.objects.filter(
+            kind=kind,
+            file_checksum=file_checksum,
+            validator_checksum=validator_checksum,
+            error_code__isnull=False,
+            machine__in=self.assignment.test_machines.all(),
+            submission_file__submissions__assignment=self.assignment).order_by('-created').first()
+
     def save_fetch_date(self):
         SubmissionFile.objects.filter(
             pk=self.file_upload.pk).update(fetched=datetime.now())
 
+    def lease_for_testing(self):
+        '''
+        Atomically set the fetch date, unless some other executor was faster.
+
+        Returns True if the submission was leased.
+        '''
+        return SubmissionFile.objects.filter(
+            pk=self.file_upload.pk, fetched__isnull=True).update(fetched=datetime.now()) == 1
+
     def get_fetch_date(self):
         return self.file_upload.fetched
 
@@ -531,13 +580,13 @@ class Submission(models.Model):
         SubmissionFile.objects.filter(
             pk=self.file_upload.pk).update(fetched=None)
 
-    def save_validation_result(self, machine, text_student, text_tutor, perf_data=None):
+    def save_validation_result(self, machine, text_student, text_tutor, perf_data=None, error_code=None, phases=None):
         self._save_test_result(
-            machine, text_student, text_tutor, SubmissionTestResult.VALIDITY_TEST, perf_data)
+            machine, text_student, text_tutor, SubmissionTestResult.VALIDITY_TEST, perf_data, error_code, phases)
 
-    def save_fulltest_result(self, machine, text_tutor, perf_data=None):
+    def save_fulltest_result(self, machine, text_tutor, perf_data=None, error_code=None, phases=None):
         self._save_test_result(
-            machine, None, text_tutor, SubmissionTestResult.FULL_TEST, perf_data)
+            machine, None, text_tutor, SubmissionTestResult.FULL_TEST, perf_data, error_code, phases)
 
     def get_validation_result(self):
         '''
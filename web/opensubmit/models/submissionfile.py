@@ -9,10 +9,43 @@ import tarfile
 import unicodedata
 import os
 import hashlib
+import threading
+from collections import OrderedDict
 
 import logging
 logger = logging.getLogger('OpenSubmit')
 
+# Memoized file checksums, keyed by path, modification time and size,
+# the least recently used ones are dropped
+_checksums = OrderedDict()
+_checksums_lock = threading.Lock()
+CHECKSUM_CACHE_SIZE = 10000
+
+
+def file_checksum(path):
+    '''
+        Determine the MD5 checksum of the raw file content,
+        or None if the file is not available.
+    '''
+    try:
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+        with _checksums_lock:
+            if key in _checksums:
+                _checksums.move_to_end(key)
+                return _checksums[key]
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                md5.update(chunk)
+        with _checksums_lock:
+            _checksums[key] = md5.hexdigest()
+            while len(_checksums) > CHECKSUM_CACHE_SIZE:
+                _checksums.popitem(last=False)
+        return md5.hexdigest()
+    except (OSError, ValueError):
+        return None
+
 
 def upload_path(instance, filename):
     '''
@@ -116,6 +149,14 @@ class SubmissionFile(models.Model):
             ''.join(sorted(md5_set)).encode('utf-8')).hexdigest()
         return result
 
+    def attachment_checksum(self):
+        '''
+            Calculate the checksum of the raw file upload.
+            In contrast to the md5 field, this is suitable for detecting
+            transmission errors.
+        '''
+        return file_checksum(self.attachment.path)
+
     def basename(self):
         return self.attachment.name[self.attachment.name.rfind('/') + 1:]
 
@@ -126,6 +167,12 @@ class SubmissionFile(models.Model):
         assert(len(self.submissions.all()) > 0)
         return reverse('submission_attachment_file', args=(self.submissions.all()[0].pk,))
 
+    def executor_download_url(self, request):
+        '''
+            Return absolute download URL for executors, protected by the shared secret.
+        '''
+        return request.build_absolute_uri(reverse('submission_file_secret', args=[self.pk, settings.JOB_EXECUTOR_SECRET]))
+
     def get_preview_url(self):
         if self.submissions.all():
             return reverse('preview', args=(self.submissions.all()[0].pk,))
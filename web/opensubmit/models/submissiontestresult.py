@@ -17,7 +17,29 @@ class SubmissionTestResult(models.Model):
     result = models.TextField(null=True, blank=True)
     result_tutor = models.TextField(null=True, blank=True)
     kind = models.CharField(max_length=2, choices=JOB_TYPES)
+    # Resource usage of the executed programs, JSON as produced by the executor
     perf_data = models.TextField(null=True, blank=True)
+    # What was tested, for re-using the result with identical uploads
+    error_code = models.IntegerField(null=True, blank=True)
+    file_checksum = models.CharField(max_length=36, null=True, blank=True, editable=False)
+    validator_checksum = models.CharField(max_length=36, null=True, blank=True, editable=False)
 
     class Meta:
         app_label = 'opensubmit'
+
+
+class SubmissionTestPhase(models.Model):
+    '''
+        One phase of the executor job that produced a test result,
+        such as downloading, unpacking or running a program.
+    '''
+    test_result = models.ForeignKey('SubmissionTestResult', related_name="phases")
+    position = models.PositiveIntegerField()
+    name = models.CharField(max_length=255)
+    # Seconds since the job was fetched by the executor
+    start = models.FloatField()
+    duration = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        app_label = 'opensubmit'
+        ordering = ['test_result', 'position']
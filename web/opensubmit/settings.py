@@ -404,6 +404,8 @@ SOCIAL_AUTH_PIPELINE = (
 
 JOB_EXECUTOR_SECRET = config.get("executor", "SHARED_SECRET")
 assert(JOB_EXECUTOR_SECRET is not "")
+# Maximum time in seconds an executor request may wait for new jobs
+JOB_EXECUTOR_MAX_WAIT = int(config.get("executor", "MAX_WAIT") or 30)
 
 GRAPPELLI_ADMIN_TITLE = "OpenSubmit"
 GRAPPELLI_SWITCH_USER = True
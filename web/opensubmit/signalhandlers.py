@@ -4,6 +4,8 @@ from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.db import transaction
 
+import threading
+
 from .security import check_permission_system
 from .models import Submission, Course, SubmissionFile
 
@@ -12,6 +14,26 @@ from opensubmit.models import UserProfile
 import logging
 logger = logging.getLogger('OpenSubmit')
 
+# Wakes up executor requests waiting for new jobs in this process
+job_condition = threading.Condition()
+job_generation = 0
+
+
+def notify_new_job():
+    global job_generation
+    with job_condition:
+        job_generation += 1
+        job_condition.notify_all()
+
+
+def wait_for_new_job(generation, timeout):
+    '''
+        Wait until some submission became pending for testing after
+        the given job generation was determined, or the timeout passed.
+    '''
+    with job_condition:
+        return job_condition.wait_for(lambda: job_generation != generation, timeout)
+
 
 @receiver(user_logged_in)
 def post_user_login(sender, request, user, **kwargs):
@@ -67,6 +89,18 @@ def submission_post_save(sender, instance, **kwargs):
                 subm.save()
 
 
+@receiver(post_save, sender=Submission)
+def submission_pending_post_save(sender, instance, **kwargs):
+    '''
+        Wake up waiting executor requests when a submission needs testing.
+    '''
+    if instance.state in [Submission.TEST_VALIDITY_PENDING,
+                          Submission.TEST_FULL_PENDING,
+                          Submission.CLOSED_TEST_FULL_PENDING]:
+        # The new state must be visible for the woken up requests
+        transaction.on_commit(notify_new_job)
+
+
 @receiver(post_save, sender=Course)
 def course_post_save(sender, instance, **kwargs):
     '''
@@ -12,11 +12,22 @@ Missing tests:
 import os
 import os.path
 import sys
+import re
+import glob
+import json
+import time
+import signal
+import subprocess
+import tempfile
+import threading
 import logging
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.error import URLError
 
 from django.core import mail
 from django.conf import settings
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.core.management import call_command
 from django.test.utils import override_settings
 from opensubmit.tests.cases import SubmitStudentScenarioTestCase
 from django.core.urlresolvers import reverse
@@ -34,7 +45,7 @@ from .helpers.user import create_user, get_student_dict
 from . import uccrap, rootdir
 
 sys.path.insert(0, os.path.dirname(__file__) + '/../../../executor/')
-from opensubmitexec import config, cmdline, server, locking, compiler, exceptions  # NOQA
+from opensubmitexec import config, cmdline, server, locking, compiler, exceptions, connection, spool, running, limits, filesystem  # NOQA
 
 logger = logging.getLogger('opensubmitexec')
 
@@ -63,6 +74,526 @@ class CmdLine(TestCase):
         with locking.ScriptLock(self.config):
             cmdline.console_script()
 
+    def test_bench(self):
+        fname = tempfile.mkstemp(suffix='.json')[1]
+        examples = rootdir + '../../../examples/helloworld'
+        argv = ['opensubmit-exec', 'bench', examples, '-n', '3', '-s', '5x10', '-o', fname]
+        self.assertTrue(cmdline.run_bench(self.config, argv))
+        with open(fname) as f:
+            report = json.load(f)
+        self.assertEqual({'passed': 3}, report['cases']['helloworld']['results'])
+        self.assertEqual({'passed': 3}, report['cases']['synthetic-5files-10KB']['results'])
+        self.assertIn('unpack submission', report['cases']['synthetic-5files-10KB']['phases'])
+        self.assertEqual(6, report['total']['jobs'])
+
+    def test_poll_loop_survives_errors(self):
+        import socket
+        self.config.set("Execution", "poll_interval", "1")
+        stop = threading.Event()
+        calls = []
+
+        def fetch_job(config, wait=0):
+            calls.append(wait)
+            if len(calls) == 1:
+                raise socket.timeout("timed out")
+            stop.set()
+            return None
+
+        old_fetch_job = cmdline.fetch_job
+        cmdline.fetch_job = fetch_job
+        try:
+            cmdline.poll_loop(self.config, stop)
+        finally:
+            cmdline.fetch_job = old_fetch_job
+        self.assertEqual(2, len(calls))
+
+    def test_requeue_jobs_of_dead_slot(self):
+        import multiprocessing
+        jobs = multiprocessing.Queue()
+        jobs.put({'SubmissionFileId': '1'})
+        jobs.put({'SubmissionFileId': '2'})
+        time.sleep(0.5)
+        fresh, count = cmdline.requeue(jobs)
+        self.assertEqual(2, count)
+        self.assertEqual('1', fresh.get(timeout=1)['SubmissionFileId'])
+        self.assertEqual('2', fresh.get(timeout=1)['SubmissionFileId'])
+
+    def test_fakeserver(self):
+        from opensubmitexec.fakeserver import create_fake_server
+        fake = create_fake_server(rootdir + '../../../examples/helloworld', jobs=3)
+        self.config.set('Server', 'url', fake.start())
+        try:
+            # First contact registers the machine
+            self.assertFalse(cmdline.download_and_run(self.config))
+            self.assertIn(self.config.get('Server', 'uuid'), fake.machines)
+            self.assertTrue(cmdline.download_and_run(self.config))
+            descriptions = server.lease_jobs(self.config, 5)
+            self.assertEqual(2, len(descriptions))
+            for description in descriptions:
+                server.fetch_leased_job(self.config, description)._run_validate()
+            # Budget is exhausted
+            self.assertFalse(cmdline.download_and_run(self.config))
+            self.assertTrue(fake.wait_for_results(3, 10))
+        finally:
+            fake.stop()
+        summary = fake.summary()
+        self.assertEqual(3, summary['jobs'])
+        self.assertEqual({'passed': 3}, summary['outcomes'])
+        self.assertEqual(0, summary['missing'])
+        self.assertEqual(0, summary['duplicates'])
+
+
+class Locking(TestCase):
+    '''
+    Test cases for the coordination of parallel jobs.
+    '''
+    def setUp(self):
+        self.config = config.read_config(
+            os.path.dirname(__file__) + "/executor.cfg")
+
+    def test_exclusive_waits_for_other_jobs(self):
+        other_job = locking.SlotLock(self.config).__enter__()
+        exclusive_job = locking.SlotLock(self.config)
+        with exclusive_job:
+            waiting = threading.Thread(target=exclusive_job.make_exclusive)
+            waiting.start()
+            waiting.join(1)
+            self.assertTrue(waiting.is_alive())
+            other_job.__exit__(None, None, None)
+            waiting.join(5)
+            self.assertFalse(waiting.is_alive())
+            self.assertTrue(exclusive_job.exclusive)
+        self.assertFalse(exclusive_job.exclusive)
+
+
+class BrokenDownloadHandler(BaseHTTPRequestHandler):
+    '''
+    Announces a chunk of 4096 bytes, but closes the connection after 100.
+    '''
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.write(b'1000\r\n' + b'x' * 100)
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Connection(TestCase):
+    '''
+    Tests for the HTTP connections to the server.
+    '''
+    def setUp(self):
+        self.config = config.read_config(
+            os.path.dirname(__file__) + "/executor.cfg")
+        self.server = HTTPServer(('127.0.0.1', 0), BrokenDownloadHandler)
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _test_broken_download(self, pooling):
+        self.config.set("Server", "pooling", pooling)
+        response = connection.get(self.config, self.url)
+        with self.assertRaises(URLError):
+            for chunk in response.iter_chunks(65536):
+                pass
+        response.close()
+        response = connection.get(self.config, self.url)
+        with self.assertRaises(URLError):
+            response.read()
+        response.close()
+
+    def test_broken_download(self):
+        self._test_broken_download("True")
+
+    def test_broken_download_without_pooling(self):
+        self._test_broken_download("False")
+
+
+class Unpacking(TestCase):
+    '''
+    Tests for the extraction of submission archives.
+    '''
+    def setUp(self):
+        self.config = config.read_config(
+            os.path.dirname(__file__) + "/executor.cfg")
+        self.directory = tempfile.mkdtemp() + os.sep
+
+    def _create_zip(self, entries):
+        import zipfile
+        fname = tempfile.mkstemp(suffix='.zip')[1]
+        with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, data in entries:
+                archive.writestr(name, data)
+        return fname
+
+    def test_single_dir(self):
+        fname = self._create_zip([('top/', ''), ('top/sub/a.c', 'x'), ('top/sub/b.c', 'y')])
+        self.assertEqual(('top/sub', True), filesystem.unpack_if_needed(self.directory, fname, self.config))
+        self.assertTrue(os.path.exists(self.directory + 'top/sub/b.c'))
+        fname = self._create_zip([('top/a.c', 'x'), ('b.c', 'y')])
+        self.assertEqual((None, True), filesystem.unpack_if_needed(self.directory, fname, self.config))
+
+    def test_path_traversal(self):
+        fname = self._create_zip([('../evil.c', 'x')])
+        with self.assertRaises(exceptions.JobException):
+            filesystem.unpack_if_needed(self.directory, fname, self.config)
+        self.assertFalse(os.path.exists(os.path.dirname(self.directory[:-1]) + '/evil.c'))
+
+    def test_archive_bomb(self):
+        fname = self._create_zip([('zeros', '0' * 10 * 1024 * 1024)])
+        with self.assertRaises(exceptions.JobException):
+            filesystem.unpack_if_needed(self.directory, fname, self.config)
+        # Stopped early, not after unpacking everything
+        self.assertLess(os.path.getsize(self.directory + 'zeros'), 10 * 1024 * 1024)
+
+    def _template_job(self):
+        from opensubmitexec.job import Job
+        job = Job(self.config, online=False)
+        job.validator_hash = str(time.time())
+        job.working_dir = tempfile.mkdtemp() + os.sep
+        return job
+
+    def test_validator_template(self):
+        self.config.set("Execution", "cache_dir", tempfile.mkdtemp())
+        validator = self._create_zip([('validator.py', 'x'), ('data/ref.txt', 'reference')])
+        jobs = [self._template_job(), self._template_job()]
+        for job in jobs:
+            template = filesystem.validator_template(job, validator)
+            filesystem.populate_from_template(self.config, template, job.working_dir)
+        # Changes stay private to the job
+        with open(jobs[0].working_dir + 'data/ref.txt', 'w') as f:
+            f.write('changed')
+        with open(jobs[1].working_dir + 'data/ref.txt') as f:
+            self.assertEqual('reference', f.read())
+        self.assertTrue(os.path.exists(jobs[1].working_dir + 'validator.py'))
+
+    def test_validator_template_hardlinks(self):
+        self.config.set("Execution", "cache_dir", tempfile.mkdtemp())
+        self.config.set("Execution", "validator_template_hardlinks", "True")
+        validator = self._create_zip([('validator.py', 'x')])
+        job = self._template_job()
+        template = filesystem.validator_template(job, validator)
+        filesystem.populate_from_template(self.config, template, job.working_dir)
+        stat = os.stat(job.working_dir + 'validator.py')
+        if stat.st_nlink > 1:
+            self.assertFalse(stat.st_mode & 0o222)
+        else:
+            # Cloned instead
+            self.assertTrue(stat.st_mode & 0o200)
+
+    def test_validator_without_archive_limits(self):
+        self.config.set("Execution", "max_archive_entries", "1")
+        validator = self._create_zip([('validator.py', 'x'), ('zeros', '0' * 10 * 1024 * 1024)])
+        filesystem.unpack_validator(self._template_job(), self.directory, validator)
+        self.assertEqual(10 * 1024 * 1024, os.path.getsize(self.directory + 'zeros'))
+
+    def test_entry_limit(self):
+        self.config.set("Execution", "max_archive_entries", "10")
+        fname = self._create_zip([('file{0}'.format(i), 'x') for i in range(11)])
+        with self.assertRaises(exceptions.JobException):
+            filesystem.unpack_if_needed(self.directory, fname, self.config)
+
+
+class Running(TestCase):
+    '''
+    Tests for the program execution helpers.
+    '''
+
+    def setUp(self):
+        self.config = config.read_config(
+            os.path.dirname(__file__) + "/executor.cfg")
+
+    def _create_job(self):
+        from opensubmitexec.job import Job
+        job = Job(self.config, online=False)
+        job.working_dir = tempfile.mkdtemp() + os.sep
+        return job
+
+    def test_file_size_limit(self):
+        job = self._create_job()
+        job.limit_file_size = 1
+        job.run_program('dd', ['if=/dev/zero', 'of=big', 'bs=1M', 'count=3'])
+        self.assertLessEqual(os.path.getsize(job.working_dir + 'big'), 1024 * 1024)
+        job._processes.close()
+
+    def test_kill_job_programs(self):
+        job = self._create_job()
+        running = job.spawn_program('sh', ['-c', 'sleep 60 & echo "pid=$!"; wait'])
+        running.expect_output('pid=([0-9]+)')
+        pid = int(running._spawn.match.group(1))
+        job._processes.close()
+        # Killed, maybe not yet reaped by init
+        time.sleep(0.5)
+        try:
+            with open('/proc/{0}/stat'.format(pid)) as f:
+                self.assertEqual('Z', f.read().split()[2])
+        except FileNotFoundError:
+            pass
+
+    def test_preempt_other_jobs(self):
+        victim = self._create_job()
+        running = victim.spawn_program('sleep', ['60'])
+        exclusive = self._create_job()
+        self.assertEqual(1, limits.preempt_jobs(self.config, exclusive._job_processes().name))
+        self.assertTrue(victim._processes.preempted())
+        self.assertFalse(exclusive._processes.preempted())
+        exit_status, output = running.expect_end()
+        self.assertEqual(None, exit_status)
+        # No new programs after pre-emption
+        with self.assertRaises(exceptions.TerminationException):
+            victim.run_program('true')
+        victim._processes.close()
+        exclusive._processes.close()
+        registry = os.listdir(limits.registry_dir(self.config))
+        self.assertNotIn(victim._processes.name, registry)
+        self.assertNotIn(victim._processes.name + '.preempted', registry)
+
+    def _validator_job(self, script, validator_hash=None):
+        job = self._create_job()
+        job.validator_hash = validator_hash
+        with open(job.validator_script_name, 'w') as f:
+            f.write(script)
+        job.results = []
+        job._send_result = lambda student, tutor, code: job.results.append(tutor)
+        return job
+
+    def test_forked_validator_crash(self):
+        job = self._validator_job(
+            "import os, signal\n"
+            "def validate(job):\n"
+            "    os.kill(os.getpid(), signal.SIGKILL)\n")
+        job._run_validate()
+        self.assertEqual(1, len(job.results))
+        self.assertIn("signal 9", job.results[0])
+
+    def test_forked_validator_exit(self):
+        job = self._validator_job(
+            "import sys\n"
+            "def validate(job):\n"
+            "    sys.exit(3)\n")
+        # Ends with an error result, not with the executor
+        job._run_validate()
+        self.assertEqual(1, len(job.results))
+        self.assertIn("exit status 3", job.results[0])
+
+    def test_forked_validator_module_cache(self):
+        marker = tempfile.mkdtemp() + os.sep + 'imports'
+        script = ("with open({0}, 'a') as f:\n"
+                  "    f.write('x')\n"
+                  "def validate(job):\n"
+                  "    open(job.working_dir + 'validated', 'w').close()\n").format(repr(marker))
+        validator_hash = str(time.time())
+        self.config.set("Execution", "cleanup", "False")
+        jobs = [self._validator_job(script, validator_hash) for i in range(3)]
+        imports = []
+        for job in jobs:
+            job._run_validate()
+            self.assertTrue(job.result_sent)
+            self.assertTrue(os.path.exists(job.working_dir + 'validated'))
+            imports.append(os.path.getsize(marker))
+        # Tried in the first child, then imported once in this process
+        self.assertLess(imports[0], imports[1])
+        self.assertEqual(imports[1], imports[2])
+
+    def test_forked_validator_exit_on_import(self):
+        from opensubmitexec import internaljob
+        script = ("import sys\n"
+                  "sys.exit()\n"
+                  "def validate(job):\n"
+                  "    pass\n")
+        validator_hash = str(time.time())
+        job = self._validator_job(script, validator_hash)
+        job._run_validate()
+        self.assertEqual(1, len(job.results))
+        self.assertIn("exit status 0", job.results[0])
+        self.assertNotIn(validator_hash, internaljob._importable_validators)
+        # Also no exit if the import in this process fails later on
+        internaljob._importable_validators.add(validator_hash)
+        job = self._validator_job(script, validator_hash)
+        job._run_validate()
+        self.assertEqual(1, len(job.results))
+        self.assertIn("Exception while loading the validator", job.results[0])
+
+    def test_grep_many(self):
+        job = self._create_job()
+        files = {'a.c': b'int main() {\n  for(;;) {}\n  for(;;) {}\n}\n',
+                 'b.c': b'while(1);\n',
+                 'data.bin': b'for\0',
+                 'empty.c': b''}
+        for fname, content in files.items():
+            with open(job.working_dir + fname, 'wb') as f:
+                f.write(content)
+        job.student_files = sorted(files.keys())
+        result = job.grep_many(['for', '^while', 'goto'])
+        self.assertEqual({'a.c': [2, 3]}, result['for'])
+        self.assertEqual({'b.c': [1]}, result['^while'])
+        self.assertEqual({}, result['goto'])
+        # No matches across lines
+        result = job.grep_many([r'{\s*for', r'{\s*}', r';$\s'])
+        self.assertEqual({}, result[r'{\s*for'])
+        self.assertEqual({'a.c': [2, 3]}, result[r'{\s*}'])
+        self.assertEqual({}, result[r';$\s'])
+        self.assertEqual({}, job.grep_many(['for'], max_size=10)['for'])
+        # Binary files are scanned by the old API
+        self.assertEqual(['a.c', 'a.c', 'data.bin'], job.grep('for'))
+
+    def test_build_cache(self):
+        # Unique source, so that earlier test runs give no cache hit
+        source = '#include <stdio.h>\nint main() {{ puts("{0}"); return 0; }}\n'.format(time.time())
+        jobs = [self._create_job(), self._create_job()]
+        for job in jobs:
+            with open(job.working_dir + 'hello.c', 'w') as f:
+                f.write(source)
+            job.run_compiler(inputs=['hello.c'], output='hello')
+            exit_status, output = job.run_program('./hello')
+            self.assertEqual(0, exit_status)
+            job._processes.close()
+        self.assertEqual((0, 1), (jobs[0]._build_hits, jobs[0]._build_misses))
+        self.assertEqual((1, 0), (jobs[1]._build_hits, jobs[1]._build_misses))
+
+    def test_build_cache_rejects_links(self):
+        # A cached build must not place links to other places into the working directory
+        import io
+        import tarfile
+        from opensubmitexec import compiler
+        from opensubmitexec.cache import FileCache
+        cache = FileCache(tempfile.mkdtemp(), 1024 * 1024)
+        directory = tempfile.mkdtemp()
+        fd, fname = tempfile.mkstemp(suffix='.tar')
+        os.close(fd)
+        with tarfile.open(fname, 'w') as tar:
+            info = tarfile.TarInfo('hello')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '/etc/passwd'
+            tar.addfile(info)
+        cache.put('evil', fname)
+        self.assertFalse(compiler.restore_build(cache, 'evil', directory))
+        self.assertFalse(os.path.lexists(os.path.join(directory, 'hello')))
+        outside = '../' + os.path.basename(directory) + '.evil'
+        with tarfile.open(fname, 'w') as tar:
+            info = tarfile.TarInfo(outside)
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b'x'))
+        cache.put('evil', fname)
+        self.assertFalse(compiler.restore_build(cache, 'evil', directory))
+        self.assertFalse(os.path.lexists(os.path.join(directory, outside)))
+        os.remove(fname)
+
+    def test_measure_program(self):
+        job = self._create_job()
+        script = 'grep Cpus_allowed_list /proc/self/status >> cpus.txt'
+        summary = job.measure_program('sh', ['-c', script], repetitions=3, warmup=2, cpu_affinity=[0])
+        job._processes.close()
+        self.assertEqual([0], summary['cpus'])
+        for key in ['wall_time', 'cpu_time', 'max_rss']:
+            stats = summary[key]
+            self.assertLessEqual(stats['min'], stats['median'])
+            self.assertLessEqual(stats['median'], stats['max'])
+            self.assertGreaterEqual(stats['stddev'], 0)
+        self.assertGreater(summary['wall_time']['min'], 0)
+        with open(job.working_dir + 'cpus.txt') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(5, len(lines))
+        for line in lines:
+            self.assertEqual('0', line.split()[-1])
+        perf_data = json.loads(job._perf_data())
+        self.assertEqual(summary, perf_data['measurements'][0])
+        self.assertEqual(5, len(perf_data['programs']))
+
+    def test_measure_program_per_run(self):
+        # The runs of a small program must not get the peak of a big one before
+        job = self._create_job()
+        big = job.measure_program('python3', ['-c', 'data = b"x" * (200 * 1024 * 1024)'],
+                                  repetitions=2, warmup=0)
+        small = job.measure_program('true', repetitions=3, warmup=1)
+        job._processes.close()
+        self.assertGreater(big['max_rss']['min'], 200 * 1024)
+        self.assertLess(small['max_rss']['max'], big['max_rss']['min'] / 2)
+        self.assertLess(small['cpu_time']['max'], big['cpu_time']['min'])
+
+    def test_measure_program_exit_status(self):
+        job = self._create_job()
+        with self.assertRaises(exceptions.WrongExitStatusException):
+            job.measure_program('false', repetitions=2)
+        job._processes.close()
+        self.assertNotIn('measurements', json.loads(job._perf_data()))
+
+    def test_build_cache_single_file_submission(self):
+        # The submission file itself is the source
+        outputs = []
+        for text in ['first', 'second']:
+            job = self._create_job()
+            job.file_name = 'hello.c'
+            job.student_files = ['hello.c']
+            with open(job.working_dir + 'hello.c', 'w') as f:
+                f.write('#include <stdio.h>\nint main() {{ puts("{0}{1}"); return 0; }}\n'.format(
+                    text, time.time()))
+            job.run_compiler(inputs=['hello.c'], output='hello')
+            outputs.append(job.run_program('./hello')[1])
+            job._processes.close()
+        self.assertNotEqual(outputs[0], outputs[1])
+
+    def test_hostinfo_cache(self):
+        from opensubmitexec import hostinfo
+        self.config.set("Execution", "cache_dir", tempfile.mkdtemp())
+        infos = hostinfo.all_host_infos(self.config)
+        self.assertEqual("Operating system", infos[0][0])
+        # Second call is answered from the cache
+        fname = hostinfo._cache_file(self.config)
+        with open(fname) as f:
+            cached = json.load(f)
+        cached['infos'][0][1] = 'cached'
+        with open(fname, 'w') as f:
+            json.dump(cached, f)
+        self.assertEqual('cached', hostinfo.all_host_infos(self.config)[0][1])
+        # Updated software invalidates the cache
+        cached['stamps']['cc'] = 0
+        with open(fname, 'w') as f:
+            json.dump(cached, f)
+        self.assertNotEqual('cached', hostinfo.all_host_infos(self.config)[0][1])
+
+    def test_hostinfo_timeout(self):
+        from opensubmitexec import hostinfo
+        start = time.time()
+        self.assertEqual("", hostinfo.from_cmd("sleep 10", 0.5))
+        self.assertLess(time.time() - start, 5)
+
+    def test_hostinfo_hanging_probe(self):
+        from opensubmitexec import hostinfo
+        script = ("import time\n"
+                  "from opensubmitexec import hostinfo\n"
+                  "probes = [('Fast', lambda: 'fast', []), ('Hanging', lambda: time.sleep(60), [])]\n"
+                  "print(hostinfo._run_probes(probes, 0))\n")
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(hostinfo.__file__)))
+        start = time.time()
+        # The hanging probe does not delay the end of the process
+        output = subprocess.check_output([sys.executable, '-c', script], env=env, timeout=30)
+        self.assertLess(time.time() - start, 10)
+        self.assertIn(b"[['Fast', 'fast'], ['Hanging', '']]", output)
+
+    def test_output_buffer(self):
+        output = running.OutputBuffer(12)
+        output.write(b"Hello")
+        output.write(b" World")
+        self.assertEqual("Hello World", output.text())
+        for i in range(100):
+            output.write(b"0123456789")
+        self.assertEqual("Hello \n[... 999 bytes of output dropped ...]\n456789", output.text())
+
+    def test_output_buffer_unlimited(self):
+        output = running.OutputBuffer(0)
+        output.write(b"x" * 100000)
+        self.assertEqual(100000, len(output.text()))
+
 
 class Library(SubmitStudentScenarioTestCase):
     '''
@@ -100,6 +631,107 @@ class Library(SubmitStudentScenarioTestCase):
 
         self.assertEqual(db_entries[0].result, msg)
 
+    def test_perf_data(self):
+        sf = create_submission_file()
+        sub = create_validatable_submission(
+            self.user, self.validated_assignment, sf)
+        test_machine = self._register_executor()
+        sub.assignment.test_machines.add(test_machine)
+        # The compiler must really run
+        self.config.set("Execution", "build_cache_size", "0")
+        self.assertEqual(True, self._run_executor())
+        result = sub.get_validation_result()
+        perf_data = json.loads(result.perf_data)
+        self.assertEqual(1, perf_data['version'])
+        self.assertGreater(len(perf_data['programs']), 0)
+        for program in perf_data['programs']:
+            self.assertGreater(program['wall_time'], 0)
+            self.assertGreater(program['max_rss'], 0)
+            self.assertIn('user_time', program)
+        self.assertTrue(self.validated_assignment.has_perf_results())
+
+    def test_perf_data_per_program(self):
+        # A small program after a big one must not get the peak of the big one
+        from opensubmitexec.job import Job
+        job = Job(self.config, online=False)
+        job.working_dir = tempfile.mkdtemp() + os.sep
+        job.run_program('python3', ['-c', 'data = b"x" * (200 * 1024 * 1024)'])
+        job.run_program('true')
+        job._processes.close()
+        big, small = json.loads(job._perf_data())['programs']
+        self.assertGreater(big['max_rss'], 200 * 1024)
+        # Linux counts the forked executor process before exec() too
+        self.assertLess(small['max_rss'], big['max_rss'] / 2)
+        self.assertLess(small['user_time'], big['user_time'])
+
+    def test_timeline(self):
+        from opensubmit.admin.submission import SubmissionAdmin
+        sf = create_submission_file()
+        sub = create_validatable_submission(
+            self.user, self.validated_assignment, sf)
+        test_machine = self._register_executor()
+        sub.assignment.test_machines.add(test_machine)
+        self.config.set("Execution", "build_cache_size", "0")
+        self.assertEqual(True, self._run_executor())
+        result = sub.get_validation_result()
+        names = [phase.name for phase in result.phases.all()]
+        for name in ['fetch', 'download submission', 'download validator', 'unpack submission',
+                     'unpack validator', 'import validator', 'send result']:
+            self.assertIn(name, names)
+        self.assertTrue([name for name in names if name.startswith('run ')])
+        self.assertEqual('send result', names[-1])
+        self.assertIsNotNone(result.phases.last().duration)
+        html = SubmissionAdmin(Submission, None).validationtest_result_tutor(sub)
+        self.assertIn('unpack submission', html)
+
+    def test_metrics(self):
+        from opensubmitexec import metrics
+        sf = create_submission_file()
+        sub = create_validatable_submission(
+            self.user, self.validated_assignment, sf)
+        test_machine = self._register_executor()
+        sub.assignment.test_machines.add(test_machine)
+        directory = tempfile.mkdtemp()
+        self.config.set("Execution", "cache_dir", directory)
+        self.config.set("Execution", "metrics_file", directory + "/executor.prom")
+        self.assertEqual(True, self._run_executor())
+        with open(directory + "/executor.prom") as f:
+            text = f.read()
+        self.assertEqual(metrics.render(self.config), text)
+        self.assertIn('opensubmit_executor_jobs_fetched_total{action="test_validity"} 1', text)
+        self.assertIn('opensubmit_executor_jobs_finished_total{action="test_validity",result="passed"} 1', text)
+        self.assertIn('opensubmit_executor_polls_total{outcome="job"} 1', text)
+        self.assertIn('opensubmit_executor_slots_busy 0', text)
+        for phase in ['download', 'unpack', 'validate', 'report']:
+            self.assertIn('opensubmit_executor_phase_seconds_count{{phase="{0}"}} 1'.format(phase), text)
+
+    def test_spooled_result(self):
+        sf = create_submission_file()
+        sub = create_validatable_submission(
+            self.user, self.validated_assignment, sf)
+        test_machine = self._register_executor()
+        sub.assignment.test_machines.add(test_machine)
+        self.config.set("Execution", "spool_dir", tempfile.mkdtemp())
+        self.config.set("Server", "retries", "1")
+        self.config.set("Server", "retry_delay", "0.1")
+
+        job = server.fetch_job(self.config)
+        self.assertNotEquals(None, job)
+
+        # Server down while the result is sent
+        server_url = self.config.get("Server", "url")
+        self.config.set("Server", "url", "http://localhost:1")
+        job.send_pass_result()
+        job.send_pass_result()
+        self.assertEqual(1, len(os.listdir(self.config.get("Execution", "spool_dir"))))
+        self.assertEqual(0, SubmissionTestResult.objects.count())
+
+        self.config.set("Server", "url", server_url)
+        self.assertEqual(0, spool.replay_spool(self.config))
+        self.assertEqual([], os.listdir(self.config.get("Execution", "spool_dir")))
+        self.assertEqual(1, SubmissionTestResult.objects.filter(
+            kind=SubmissionTestResult.VALIDITY_TEST).count())
+
     def test_fetch_job_renaming(self):
         test_machine = self._register_executor()
         self.validated_assignment.test_machines.add(test_machine)
@@ -123,6 +755,31 @@ class Library(SubmitStudentScenarioTestCase):
         self.assertListEqual(job.grep("World"), ['helloworld.c'])
         self.assertListEqual(job.grep("foobar"), [])
 
+    def test_validator_cache(self):
+        sf = create_submission_file()
+        sub = create_validatable_submission(
+            self.user, self.validated_assignment, sf)
+        test_machine = self._register_executor()
+        sub.assignment.test_machines.add(test_machine)
+        job = server.fetch_job(self.config)
+        self.assertNotEquals(None, job)
+        self.assertEqual(job.validator_hash,
+                         self.validated_assignment.validity_test_checksum())
+        cache_dir = self.config.get("Execution", "cache_dir") + 'validators'
+        self.assertIn(job.validator_hash, os.listdir(cache_dir))
+
+    def test_submission_size_limit(self):
+        sf = create_submission_file()
+        sub = create_validatable_submission(
+            self.user, self.validated_assignment, sf)
+        test_machine = self._register_executor()
+        sub.assignment.test_machines.add(test_machine)
+        self.config.set("Execution", "max_submission_size", "0.00001")
+        self.assertEqual(None, server.fetch_job(self.config))
+        sub.refresh_from_db()
+        self.assertEqual(sub.state, Submission.TEST_VALIDITY_FAILED)
+        self.assertIn("too large", sub.get_validation_result().result)
+
     def test_ensure_files(self):
         sf = create_submission_file()
         sub = create_validatable_submission(
@@ -289,7 +946,7 @@ class Communication(SubmitStudentScenarioTestCase):
     def _run_executor(self):
         return cmdline.download_and_run(self.config)
 
-    def _register_test_machine(self):
+    def _register_test_machine(self, user=None):
         '''
         Utility step for a common test case preparation:
         - Create validatable submission
@@ -297,11 +954,204 @@ class Communication(SubmitStudentScenarioTestCase):
         '''
         sf = create_submission_file()
         sub = create_validatable_submission(
-            self.user, self.validated_assignment, sf)
+            user or self.user, self.validated_assignment, sf)
         test_machine = self._register_executor()
         sub.assignment.test_machines.add(test_machine)
         return sub
 
+    def test_daemon_mode(self):
+        sub = self._register_test_machine()
+        old_handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+        # Stop the daemon after it had some time for fetching jobs
+        threading.Timer(5, os.kill, [os.getpid(), signal.SIGTERM]).start()
+        cmdline.run_daemon(self.config)
+        signal.signal(signal.SIGTERM, old_handlers[0])
+        signal.signal(signal.SIGINT, old_handlers[1])
+        results = SubmissionTestResult.objects.filter(
+            submission_file=sub.file_upload,
+            kind=SubmissionTestResult.VALIDITY_TEST
+        )
+        self.assertEqual(1, len(results))
+
+    def test_daemon_mode_with_slots(self):
+        sub = self._register_test_machine()
+        self.config.set("Execution", "slots", "2")
+        old_handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+        threading.Timer(5, os.kill, [os.getpid(), signal.SIGTERM]).start()
+        cmdline.run_daemon(self.config)
+        signal.signal(signal.SIGTERM, old_handlers[0])
+        signal.signal(signal.SIGINT, old_handlers[1])
+        results = SubmissionTestResult.objects.filter(
+            submission_file=sub.file_upload,
+            kind=SubmissionTestResult.VALIDITY_TEST
+        )
+        self.assertEqual(1, len(results))
+
+    def test_daemon_mode_with_batch_leasing(self):
+        # New submissions of the same user withdraw the older ones
+        subs = [self._register_test_machine(create_user(get_student_dict(10 + index)))
+                for index in range(3)]
+        self.config.set("Execution", "slots", "2")
+        self.config.set("Execution", "batch_leasing", "True")
+        old_handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+        threading.Timer(10, os.kill, [os.getpid(), signal.SIGTERM]).start()
+        cmdline.run_daemon(self.config)
+        signal.signal(signal.SIGTERM, old_handlers[0])
+        signal.signal(signal.SIGINT, old_handlers[1])
+        for sub in subs:
+            results = SubmissionTestResult.objects.filter(
+                submission_file=sub.file_upload,
+                kind=SubmissionTestResult.VALIDITY_TEST
+            )
+            self.assertEqual(1, len(results))
+
+    def test_lease_jobs(self):
+        self._register_test_machine(create_user(get_student_dict(10)))
+        self._register_test_machine(create_user(get_student_dict(11)))
+        jobs = server.lease_jobs(self.config, 5)
+        self.assertEqual(2, len(jobs))
+        self.assertNotEqual(jobs[0]['SubmissionId'], jobs[1]['SubmissionId'])
+        # Leased jobs are not handed out again
+        self.assertEqual([], server.lease_jobs(self.config, 5))
+        self.assertEqual(None, server.fetch_job(self.config))
+        job = server.fetch_leased_job(self.config, jobs[0])
+        self.assertIsNotNone(job)
+        job._run_validate()
+        sub = Submission.objects.get(pk=int(jobs[0]['SubmissionId']))
+        self.assertEqual(1, len(sub.file_upload.test_results.all()))
+
+    def test_leased_job_with_failing_download(self):
+        sub = self._register_test_machine()
+        description = server.lease_jobs(self.config, 1)[0]
+        description['PostRunValidation'] = self.live_server_url + '/download/0/missing/'
+        description.pop('ValidatorHash', None)
+        pattern = self.config.get("Execution", "directory") + description['SubmissionId'] + '_*'
+        before = set(glob.glob(pattern))
+        self.assertEqual(None, server.fetch_leased_job(self.config, description))
+        # No working directory left behind
+        self.assertEqual(before, set(glob.glob(pattern)))
+        # Given back to the server, for another try
+        sub.refresh_from_db()
+        self.assertEqual(None, sub.get_fetch_date())
+        self.assertEqual(0, len(sub.file_upload.test_results.all()))
+
+    def test_preempted_job_is_handed_out_again(self):
+        sub = self._register_test_machine()
+        job = server.fetch_job(self.config)
+        self.assertTrue(server.supports_retry(job.api_version))
+        self.assertEqual(None, server.fetch_job(self.config))
+        running = job.spawn_program('sleep', ['60'])
+        self.assertEqual(1, limits.preempt_jobs(self.config, 'exclusive'))
+        running.expect_end()
+        job._send_result("Killed", "Killed", 1)
+        job._processes.close()
+        sub.refresh_from_db()
+        self.assertEqual(None, sub.get_fetch_date())
+        self.assertEqual(Submission.TEST_VALIDITY_PENDING, sub.state)
+        self.assertEqual(0, len(sub.file_upload.test_results.all()))
+        job = server.fetch_job(self.config)
+        self.assertEqual(str(sub.file_upload.pk), job.file_id)
+
+    def test_no_preemption_with_old_server(self):
+        from opensubmitexec.job import Job
+        self.config.set("Execution", "preempt_after", "1")
+        calls = []
+
+        class Lock():
+            def make_exclusive(self, preempt_after, preempt):
+                calls.append(preempt_after)
+
+        job = Job(self.config)
+        job._slot_lock = Lock()
+        job.api_version = '1.1.0'
+        job._make_exclusive()
+        job.api_version = '1.2.0'
+        job._make_exclusive()
+        self.assertEqual([0, 1], calls)
+
+    def test_reuse_test_results(self):
+        self.validated_assignment.reuse_test_results = True
+        self.validated_assignment.save()
+        first = self._register_test_machine(create_user(get_student_dict(10)))
+        self.assertEqual(True, self._run_executor())
+        # Byte-identical upload by another student
+        second = create_validatable_submission(
+            create_user(get_student_dict(11)), self.validated_assignment, create_submission_file())
+        job = server.fetch_job(self.config)
+        # Not dispatched for the validity test, the next job is a full test
+        self.assertEqual('test_full', job.action)
+        first = Submission.objects.get(pk=first.pk)
+        second = Submission.objects.get(pk=second.pk)
+        self.assertNotEqual(Submission.TEST_VALIDITY_PENDING, second.state)
+        self.assertEqual(first.get_validation_result().result,
+                         second.get_validation_result().result)
+        self.assertIn("Re-used", second.get_validation_result().result_tutor)
+        self.assertEqual(0, second.get_validation_result().error_code)
+
+    def test_reuse_test_results_when_leasing(self):
+        self.validated_assignment.reuse_test_results = True
+        self.validated_assignment.save()
+        self._register_test_machine(create_user(get_student_dict(10)))
+        self.assertEqual(True, self._run_executor())
+        second = create_validatable_submission(
+            create_user(get_student_dict(11)), self.validated_assignment, create_submission_file())
+        jobs = server.lease_jobs(self.config, 5)
+        self.assertEqual(['test_full'], list(set([job['Action'] for job in jobs])))
+        second = Submission.objects.get(pk=second.pk)
+        self.assertIn("Re-used", second.get_validation_result().result_tutor)
+
+    def test_invalid_job_request(self):
+        machine = self._register_executor()
+        params = {'Secret': settings.JOB_EXECUTOR_SECRET, 'UUID': machine.host}
+        for name in ('Wait', 'Jobs'):
+            response = self.client.get('/jobs/', dict(params, **{name: 'many'}))
+            self.assertEqual(400, response.status_code)
+        # Values out of range are limited
+        response = self.client.get('/jobs/', dict(params, Wait='-5', Jobs='1000'))
+        self.assertEqual(404, response.status_code)
+
+    def test_long_poll_timeout(self):
+        self._register_executor()
+        started = time.time()
+        self.assertEqual(None, server.fetch_job(self.config, wait=2))
+        self.assertGreaterEqual(time.time() - started, 2)
+
+    def test_long_poll_wakeup(self):
+        test_machine = self._register_executor()
+        self.validated_assignment.test_machines.add(test_machine)
+        jobs = []
+        waiting = threading.Thread(
+            target=lambda: jobs.append(server.fetch_job(self.config, wait=20)))
+        started = time.time()
+        waiting.start()
+        time.sleep(1)
+        sf = create_submission_file()
+        create_validatable_submission(self.user, self.validated_assignment, sf)
+        waiting.join()
+        self.assertIsNotNone(jobs[0])
+        # Woken up by the new submission, not by the database re-check
+        self.assertLess(time.time() - started, 4)
+
+    def test_connection_pooling(self):
+        sub = self._register_test_machine()
+        self.assertEqual(True, self._run_executor())
+        self.assertIsNotNone(connection._session)
+        results = SubmissionTestResult.objects.filter(
+            submission_file=sub.file_upload,
+            kind=SubmissionTestResult.VALIDITY_TEST
+        )
+        self.assertEqual(1, len(results))
+
+    def test_without_connection_pooling(self):
+        self.config.set("Server", "pooling", "False")
+        sub = self._register_test_machine()
+        self.assertEqual(True, self._run_executor())
+        results = SubmissionTestResult.objects.filter(
+            submission_file=sub.file_upload,
+            kind=SubmissionTestResult.VALIDITY_TEST
+        )
+        self.assertEqual(1, len(results))
+
     def test_register_executor_explicit(self):
         machine_count = TestMachine.objects.all().count()
         assert(self._register_executor().pk)
@@ -548,3 +1398,21 @@ class Communication(SubmitStudentScenarioTestCase):
         # whatever the executor says
         sub1 = Submission.objects.get(pk=sub1.pk)
         self.assertEqual(old_sub1_state, sub1.state)
+
+
+class LoadTest(TransactionTestCase):
+    '''
+    Test case for the load test of the executor API.
+    '''
+    def test_loadtest_command(self):
+        from io import StringIO
+        out = StringIO()
+        call_command('loadtest', executors=4, submissions=6, duration=5, poll_interval=0.2,
+                     run_time=0.05, batch=2, seed=1, stdout=out)
+        report = out.getvalue()
+        self.assertIn('POST /machines/', report)
+        self.assertIn('GET /jobs/', report)
+        # SQLite may refuse some parallel requests, so not all jobs may be done
+        self.assertGreater(int(re.search(r'(\d+) results reported', report).group(1)), 0)
+        self.assertIn('0 double dispatches, 0 duplicate test results', report)
+        self.assertEqual(0, Submission.objects.count())
@@ -63,3 +63,18 @@ class SubmissionFile(SubmitStudentTestCase):
             "submfiles/duplicates/duplicate_copy.zip",
             "submfiles/validation/1000ttt/packed.tgz")
         self.assertNotEqual(sub1.file_upload.md5, sub2.file_upload.md5)
+
+    def test_checksum_memo_is_bounded(self):
+        from opensubmit.models import submissionfile
+        sub1, sub2 = self.prepare_submission(
+            "submfiles/validation/1100ttf/validator.py",
+            "submfiles/validation/1100ttf/packed.zip")
+        old_size = submissionfile.CHECKSUM_CACHE_SIZE
+        submissionfile.CHECKSUM_CACHE_SIZE = 1
+        try:
+            checksum = sub1.file_upload.attachment_checksum()
+            sub2.file_upload.attachment_checksum()
+            self.assertEqual(1, len(submissionfile._checksums))
+            self.assertEqual(checksum, sub1.file_upload.attachment_checksum())
+        finally:
+            submissionfile.CHECKSUM_CACHE_SIZE = old_size
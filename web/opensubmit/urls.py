@@ -46,6 +46,7 @@ urlpatterns = [
     # Executor URLs
     url(r'^download/(?P<pk>\d+)/validity_testscript/secret=(?P<secret>\w+)$', api.ValidityScriptView.as_view(), name='validity_script_secret'),
     url(r'^download/(?P<pk>\d+)/full_testscript/secret=(?P<secret>\w+)$', api.FullScriptView.as_view(), name='full_testscript_secret'),
+    url(r'^download/(?P<pk>\d+)/submission/secret=(?P<secret>\w+)$', api.SubmissionFileView.as_view(), name='submission_file_secret'),
     url(r'^jobs/$', api.jobs, name='jobs'),
     url(r'^machines/$', api.MachinesView.as_view(), name='machines'),
     # Error pages
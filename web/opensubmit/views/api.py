@@ -6,23 +6,36 @@
 '''
 
 from datetime import datetime, timedelta
+from collections import OrderedDict
+import json
+import time
 import os
 
 from django.core.exceptions import PermissionDenied
 from django.core.mail import mail_managers
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, FileResponse, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import DetailView, View
 from django.utils.decorators import method_decorator
 
 from django.conf import settings
-from opensubmit.models import Assignment, Submission, TestMachine, SubmissionFile
+from opensubmit.models import Assignment, Submission, TestMachine, SubmissionFile, SubmissionTestResult
 from opensubmit.views.helpers import BinaryDownloadMixin
+from opensubmit import signalhandlers
 
 import logging
 logger = logging.getLogger('OpenSubmit')
 
+# Semantic versioning of the executor protocol
+API_VERSION = '1.2.0'
+
+# Maximum number of jobs leased with one request
+JOB_BATCH_LIMIT = 50
+
+# Database polling interval in seconds for requests waiting for jobs
+JOB_RECHECK_INTERVAL = 5
+
 
 class ValidityScriptView(BinaryDownloadMixin, DetailView):
     '''
@@ -58,6 +71,26 @@ class FullScriptView(BinaryDownloadMixin, DetailView):
         return ass
 
 
+class SubmissionFileView(DetailView):
+    '''
+    Download of a submission file by the executor.
+    '''
+    model = SubmissionFile
+
+    def get(self, request, *args, **kwargs):
+        if self.kwargs['secret'] != settings.JOB_EXECUTOR_SECRET:
+            raise PermissionDenied
+        submission_file = self.get_object()
+        f = submission_file.attachment
+        if not os.access(f.path, os.F_OK):
+            raise Http404
+        response = FileResponse(open(f.path, 'rb'), content_type='application/binary')
+        response['Content-Disposition'] = 'attachment; filename="%s"' % submission_file.basename()
+        response['Content-Length'] = os.path.getsize(f.path)
+        response['SubmissionFileChecksum'] = submission_file.attachment_checksum()
+        return response
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class MachinesView(View):
     '''
@@ -83,6 +116,284 @@ class MachinesView(View):
         return HttpResponse(status=201)
 
 
+def reset_timed_out_jobs(request, machine):
+    '''
+    Clean up submissions where the answer from the executors took too long.
+    '''
+    pending_submissions = Submission.pending_tests.filter(
+        file_upload__fetched__isnull=False)
+    #logger.debug("%u pending submission(s)"%(len(pending_submissions)))
+    for sub in pending_submissions:
+        max_delay = timedelta(
+            seconds=sub.assignment.attachment_test_timeout)
+        # There is a small chance that meanwhile the result was delivered, so fetched became NULL
+        if sub.file_upload.fetched and sub.file_upload.fetched + max_delay < datetime.now():
+            logger.debug(
+                "Resetting executor fetch status for submission %u, due to timeout" % sub.pk)
+            # TODO:  Late delivery for such a submission by the executor may lead to result overwriting. Check this.
+            sub.clean_fetch_date()
+            if sub.state == Submission.TEST_VALIDITY_PENDING:
+                sub.save_validation_result(
+                    machine, "Killed due to non-reaction. Please check your application for deadlocks or keyboard input.", "Killed due to non-reaction on timeout signals.")
+                sub.state = Submission.TEST_VALIDITY_FAILED
+                sub.inform_student(request, sub.state)
+            if sub.state == Submission.TEST_FULL_PENDING:
+                sub.save_fulltest_result(
+                    machine, "Killed due to non-reaction on timeout signals. Student not informed, since this was the full test.")
+                sub.state = Submission.TEST_FULL_FAILED
+            sub.save()
+
+
+def count_parameter(request, name, default, maximum):
+    '''
+    Returns the numeric GET parameter, limited to the range from 0 to 'maximum'.
+    Raises ValueError if it is no number.
+    '''
+    return max(0, min(int(request.GET.get(name, default)), maximum))
+
+
+def fetchable_submissions(request, machine, wait=0):
+    '''
+    Returns the submissions pending for testing on the given machine.
+
+    If there are none, wait up to 'wait' seconds for new ones. Submission
+    changes in other server processes do not wake us up, so the database
+    is checked again every JOB_RECHECK_INTERVAL seconds.
+    '''
+    deadline = time.time() + wait
+    while True:
+        generation = signalhandlers.job_generation
+        reset_timed_out_jobs(request, machine)
+        submissions = Submission.pending_tests
+        submissions = submissions.filter(assignment__in=machine.assignments.all()) \
+                                 .filter(file_upload__isnull=False) \
+                                 .filter(file_upload__fetched__isnull=True)
+        remaining = deadline - time.time()
+        if remaining <= 0 or submissions.exists():
+            return submissions
+        signalhandlers.wait_for_new_job(generation, min(remaining, JOB_RECHECK_INTERVAL))
+
+
+def reuse_test_result(request, sub):
+    '''
+    Complete the pending test of a just leased submission, if its assignment
+    re-uses test results and some byte-identical upload was already tested
+    with the same test script. Only leased candidates are checked, so that
+    polling executors do not search for results again and again.
+
+    Returns True if the test was completed this way.
+    '''
+    if not sub.assignment.reuse_test_results:
+        return False
+    result = sub.reusable_test_result()
+    if not result:
+        return False
+    logger.debug("Re-using test result %u for submission %u" % (result.pk, sub.pk))
+    if result.kind == SubmissionTestResult.VALIDITY_TEST:
+        action = 'test_validity'
+    else:
+        action = 'test_full'
+    message_tutor = "%s\n\n(Re-used result of submission file %u.)" % (
+        result.result_tutor or '', result.submission_file.pk)
+    # Moves the submission on, maybe to the next pending test
+    store_test_result(request, sub, result.machine, action, result.result,
+                      message_tutor, result.error_code, result.perf_data)
+    return True
+
+
+def report_missing_file(sub):
+    mail_managers('Warning: Missing file',
+                  'Missing file on storage for submission file entry %u: %s' % (
+                      sub.file_upload.pk, str(sub.file_upload.attachment)), fail_silently=True)
+
+
+def job_description(request, sub):
+    '''
+    Returns the job meta data for a submission, as sent to the executor.
+    '''
+    desc = OrderedDict()
+    desc['SubmissionFileChecksum'] = sub.file_upload.attachment_checksum()
+    desc['SubmissionFileId'] = str(sub.file_upload.pk)
+    desc['SubmissionOriginalFilename'] = sub.file_upload.original_filename
+    desc['SubmissionId'] = str(sub.pk)
+    desc['SubmitterName'] = sub.submitter.get_full_name()
+    desc['SubmitterStudentId'] = sub.submitter.profile.student_id
+    desc['AuthorNames'] = str(sub.authors.all())
+    desc['SubmitterStudyProgram'] = str(sub.submitter.profile.study_program)
+    desc['Course'] = str(sub.assignment.course)
+    desc['Assignment'] = str(sub.assignment)
+    desc['Timeout'] = sub.assignment.attachment_test_timeout
+    if sub.state == Submission.TEST_VALIDITY_PENDING:
+        desc['Action'] = 'test_validity'
+        desc['PostRunValidation'] = sub.assignment.validity_test_url(request)
+        validator_hash = sub.assignment.validity_test_checksum()
+    elif sub.state == Submission.TEST_FULL_PENDING or sub.state == Submission.CLOSED_TEST_FULL_PENDING:
+        desc['Action'] = 'test_full'
+        desc['PostRunValidation'] = sub.assignment.full_test_url(request)
+        validator_hash = sub.assignment.full_test_checksum()
+    else:
+        assert (False)
+    if validator_hash:
+        desc['ValidatorHash'] = validator_hash
+    limits = [('LimitCpuTime', sub.assignment.limit_cpu_time),
+              ('LimitMemory', sub.assignment.limit_memory),
+              ('LimitProcesses', sub.assignment.limit_processes),
+              ('LimitFileSize', sub.assignment.limit_file_size)]
+    for key, value in limits:
+        if value:
+            desc[key] = value
+    return desc
+
+
+def lease_jobs(request, submissions, count):
+    '''
+    Lease up to 'count' of the given submissions to the calling executor,
+    and return a JSON manifest with their job meta data.
+
+    Each submission is leased with a conditional update, so parallel
+    executors never get the same job. Pending tests that can re-use
+    an earlier result are completed instead of being handed out.
+    '''
+    count = max(0, min(count, JOB_BATCH_LIMIT))
+    manifest = []
+    # Some candidates may be leased by other executors meanwhile
+    for sub in submissions[:count * 2]:
+        if len(manifest) == count:
+            break
+        if not os.access(sub.file_upload.attachment.path, os.F_OK):
+            report_missing_file(sub)
+            continue
+        if not sub.lease_for_testing() or reuse_test_result(request, sub):
+            continue
+        Submission.objects.filter(pk=sub.pk).update(modified=datetime.now())
+        desc = job_description(request, sub)
+        desc['SubmissionUrl'] = sub.file_upload.executor_download_url(request)
+        manifest.append(desc)
+        logger.debug("Leasing submission %u as new %s job" %
+                     (sub.pk, desc['Action']))
+    if len(manifest) == 0:
+        raise Http404
+    response = JsonResponse({'Jobs': manifest})
+    response['APIVersion'] = API_VERSION
+    return response
+
+
+def parse_timeline(sub, timeline):
+    '''
+    Returns the list of job phases from the timeline sent by the executor,
+    or None if there is none.
+
+    The executor cannot know how long the sending of the result takes,
+    so this duration is estimated from the fetch date of the submission.
+    '''
+    if not timeline:
+        return None
+    try:
+        phases = json.loads(timeline)['phases']
+        for phase in phases:
+            phase['start'] = float(phase['start'])
+            if phase['duration'] is not None:
+                phase['duration'] = float(phase['duration'])
+    except (ValueError, TypeError, KeyError):
+        logger.error("Ignoring invalid timeline for submission %u" % (sub.pk))
+        return None
+    fetched = sub.get_fetch_date()
+    if phases and phases[-1]['duration'] is None and fetched:
+        elapsed = (datetime.now() - fetched).total_seconds()
+        phases[-1]['duration'] = max(0.0, elapsed - phases[-1]['start'])
+    return phases
+
+
+def store_test_result(request, sub, machine, action, message, message_tutor, error_code, perf_data=None, phases=None):
+    '''
+    Store a test result for the submission and advance its state accordingly.
+    '''
+    # Job state: Waiting for validity test
+    # Possible with + without full test
+    # Possible with + without grading
+    if action == 'test_validity' and sub.state == Submission.TEST_VALIDITY_PENDING:
+        sub.save_validation_result(
+            machine, message, message_tutor, perf_data, error_code, phases)
+        if error_code == 0:
+            # We have a full test
+            if sub.assignment.attachment_test_full:
+                logger.debug(
+                    "Validity test working, setting state to pending full test")
+                sub.state = Submission.TEST_FULL_PENDING
+            # We have no full test
+            else:
+                logger.debug(
+                    "Validity test working, setting state to tested")
+                sub.state = Submission.SUBMITTED_TESTED
+                if not sub.assignment.is_graded():
+                    # Assignment is not graded. We are done here.
+                    sub.state = Submission.CLOSED
+                    sub.inform_student(request, Submission.CLOSED)
+        else:
+            logger.debug(
+                "Validity test not working, setting state to failed")
+            sub.state = Submission.TEST_VALIDITY_FAILED
+        sub.inform_student(request, sub.state)
+    # Job state: Waiting for full test
+    # Possible with + without grading
+    elif action == 'test_full' and sub.state == Submission.TEST_FULL_PENDING:
+        sub.save_fulltest_result(
+            machine, message_tutor, perf_data, error_code, phases)
+        if error_code == 0:
+            if sub.assignment.is_graded():
+                logger.debug("Full test working, setting state to tested (since graded)")
+                sub.state = Submission.SUBMITTED_TESTED
+            else:
+                logger.debug("Full test working, setting state to closed (since not graded)")
+                sub.state = Submission.CLOSED
+                sub.inform_student(request, Submission.CLOSED)
+        else:
+            logger.debug("Full test not working, setting state to failed")
+            sub.state = Submission.TEST_FULL_FAILED
+            # full tests may be performed several times and are meant to be a silent activity
+            # therefore, we send no mail to the student here
+    # Job state: Waiting for full test of already closed jobs ("re-test")
+    # Grading is already done
+    elif action == 'test_full' and sub.state == Submission.CLOSED_TEST_FULL_PENDING:
+        logger.debug(
+            "Closed full test done, setting state to closed again")
+        sub.save_fulltest_result(
+            machine, message_tutor, perf_data, error_code, phases)
+        sub.state = Submission.CLOSED
+        # full tests may be performed several times and are meant to be a silent activity
+        # therefore, we send no mail to the student here
+    elif action == 'test_validity' and sub.state == Submission.TEST_VALIDITY_FAILED:
+        # Can happen if the validation is set to failed due to timeout, but the executor delivers the late result.
+        # Happens in reality only with >= 2 executors, since the second one is pulling for new jobs and triggers
+        # the timeout check while the first one is still stucked with the big job.
+        # Can be ignored.
+        logger.debug(
+            "Ignoring executor result, since the submission is already marked as failed.")
+    else:
+        msg = '''
+            Dear OpenSubmit administrator,
+
+            the executors returned some result, but this does not fit to the current submission state.
+            This is a strong indication for a bug in OpenSubmit - sorry for that.
+            The system will ignore the report from executor and mark the job as to be repeated.
+            Please report this on the project GitHub page for further investigation.
+
+            Submission ID: %u
+            Submission File ID reported by the executor: %u
+            Action reported by the executor: %s
+            Current state of the submission: %s (%s)
+            Message from the executor: %s
+            Error code from the executor: %u
+            ''' % (sub.pk, sub.file_upload.pk, action,
+                   sub.state_for_tutors(), sub.state,
+                   message, error_code)
+        mail_managers('Warning: Inconsistent job state',
+                      msg, fail_silently=True)
+    # Mark work as done
+    sub.save()
+    sub.clean_fetch_date()
+
+
 @csrf_exempt
 def jobs(request):
     ''' This is the view used by the executor.py scripts for getting / putting the test results.
@@ -105,17 +416,39 @@ def jobs(request):
                     'ErrorCode',
                     'Action',
                     'Secret',
-                    'UUID'
+                    'UUID',
+                    'PerfData' (optional, JSON, see opensubmitexec.internaljob)
+                    'Timeline' (optional, JSON, see opensubmitexec.internaljob)
+
+        POST requests with 'Retry' give the job back without a result (API version 1.2),
+        for example when the executor pre-empted it. Only 'SubmissionFileId', 'Action',
+        'Secret' and 'UUID' are needed then. The submission is pending for testing again.
 
         GET requests are expected to contain the following parameters:
                     'Secret',
-                    'UUID'
+                    'UUID',
+                    'Jobs' (optional)
+                    'Wait' (optional)
 
         GET reponses deliver the following elements in the header:
                     'SubmissionFileId',
+                    'SubmissionFileChecksum',
                     'Timeout',
                     'Action',
-                    'PostRunValidation'
+                    'PostRunValidation',
+                    'ValidatorHash' (optional)
+                    'LimitCpuTime', 'LimitMemory', 'LimitProcesses', 'LimitFileSize' (optional)
+
+        GET requests with 'Jobs' lease up to this number of jobs at once (API version 1.1).
+        The JSON response contains a list 'Jobs' with the same elements per job,
+        plus the 'SubmissionUrl' for downloading the submission file.
+
+        GET requests with 'Wait' are held up to this number of seconds (API version 1.1),
+        until a job becomes available. The server limits the waiting time by the
+        JOB_EXECUTOR_MAX_WAIT setting.
+
+        'Jobs' and 'Wait' values out of range are limited, other values than
+        numbers are answered with HTTP 400.
     '''
     try:
         if request.method == 'GET':
@@ -141,7 +474,7 @@ def jobs(request):
             "Test machine is unknown, creating entry and asking executor for configuration.")
         response = HttpResponse()
         response['Action'] = 'get_config'
-        response['APIVersion'] = '1.0.0'  # semantic versioning
+        response['APIVersion'] = API_VERSION
         response['MachineId'] = machine.pk
         return response
 
@@ -150,74 +483,41 @@ def jobs(request):
         raise Http404
 
     if request.method == "GET":
-        # Clean up submissions where the answer from the executors took too long
-        pending_submissions = Submission.pending_tests.filter(
-            file_upload__fetched__isnull=False)
-        #logger.debug("%u pending submission(s)"%(len(pending_submissions)))
-        for sub in pending_submissions:
-            max_delay = timedelta(
-                seconds=sub.assignment.attachment_test_timeout)
-            # There is a small chance that meanwhile the result was delivered, so fetched became NULL
-            if sub.file_upload.fetched and sub.file_upload.fetched + max_delay < datetime.now():
-                logger.debug(
-                    "Resetting executor fetch status for submission %u, due to timeout" % sub.pk)
-                # TODO:  Late delivery for such a submission by the executor may lead to result overwriting. Check this.
-                sub.clean_fetch_date()
-                if sub.state == Submission.TEST_VALIDITY_PENDING:
-                    sub.save_validation_result(
-                        machine, "Killed due to non-reaction. Please check your application for deadlocks or keyboard input.", "Killed due to non-reaction on timeout signals.")
-                    sub.state = Submission.TEST_VALIDITY_FAILED
-                    sub.inform_student(request, sub.state)
-                if sub.state == Submission.TEST_FULL_PENDING:
-                    sub.save_fulltest_result(
-                        machine, "Killed due to non-reaction on timeout signals. Student not informed, since this was the full test.")
-                    sub.state = Submission.TEST_FULL_FAILED
-                sub.save()
-
-        # Now get an appropriate submission.
-        submissions = Submission.pending_tests
-        submissions = submissions.filter(assignment__in=machine.assignments.all()) \
-                                 .filter(file_upload__isnull=False) \
-                                 .filter(file_upload__fetched__isnull=True)
-        if len(submissions) == 0:
+        try:
+            wait = count_parameter(request, 'Wait', 0, settings.JOB_EXECUTOR_MAX_WAIT)
+            count = count_parameter(request, 'Jobs', 1, JOB_BATCH_LIMIT)
+        except ValueError:
+            logger.error("Invalid 'Wait' or 'Jobs' parameter in executor request.")
+            return HttpResponseBadRequest()
+        submissions = fetchable_submissions(request, machine, wait)
+
+        if 'Jobs' in request.GET:
+            return lease_jobs(request, submissions, count)
+
+        # Parallel waiting requests are woken up together, so lease atomically
+        for sub in submissions:
+            if sub.lease_for_testing() and not reuse_test_result(request, sub):
+                break
+        else:
             # Nothing found to be fetchable
             #logger.debug("No pending work for executors")
             raise Http404
-        else:
-            sub = submissions[0]
-        sub.save_fetch_date()
-        sub.modified = datetime.now()
-        sub.save()
+        # No save(), it would wake up the other waiting requests
+        Submission.objects.filter(pk=sub.pk).update(modified=datetime.now())
 
         # create HTTP response with file download
         f = sub.file_upload.attachment
         # on dev server, we sometimes have stale database entries
         if not os.access(f.path, os.F_OK):
-            mail_managers('Warning: Missing file',
-                          'Missing file on storage for submission file entry %u: %s' % (
-                              sub.file_upload.pk, str(sub.file_upload.attachment)), fail_silently=True)
+            report_missing_file(sub)
             raise Http404
-        response = HttpResponse(f, content_type='application/binary')
-        response['APIVersion'] = '1.0.0'  # semantic versioning
+        # Stream the file, executors may fetch large uploads in parallel
+        response = FileResponse(open(f.path, 'rb'), content_type='application/binary')
+        response['APIVersion'] = API_VERSION
         response['Content-Disposition'] = 'attachment; filename="%s"' % sub.file_upload.basename()
-        response['SubmissionFileId'] = str(sub.file_upload.pk)
-        response['SubmissionOriginalFilename'] = sub.file_upload.original_filename
-        response['SubmissionId'] = str(sub.pk)
-        response['SubmitterName'] = sub.submitter.get_full_name()
-        response['SubmitterStudentId'] = sub.submitter.profile.student_id
-        response['AuthorNames'] = sub.authors.all()
-        response['SubmitterStudyProgram'] = str(sub.submitter.profile.study_program)
-        response['Course'] = str(sub.assignment.course)
-        response['Assignment'] = str(sub.assignment)
-        response['Timeout'] = sub.assignment.attachment_test_timeout
-        if sub.state == Submission.TEST_VALIDITY_PENDING:
-            response['Action'] = 'test_validity'
-            response['PostRunValidation'] = sub.assignment.validity_test_url(request)
-        elif sub.state == Submission.TEST_FULL_PENDING or sub.state == Submission.CLOSED_TEST_FULL_PENDING:
-            response['Action'] = 'test_full'
-            response['PostRunValidation'] = sub.assignment.full_test_url(request)
-        else:
-            assert (False)
+        response['Content-Length'] = os.path.getsize(f.path)
+        for key, value in job_description(request, sub).items():
+            response[key] = value
         logger.debug("Delivering submission %u as new %s job" %
                      (sub.pk, response['Action']))
         return response
@@ -235,91 +535,25 @@ def jobs(request):
         sid = request.POST['SubmissionFileId']
         submission_file = get_object_or_404(SubmissionFile, pk=sid)
         sub = submission_file.submissions.all()[0]
+        if request.POST.get('Retry'):
+            logger.debug("Executor gave back the %s job for submission %u" %
+                         (request.POST['Action'], sub.pk))
+            sub.clean_fetch_date()
+            # No save(), so the waiting requests are woken up explicitly
+            signalhandlers.notify_new_job()
+            return HttpResponse(status=201)
         logger.debug("Storing executor results for submission %u" % (sub.pk))
         error_code = int(request.POST['ErrorCode'])
-        # Job state: Waiting for validity test
-        # Possible with + without full test
-        # Possible with + without grading
-        if request.POST['Action'] == 'test_validity' and sub.state == Submission.TEST_VALIDITY_PENDING:
-            sub.save_validation_result(
-                machine, request.POST['Message'], request.POST['MessageTutor'])
-            if error_code == 0:
-                # We have a full test
-                if sub.assignment.attachment_test_full:
-                    logger.debug(
-                        "Validity test working, setting state to pending full test")
-                    sub.state = Submission.TEST_FULL_PENDING
-                # We have no full test
-                else:
-                    logger.debug(
-                        "Validity test working, setting state to tested")
-                    sub.state = Submission.SUBMITTED_TESTED
-                    if not sub.assignment.is_graded():
-                        # Assignment is not graded. We are done here.
-                        sub.state = Submission.CLOSED
-                        sub.inform_student(request, Submission.CLOSED)
-            else:
-                logger.debug(
-                    "Validity test not working, setting state to failed")
-                sub.state = Submission.TEST_VALIDITY_FAILED
-            sub.inform_student(request, sub.state)
-        # Job state: Waiting for full test
-        # Possible with + without grading
-        elif request.POST['Action'] == 'test_full' and sub.state == Submission.TEST_FULL_PENDING:
-            sub.save_fulltest_result(
-                machine, request.POST['MessageTutor'])
-            if error_code == 0:
-                if sub.assignment.is_graded():
-                    logger.debug("Full test working, setting state to tested (since graded)")
-                    sub.state = Submission.SUBMITTED_TESTED
-                else:
-                    logger.debug("Full test working, setting state to closed (since not graded)")
-                    sub.state = Submission.CLOSED
-                    sub.inform_student(request, Submission.CLOSED)
-            else:
-                logger.debug("Full test not working, setting state to failed")
-                sub.state = Submission.TEST_FULL_FAILED
-                # full tests may be performed several times and are meant to be a silent activity
-                # therefore, we send no mail to the student here
-        # Job state: Waiting for full test of already closed jobs ("re-test")
-        # Grading is already done
-        elif request.POST['Action'] == 'test_full' and sub.state == Submission.CLOSED_TEST_FULL_PENDING:
-            logger.debug(
-                "Closed full test done, setting state to closed again")
-            sub.save_fulltest_result(
-                machine, request.POST['MessageTutor'])
-            sub.state = Submission.CLOSED
-            # full tests may be performed several times and are meant to be a silent activity
-            # therefore, we send no mail to the student here
-        elif request.POST['Action'] == 'test_validity' and sub.state == Submission.TEST_VALIDITY_FAILED:
-            # Can happen if the validation is set to failed due to timeout, but the executor delivers the late result.
-            # Happens in reality only with >= 2 executors, since the second one is pulling for new jobs and triggers
-            # the timeout check while the first one is still stucked with the big job.
-            # Can be ignored.
-            logger.debug(
-                "Ignoring executor result, since the submission is already marked as failed.")
-        else:
-            msg = '''
-                Dear OpenSubmit administrator,
-
-                the executors returned some result, but this does not fit to the current submission state.
-                This is a strong indication for a bug in OpenSubmit - sorry for that.
-                The system will ignore the report from executor and mark the job as to be repeated.
-                Please report this on the project GitHub page for further investigation.
-
-                Submission ID: %u
-                Submission File ID reported by the executor: %u
-                Action reported by the executor: %s
-                Current state of the submission: %s (%s)
-                Message from the executor: %s
-                Error code from the executor: %u
-                ''' % (sub.pk, submission_file.pk, request.POST['Action'],
-                       sub.state_for_tutors(), sub.state,
-                       request.POST['Message'], error_code)
-            mail_managers('Warning: Inconsistent job state',
-                          msg, fail_silently=True)
-        # Mark work as done
-        sub.save()
-        sub.clean_fetch_date()
+        perf_data = request.POST.get('PerfData')
+        if perf_data:
+            try:
+                json.loads(perf_data)
+            except ValueError:
+                logger.error("Ignoring invalid performance data for submission %u" % (sub.pk))
+                perf_data = None
+        phases = parse_timeline(sub, request.POST.get('Timeline'))
+        store_test_result(request, sub, machine, request.POST['Action'],
+                          request.POST['Message'], request.POST.get('MessageTutor'),
+                          error_code, perf_data, phases)
         return HttpResponse(status=201)
 